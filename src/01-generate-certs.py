@@ -3,14 +3,18 @@
 # 04
 
 import os
-import subprocess
 import sys
 import argparse
-import json
-from string import Template
-import shutil
-import logging
-import tarfile
+import datetime
+
+from kthw.signer import BACKENDS, CFSSL_TIMEOUT, DEFAULT_CA_EXPIRY, DEFAULT_KEY_ALGORITHM, KEY_ALGORITHMS, SignerError, getSigner, loadProfile, parseDuration
+from kthw.manifest import MANIFEST_FILE, CertManifest, dataDigest, fileDigest
+from kthw.csr import CsrError, renderCsr, renderCsrs, writeDebugCsr
+from kthw.config import ConfigError, loadConfig
+from kthw.archive import buildHostBundles, bundlePath, hostBundles
+from kthw.keypool import DEFAULT_LOW_WATER, DEFAULT_POOL, KeyPool
+from kthw.deliver import DELIVERY_MODES
+from kthw.trace import span, traced
 
 kubernetes_hostnames = "kubernetes,kubernetes.default,kubernetes.default.svc,kubernetes.default.svc.cluster,kubernetes.svc.cluster.local"
 
@@ -25,17 +29,30 @@ kubernetes_static_ip_addresses = "10.32.0.1"
 cfssl = "cfssl"
 cfssl_json = "cfssl-json"
 
-print(":: Setting up SSL certificates")
 
-def checkCertsDir(clusterConfig,template_files):
+def ownedFile(name):
+    # certificates, keys and CSRs, the manifest and the host bundles (with their .sha256)
+    if name == MANIFEST_FILE:
+        return True
+    if name.startswith("k8s-certs-") and (name.endswith(".tar.gz") or name.endswith(".tar.gz.sha256")):
+        return True
+    return name.endswith(".pem") or name.endswith(".csr") or name.endswith("-csr.json")
+
+
+def checkCertsDir(clusterConfig,template_files,incremental=False):
     print(":: Checking certs directory exists.")
 
     if not os.path.exists(clusterConfig['certificatesPath']):
         os.mkdir(clusterConfig['certificatesPath'])
+    elif incremental:
+        print('keeping existing certificates (incremental).')
     else:
+        # only what this script writes: k8sConfPath may be the same directory, and a new
+        # encryption-config.yaml would make the Secrets already in etcd unreadable
         print('removing..')
-        shutil.rmtree(clusterConfig['certificatesPath'])
-        os.mkdir(clusterConfig['certificatesPath'])
+        for name in os.listdir(clusterConfig['certificatesPath']):
+            if ownedFile(name):
+                os.remove(os.path.join(clusterConfig['certificatesPath'], name))
 
     if (
         os.path.exists(template_files["ca_config"])
@@ -52,29 +69,45 @@ def checkCertsDir(clusterConfig,template_files):
         sys.exit(1)
 
 
-def genPemFiles(clusterConfig,template_files):
-    # check cfssl is installed
+def keySpec(clusterConfig,name):
+    # Key of certificate <name> for the keyAlgorithm of cluster.json, None to keep the key of the CSR template.
+    # The service account key signs tokens and stays RSA; the default keeps the manifests of existing trees.
+    if name == "service-account" or clusterConfig['keyAlgorithm'] == DEFAULT_KEY_ALGORITHM:
+        return None
+    return KEY_ALGORITHMS[clusterConfig['keyAlgorithm']]
+
+@traced
+def genPemFiles(clusterConfig,template_files,signer,manifest,rotate_ca=False):
     try:
         print(":: Generating Certificates.")
         print("Generating .pem files")
 
-        p1_gen_cert1 = subprocess.Popen(
-            [cfssl, "gencert", "-initca", template_files["ca_csr"]],
-            stdout=subprocess.PIPE,
-        )
-
         print(
             "#################################################################################################################"
         )
-        p2_json_out1 = subprocess.Popen(
-            [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "ca"],
-            stdin=p1_gen_cert1.stdout,
-            stdout=subprocess.PIPE,
-        )
+        ca_base = clusterConfig['certificatesPath'] + "/" + "ca"
 
-        p1_gen_cert1.stdout.close()
-        output, err = p2_json_out1.communicate()
-        # cfssl gencert -initca ca-csr.json | cfssljson -bare ca
+        # in incremental mode the existing CA is kept until it is explicitly rotated
+        if (
+            manifest.incremental
+            and not rotate_ca
+            and os.path.exists(ca_base + ".pem")
+            and os.path.exists(ca_base + "-key.pem")
+        ):
+            print("> Reusing existing CA %s.pem (use --rotate-ca to replace it)." % ca_base)
+        else:
+            # cfssl gencert -initca ca-csr.json | cfssljson -bare ca
+            key_spec = keySpec(clusterConfig, "ca")
+            csr = renderCsr(template_files["ca_csr"])
+            writeDebugCsr(ca_base, csr)
+            signer.initCA(csr, ca_base, key_spec)
+            expiry = parseDuration(csr.get("ca", {}).get("expiry", DEFAULT_CA_EXPIRY))
+            inputs = {"csr": dataDigest(csr)}
+            if key_spec is not None:
+                inputs["key"] = dict(key_spec)
+            manifest.record("ca", inputs, datetime.datetime.now(datetime.timezone.utc) + expiry)
+
+        manifest.ca_fingerprint = fileDigest(ca_base + ".pem")
 
         if (
             os.path.exists(clusterConfig['certificatesPath'] + "/ca.pem")
@@ -84,325 +117,322 @@ def genPemFiles(clusterConfig,template_files):
             print(".pem files generated.")
         else:
             sys.exit(1)
-        # Generate admin certificates
 
         print(
             "#################################################################################################################"
         )
-    except Exception as err:
-        print(err)
+    except (SignerError, CsrError) as err:
+        print("ERROR > %s" % err)
         sys.exit(1)
 
-def genAdminCert(clusterConfig,template_files):
-
-    p2_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s"% clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-profile=kubernetes",
-            "%s" % template_files["admin_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
-
-    p2_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "admin"],
-        stdin=p2_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
-    )
+def issueCert(clusterConfig,template_files,signer,manifest,csr,name,hostnames=None):
+    # Sign <name>.pem/<name>-key.pem with the cluster CA using the "kubernetes" profile,
+    # unless the manifest shows an existing certificate with the same inputs.
+    # Returns True if a new certificate was issued.
+    with span("issueCert", certificate=name) as traced_span:
+        settings = loadProfile(template_files["ca_config"], "kubernetes")
+        key_spec = keySpec(clusterConfig, name)
+        inputs = manifest.inputs(csr, hostnames, manifest.ca_fingerprint, "kubernetes", settings, key_spec)
+
+        if manifest.isCurrent(name, inputs):
+            traced_span.update(issued=False)
+            return False
+
+        writeDebugCsr(clusterConfig['certificatesPath'] + "/" + name, csr)
+        signer.sign(
+            clusterConfig['certificatesPath'] + "/" + "ca",
+            template_files["ca_config"],
+            "kubernetes",
+            csr,
+            clusterConfig['certificatesPath'] + "/" + name,
+            hostnames,
+            key_spec,
+        )
+        manifest.record(name, inputs, datetime.datetime.now(datetime.timezone.utc) + parseDuration(settings.get("expiry", "8760h")))
+        traced_span.update(issued=True)
+        return True
 
-    p2_gen_cert1.stdout.close()
-    output, err = p2_json_out1.communicate()
+def signCert(clusterConfig,template_files,signer,manifest,csr_file,name,description,hostnames=None):
+    try:
+        issued = issueCert(clusterConfig, template_files, signer, manifest, renderCsr(csr_file), name, hostnames)
+    except (SignerError, CsrError) as err:
+        print("ERROR > %s certificate failed: %s" % (name, err))
+        sys.exit(1)
 
-    if p2_json_out1.returncode == 0:
-        print("> admin certificate generated.")
+    if issued:
+        print("> %s generated." % description)
     else:
-        sys.exit(1)
+        print("> %s up to date." % description)
 
-def genNodeCerts(clusterConfig,template_files):
-    # Worker node certificates
-    # Generate a certificate and private key for each Kubernetes worker node:
+@traced
+def genAdminCert(clusterConfig,template_files,signer,manifest):
 
-    worker_csr = Template(open(template_files["worker_csr"]).read())
+    signCert(clusterConfig, template_files, signer, manifest, template_files["admin_csr"], "admin", "admin certificate")
 
-    for worker in range(1, clusterConfig['workersCount'] + 1):
-        worker_csr_subst = {"instance": clusterConfig["workers"][worker -1]['name']}
-        worker_csr_data = worker_csr.substitute(worker_csr_subst)
+def genNodeCert(clusterConfig,template_files,signer,manifest,worker_csr,worker):
+    # Issue the certificate and private key for a single worker node from its rendered CSR.
+    # Returns (worker name, issued, error message or None) so callers can report each failure on its own.
 
-        with open(clusterConfig['certificatesPath'] + "/" + clusterConfig["workers"][worker -1]['name'] + "-csr.json", "w") as f:
-            f.writelines(json.dumps(json.loads(worker_csr_data), indent=4))
-        print(
-            "#################################################################################################################"
-        )
-        p3_gen_cert1 = subprocess.Popen(
-            [
-                cfssl,
-                "gencert",
-                "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-                "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-                "-config=%s" % template_files["ca_config"],
-                "-hostname=%s,%s,%s" % (clusterConfig["workers"][worker -1]['name'], clusterConfig["workers"][worker -1]['externalIP'], clusterConfig["workers"][worker -1]['internalIP']),
-                "-profile=kubernetes",
-                "%s" % clusterConfig['certificatesPath'] + "/" + clusterConfig["workers"][worker -1]['name'] + "-csr.json",
-            ],
-            stdout=subprocess.PIPE,
+    try:
+        issued = issueCert(
+            clusterConfig,
+            template_files,
+            signer,
+            manifest,
+            worker_csr,
+            worker['name'],
+            [worker['name'], worker['externalIP'], worker['internalIP']],
         )
+    except SignerError as err:
+        return worker['name'], False, str(err)
 
-        p3_json_out1 = subprocess.Popen(
-            [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "%s" % clusterConfig["workers"][worker -1]['name']],
-            stdin=p3_gen_cert1.stdout,
-            stdout=subprocess.PIPE,
-        )
+    return worker['name'], issued, None
 
-        p3_gen_cert1.stdout.close()
-        output, err = p3_json_out1.communicate()
 
-        if p3_json_out1.returncode == 0:
-            print("> %s certificate successfully generated." % clusterConfig["workers"][worker -1]['name'])
-        else:
-            sys.exit(1)
+def printNodeCert(name,issued):
+    if issued:
+        print("> %s certificate successfully generated." % name)
+    else:
+        print("> %s certificate up to date." % name)
 
-    print("> Worker node certificates stored in %s" % clusterConfig['certificatesPath'])
-    # f.close()
 
+@traced
+def genNodeCerts(clusterConfig,template_files,signer,manifest,jobs=1):
+    # Worker node certificates
+    # Generate a certificate and private key for each Kubernetes worker node:
+    # with jobs > 1 the per-worker signing runs concurrently in a bounded pool.
+    import concurrent.futures
 
-def genKubeControllerCert(clusterConfig,template_files):
-    print(":: Generating kube-controller-manager client certificate/private key.")
+    workers = clusterConfig["workers"][:clusterConfig['workersCount']]
+
+    # the CSRs of all workers in one pass over the parsed template
+    try:
+        worker_csrs = renderCsrs(template_files["worker_csr"], [{"instance": worker['name']} for worker in workers])
+    except CsrError as err:
+        print("ERROR > %s" % err)
+        sys.exit(1)
 
     print(
         "#################################################################################################################"
     )
 
-    p4_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-profile=kubernetes",
-            template_files["kube_controller_manager_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
-
-    p4_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "kube-controller-manager"],
-        stdin=p4_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
-    )
-
-    p4_gen_cert1.stdout.close()
-    output, err = p4_json_out1.communicate()
+    failed = []
 
-    if p4_json_out1.returncode == 0:
-        print("> kube-controller-manager client certificate generated.")
+    if jobs <= 1:
+        for worker, worker_csr in zip(workers, worker_csrs):
+            name, issued, error = genNodeCert(clusterConfig, template_files, signer, manifest, worker_csr, worker)
+            if error is not None:
+                print("ERROR > %s certificate failed: %s" % (name, error))
+                sys.exit(1)
+            printNodeCert(name, issued)
     else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(genNodeCert, clusterConfig, template_files, signer, manifest, worker_csr, worker): worker['name']
+                for worker, worker_csr in zip(workers, worker_csrs)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    name, issued, error = future.result()
+                except concurrent.futures.CancelledError:
+                    continue
+                except Exception as err:
+                    error = str(err)
+
+                if error is not None:
+                    print("ERROR > %s certificate failed: %s" % (name, error))
+                    failed.append(name)
+                    # fail fast: don't start signing jobs that haven't been picked up yet
+                    for pending in futures:
+                        pending.cancel()
+                else:
+                    printNodeCert(name, issued)
+
+    if len(failed) > 0:
+        print("ERROR > Failed to generate certificates for: %s" % ", ".join(failed))
         sys.exit(1)
 
+    print("> Worker node certificates stored in %s" % clusterConfig['certificatesPath'])
+
 
-def genKubeProxyCert(clusterConfig,template_files):
-    print(":: Generating kube-proxy certificate/private key.")
+@traced
+def genKubeControllerCert(clusterConfig,template_files,signer,manifest):
+    print(":: Generating kube-controller-manager client certificate/private key.")
 
     print(
         "#################################################################################################################"
     )
 
-    p5_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-profile=kubernetes",
-            template_files["kube_proxy_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
+    signCert(clusterConfig, template_files, signer, manifest, template_files["kube_controller_manager_csr"], "kube-controller-manager", "kube-controller-manager client certificate")
 
-    p5_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "kube-proxy"],
-        stdin=p5_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
-    )
 
-    p5_gen_cert1.stdout.close()
-    output, err = p5_json_out1.communicate()
+@traced
+def genKubeProxyCert(clusterConfig,template_files,signer,manifest):
+    print(":: Generating kube-proxy certificate/private key.")
 
-    if p5_json_out1.returncode == 0:
-        print("> kube-proxy client certificate generated.")
-    else:
-        sys.exit(1)
+    print(
+        "#################################################################################################################"
+    )
+
+    signCert(clusterConfig, template_files, signer, manifest, template_files["kube_proxy_csr"], "kube-proxy", "kube-proxy client certificate")
 
 
-def genKubeScheduler(clusterConfig,template_files):
+@traced
+def genKubeScheduler(clusterConfig,template_files,signer,manifest):
     print(":: Generating kube-scheduler certificate/private key.")
 
     print(
         "#################################################################################################################"
     )
 
-    p6_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-profile=kubernetes",
-            template_files["kube_scheduler_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
-
-    p6_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "kube-scheduler"],
-        stdin=p6_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
-    )
-
-    p6_gen_cert1.stdout.close()
-    output, err = p6_json_out1.communicate()
-
-    if p6_json_out1.returncode == 0:
-        print("> kube-scheduler certificate generated.")
-    else:
-        sys.exit(1)
+    signCert(clusterConfig, template_files, signer, manifest, template_files["kube_scheduler_csr"], "kube-scheduler", "kube-scheduler certificate")
 
 
-def genApiServerCert(clusterConfig,template_files):
+@traced
+def genApiServerCert(clusterConfig,template_files,signer,manifest):
     print(":: Generating API Server certificate/private key.")
 
     print(
         "#################################################################################################################"
     )
 
-    static_internal_ip = ""
-
-    for controller in clusterConfig['controllers']:
-
-        static_internal_ip += controller['internalIP'] + ","
-  
-    p7_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-hostname=%s,%s,127.0.0.1,%s"
-                            % (kubernetes_static_ip_addresses + "," + static_internal_ip[:-1], clusterConfig['staticExternalIP'], kubernetes_hostnames),
-            "-profile=kubernetes",
-            template_files["kubernetes_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
+    static_internal_ip = [controller['internalIP'] for controller in clusterConfig['controllers']]
 
-    p7_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "kubernetes"],
-        stdin=p7_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
+    hostnames = (
+        [kubernetes_static_ip_addresses]
+        + static_internal_ip
+        + [clusterConfig['staticExternalIP'], "127.0.0.1"]
+        + kubernetes_hostnames.split(",")
     )
 
-    p7_gen_cert1.stdout.close()
-    output, err = p7_json_out1.communicate()
-
-    if p7_json_out1.returncode == 0:
-        print("> API Server certificate generated.")
-    else:
-        sys.exit(1)
+    signCert(clusterConfig, template_files, signer, manifest, template_files["kubernetes_csr"], "kubernetes", "API Server certificate", hostnames)
 
 
-def genServiceAccCert(clusterConfig,template_files):
+@traced
+def genServiceAccCert(clusterConfig,template_files,signer,manifest):
     print(":: Generating Service account certificate/private key.")
 
     print(
         "#################################################################################################################"
     )
 
-    p8_gen_cert1 = subprocess.Popen(
-        [
-            cfssl,
-            "gencert",
-            "-ca=%s" % clusterConfig['certificatesPath'] + "/" + "ca.pem",
-            "-ca-key=%s" % clusterConfig['certificatesPath'] + "/" + "ca-key.pem",
-            "-config=%s" % template_files["ca_config"],
-            "-profile=kubernetes",
-            template_files["service_account_csr"],
-        ],
-        stdout=subprocess.PIPE,
-    )
+    signCert(clusterConfig, template_files, signer, manifest, template_files["service_account_csr"], "service-account", "Service account certificate")
 
-    p8_json_out1 = subprocess.Popen(
-        [cfssl_json, "-bare", clusterConfig['certificatesPath'] + "/" + "service-account"],
-        stdin=p8_gen_cert1.stdout,
-        stdout=subprocess.PIPE,
-    )
 
-    p8_gen_cert1.stdout.close()
-    output, err = p8_json_out1.communicate()
+@traced
+def archiveFiles(clusterConfig):
+    # One bundle per host with only the files that host needs.
+    print("::Archiving files.")
+    try:
+        path = clusterConfig['certificatesPath']
+
+        changed = buildHostBundles(path, "k8s-certs", hostBundles(clusterConfig, "certs"))
+        for host in changed:
+            if changed[host]:
+                print("%s written." % bundlePath(path, "k8s-certs", host))
+            else:
+                print("%s unchanged." % bundlePath(path, "k8s-certs", host))
 
-    if p8_json_out1.returncode == 0:
-        print("> Service account certificate generated.")
-    else:
+    except Exception as err:
+        print(err)
         sys.exit(1)
 
+# (component, gen function) for every certificate signed by the CA, see generateCerts
+CERT_COMPONENTS = [
+    ("admin", genAdminCert),
+    ("workers", genNodeCerts),
+    ("kube-controller-manager", genKubeControllerCert),
+    ("kube-proxy", genKubeProxyCert),
+    ("kube-scheduler", genKubeScheduler),
+    ("kubernetes", genApiServerCert),
+    ("service-account", genServiceAccCert),
+]
+
+
+def prepareCerts(clusterConfig,backend="native",jobs=1,incremental=False,rotate_ca=False,renew_before="720h",key_pool=None,key_pool_low_water=DEFAULT_LOW_WATER,delivery="bundle",command_timeout=None):
+    # Set up the certificates directory and the CA.
+    # Returns the context genComponentCert and finishCerts work on.
+    template_files = {
+        "ca_config": clusterConfig['templatesPath'] + "/ca-config.json",
+        "ca_csr": clusterConfig['templatesPath'] + "/ca-csr.json",
+        "admin_csr": clusterConfig['templatesPath'] + "/admin-csr.json",
+        "worker_csr": clusterConfig['templatesPath'] + "/worker-csr.json",
+        "kube_controller_manager_csr": clusterConfig['templatesPath'] + "/kube-controller-manager-csr.json",
+        "kube_proxy_csr": clusterConfig['templatesPath'] + "/kube-proxy-csr.json",
+        "kube_scheduler_csr": clusterConfig['templatesPath'] + "/kube-scheduler-csr.json",
+        "kubernetes_csr": clusterConfig['templatesPath'] + "/kubernetes-csr.json",
+        "service_account_csr": clusterConfig['templatesPath'] + "/service-account-csr.json",
+    }
+
+    pool = KeyPool(key_pool, key_pool_low_water) if key_pool is not None else None
 
-def extractConfig(configFile):
     try:
-        # read json file
-        configData = json.load(open(configFile))
+        signer = getSigner(backend, cfssl, cfssl_json, pool, command_timeout)
+        renew_before = parseDuration(renew_before)
+    except SignerError as err:
+        print("ERROR > %s" % err)
+        sys.exit(1)
 
-        if(len(configData) > 0):
-            workersCount = configData[0]['workersCount']
-            controllersCount = configData[0]['controllersCount']
+    checkCertsDir(clusterConfig,template_files,incremental)
 
-            staticExternalIP = configData[0]['staticExternalIP']
+    manifest = CertManifest(clusterConfig['certificatesPath'], incremental, renew_before)
+    manifest.load()
 
-            certificatesPath = configData[0]['certificatesPath']
-            k8sCertsPath = configData[0]['certificatesPath']
-            templatesPath = configData[0]['templatesPath']
+    genPemFiles(clusterConfig,template_files,signer,manifest,rotate_ca)
 
-            controllers = configData[0]['controllers']
-            workers = configData[0]['workers']
+    return {
+        "clusterConfig": clusterConfig,
+        "template_files": template_files,
+        "signer": signer,
+        "manifest": manifest,
+        "jobs": jobs,
+        "keyPool": pool,
+        "delivery": delivery,
+    }
 
 
+def genComponentCert(context,component):
+    genCert = dict(CERT_COMPONENTS)[component]
 
-            return {
-                "workersCount" : workersCount,
-                "controllersCount": controllersCount,
-                "workers" : workers,
-                "controllers": controllers,
-                "staticExternalIP": staticExternalIP,
-                "certificatesPath" : certificatesPath,
-                "templatesPath" : templatesPath
-            }
-    except Exception as error:
-        print(error)
-        sys.exit(1)
+    if genCert is genNodeCerts:
+        genNodeCerts(context['clusterConfig'], context['template_files'], context['signer'], context['manifest'], context['jobs'])
+    else:
+        genCert(context['clusterConfig'], context['template_files'], context['signer'], context['manifest'])
 
-def archiveFiles(clusterConfig):
-    print("::Archiving files.")
-    try:
-        path = clusterConfig['certificatesPath']
-        tarFilename = path + "/k8s-certs.tar.gz"
-        
-        filenames = []
-        with tarfile.open(tarFilename,"w:gz") as archive:
-            for root,dirs,files in os.walk(path):
-                for file in files:
-                
-                    archive.add(os.path.join(root,file),arcname=os.path.basename(file))
-        archive.close()
 
+def finishCerts(context):
+    # Drop certificates of removed hosts, save the manifest and build the bundles.
+    clusterConfig = context['clusterConfig']
+    manifest = context['manifest']
 
-    except Exception as err:
-        print(err)
-        sys.exit(1)
+    keep = ["ca"] + [component for component, genCert in CERT_COMPONENTS if genCert is not genNodeCerts]
+    keep += [worker['name'] for worker in clusterConfig['workers'][:clusterConfig['workersCount']]]
+    for name in manifest.prune(keep):
+        print("> removed certificate %s." % name)
+    manifest.save()
+
+    # with streaming delivery (kthw/deliver.py) the files go to the hosts without bundles
+    if context['delivery'] == "bundle":
+        archiveFiles(clusterConfig)
+
+    pool = context['keyPool']
+    if pool is not None:
+        for algo, size in sorted(set(pool.claimed) | set(pool.missed)):
+            print("> key pool %s-%s: %d keys used, %d generated inline, %d left." % (
+                algo, size, pool.claimed.get((algo, size), 0), pool.missed.get((algo, size), 0), pool.available(algo, size)))
+        for spec in pool.refillInBackground():
+            print("> key pool %s below %d keys, refilling in the background." % (spec, pool.low_water))
+
+
+def generateCerts(clusterConfig,backend="native",jobs=1,incremental=False,rotate_ca=False,renew_before="720h",key_pool=None,key_pool_low_water=DEFAULT_LOW_WATER,delivery="bundle",command_timeout=None):
+    # Stage [01]: issue every certificate and build the per-host bundles.
+    context = prepareCerts(clusterConfig, backend, jobs, incremental, rotate_ca, renew_before, key_pool, key_pool_low_water, delivery, command_timeout)
+
+    for component, genCert in CERT_COMPONENTS:
+        genComponentCert(context, component)
+
+    finishCerts(context)
 
 def main():
 
@@ -412,35 +442,71 @@ def main():
         "--config", type=str, help="Specify the path to the Kubernetes cluster config json file."
     )
 
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of worker certificates to issue in parallel (default: 1)."
+    )
+
+    parser.add_argument(
+        "--backend", type=str, choices=BACKENDS, default="native",
+        help="Certificate signing backend: in-process 'native' (needs the cryptography package) or 'cfssl' (default: native)."
+    )
+
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Keep the existing certificates and only re-issue those whose inputs changed or that are near expiry."
+    )
+
+    parser.add_argument(
+        "--rotate-ca", action="store_true", help="Issue a new CA (and with it every certificate) in incremental mode."
+    )
+
+    parser.add_argument(
+        "--renew-before", type=str, default="720h",
+        help="In incremental mode, re-issue certificates expiring within this duration (default: 720h)."
+    )
+
+    parser.add_argument(
+        "--key-pool", type=str, nargs="?", const=DEFAULT_POOL,
+        help="Take private keys from this pool of pre-generated keys (default pool: %s), see python -m kthw.keypool." % DEFAULT_POOL
+    )
+
+    parser.add_argument(
+        "--key-pool-low-water", type=int, default=DEFAULT_LOW_WATER,
+        help="Refill the key pool in the background when fewer keys are left (default: %d)." % DEFAULT_LOW_WATER
+    )
+
+    parser.add_argument(
+        "--delivery", type=str, choices=DELIVERY_MODES, default="bundle",
+        help="'bundle' writes a k8s-certs bundle per host for Ansible, 'stream' skips them for python -m kthw.deliver (default: bundle)."
+    )
+
+    parser.add_argument(
+        "--command-timeout", type=float,
+        help="Seconds before a cfssl / cfssl-json call is killed and retried (default: %d)." % CFSSL_TIMEOUT
+    )
+
     args = parser.parse_args()
 
     if (args.config is not None):
         if(os.path.exists(args.config)):
         
-            clusterConfig = extractConfig(args.config)
-            template_files = {
-                "ca_config": clusterConfig['templatesPath'] + "/ca-config.json",
-                "ca_csr": clusterConfig['templatesPath'] + "/ca-csr.json",
-                "admin_csr": clusterConfig['templatesPath'] + "/admin-csr.json",
-                "worker_csr": clusterConfig['templatesPath'] + "/worker-csr.json",
-                "kube_controller_manager_csr": clusterConfig['templatesPath'] + "/kube-controller-manager-csr.json",
-                "kube_proxy_csr": clusterConfig['templatesPath'] + "/kube-proxy-csr.json",
-                "kube_scheduler_csr": clusterConfig['templatesPath'] + "/kube-scheduler-csr.json",
-                "kubernetes_csr": clusterConfig['templatesPath'] + "/kubernetes-csr.json",
-                "service_account_csr": clusterConfig['templatesPath'] + "/service-account-csr.json",
-            }
-
-            checkCertsDir(clusterConfig,template_files)
-            genPemFiles(clusterConfig,template_files)
-            genAdminCert(clusterConfig,template_files)
-            genNodeCerts(clusterConfig,template_files)
-            genKubeControllerCert(clusterConfig,template_files)
-            genKubeProxyCert(clusterConfig,template_files)
-            genKubeScheduler(clusterConfig,template_files)
-            genApiServerCert(clusterConfig,template_files)
-            genServiceAccCert(clusterConfig,template_files)
-
-            archiveFiles(clusterConfig)
+            try:
+                clusterConfig = loadConfig(args.config, save=True)
+            except ConfigError as err:
+                print("ERROR > %s" % err)
+                sys.exit(1)
+            generateCerts(
+                clusterConfig,
+                backend=args.backend,
+                jobs=args.jobs,
+                incremental=args.incremental,
+                rotate_ca=args.rotate_ca,
+                renew_before=args.renew_before,
+                key_pool=args.key_pool,
+                key_pool_low_water=args.key_pool_low_water,
+                delivery=args.delivery,
+                command_timeout=args.command_timeout,
+            )
         else:
             print("ERROR > Failed to locate config file.")
             sys.exit(1)
@@ -3,468 +3,254 @@
 # 05
 
 import os
-import subprocess
 import sys
 import argparse
 import shutil
-import json
-import tarfile
-import glob
+import threading
+
+from kthw.kubeconfig import BACKENDS, KUBECTL_TIMEOUT, KubeconfigError, getWriter
+from kthw.config import ConfigError, loadConfig
+from kthw.archive import buildHostBundles, bundlePath, hostBundles
+from kthw.deliver import DELIVERY_MODES
+from kthw.manifest import KubeconfigManifest
+from kthw.trace import span, traced
+
+CLUSTER_NAME = "kubernetes-the-hard-way"
+
+
+def genKubeconfig(configData, writer, directory, name, server, user, cert_name, manifest=None):
+    # Write <directory>/<name>.kubeconfig for user, authenticated with <cert_name>.pem/<cert_name>-key.pem.
+    # With a manifest in incremental mode an existing file whose inputs did not change is kept.
+    # Returns an error message or None, so failures can be collected per file.
+    path = "%s/%s.kubeconfig" % (directory, name)
+    files = (
+        "%s/ca.pem" % configData['certificatesPath'],
+        "%s/%s.pem" % (configData['certificatesPath'], cert_name),
+        "%s/%s-key.pem" % (configData['certificatesPath'], cert_name),
+    )
 
+    if manifest is not None:
+        try:
+            inputs = manifest.inputs(CLUSTER_NAME, server, user, *files)
+        except OSError as err:
+            return str(err)
+        if manifest.isCurrent(name, inputs):
+            print("%s kubeconfig file unchanged." % name)
+            return None
 
-def genWorkerConfig(configData):
-    print(":: Generating kubeconfig file for each worker.")
+    # clean old file if present
+    if os.path.exists(path):
+        os.remove(path)
 
-    for worker in range(1,  configData['workersCount'] + 1):
-        # clean old files if present
-
-        if os.path.exists("%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name'])):
-            os.remove("%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name']))
-
-        p1_kubeconfig = subprocess.check_output(
-            [
-                "kubectl",
-                "config",
-                "set-cluster",
-                "kubernetes-the-hard-way",
-                "--certificate-authority=%s/ca.pem" % configData['certificatesPath'],
-                "--embed-certs=true",
-                #"--server=https://%s:6443" % (configData["workers"][worker -1]['externalIP']),
-                "--server=https://%s:6443" % configData['staticExternalIP'],
-                "--kubeconfig=%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name']),
-            ]
-        )
+    try:
+        with span("genKubeconfig", kubeconfig=name):
+            writer(path, CLUSTER_NAME, server, files[0], user, files[1], files[2])
+    except KubeconfigError as err:
+        return str(err)
 
-        if 'Cluster "kubernetes-the-hard-way" set.' in str(p1_kubeconfig):
-            if os.path.exists("%s/worker-%s.kubeconfig" % (configData['k8sConfPath'], str(worker))):
-                print("worker-%s kubeconfig file generated." % str(worker))
-        else:
-            sys.exit(1)
+    if not os.path.exists(path):
+        return "%s was not created." % path
 
-        p2_kubeconfig = subprocess.check_output(
-            [
-                "kubectl",
-                "config",
-                "set-credentials",
-                "system:node:%s" % configData["workers"][worker -1]['name'],
-                "--client-certificate=%s/%s.pem" % (configData['certificatesPath'], configData["workers"][worker -1]['name']),
-                "--client-key=%s/%s-key.pem" % (configData['certificatesPath'], configData["workers"][worker -1]['name']),
-                "--embed-certs=true",
-                "--kubeconfig=%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name']),
-            ]
-        )
+    if manifest is not None:
+        manifest.record(name, inputs)
 
-        if 'User "system:node:%s" set.' % configData["workers"][worker -1]['name'] in str(p2_kubeconfig):
-            print("%s system node set." % configData["workers"][worker -1]['name'])
-
-        p3_kubeconfig = subprocess.check_output(
-            [
-                "kubectl",
-                "config",
-                "set-context",
-                "default",
-                "--cluster=kubernetes-the-hard-way",
-                "--user=system:node:%s" % configData["workers"][worker -1]['name'],
-                "--kubeconfig=%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name']),
-            ]
-        )
+    print('%s kubeconfig file generated, switched to context "default".' % name)
+    return None
 
-        if 'Context "default" created.' or 'Context "default" modified.' in str(
-            p3_kubeconfig
-        ):
-            print("%s context default created." % configData["workers"][worker -1]['name'])
-        else:
-            print(str(p3_kubeconfig.strip()))
-            sys.exit(1)
 
-        p4_kubeconfig = subprocess.check_output(
-            [
-                "kubectl",
-                "config",
-                "use-context",
-                "default",
-                "--kubeconfig=%s/%s.kubeconfig" % (configData['k8sConfPath'], configData["workers"][worker -1]['name']),
-            ]
-        )
+# Each gen*Config function returns the kubeconfig files it needs as
+# (name, server, user, certificate name) tuples for buildKubeconfigs.
 
-        if 'Switched to context "default".' in str(p4_kubeconfig):
-            print('%s switched to context "default".' % configData["workers"][worker -1]['name'])
-        else:
-            print(str(p4_kubeconfig.strip()))
-            sys.exit(1)
+@traced
+def genWorkerConfig(configData):
+    print(":: Generating kubeconfig file for each worker.")
+
+    return [
+        (
+            worker['name'],
+            "https://%s:6443" % configData['staticExternalIP'],
+            "system:node:%s" % worker['name'],
+            worker['name'],
+        )
+        for worker in configData["workers"][:configData['workersCount']]
+    ]
 
 
+@traced
 def genKubeProxyConfig(configData):
     print(":: Generating kubeconfig file for kube-proxy service.")
 
-    # Clean old file
-
-    if os.path.exists("%s/kube-proxy.kubeconfig" % configData['k8sConfPath']):
-        os.remove("%s/kube-proxy.kubeconfig" % configData['k8sConfPath'])
-
-    p5_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-cluster",
-            "kubernetes-the-hard-way",
-            "--certificate-authority=%s/ca.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--server=https://%s:6443" % configData['staticExternalIP'],
-            "--kubeconfig=%s/kube-proxy.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
-    if 'Cluster "kubernetes-the-hard-way" set.' in str(
-        p5_kubeconfig
-    ) and os.path.exists("%s/kube-proxy.kubeconfig" % configData['k8sConfPath']):
-        print('Cluster "kubernetes-the-hard-way" set.')
-    else:
-        print(str(p5_kubeconfig))
-        sys.exit(1)
-
-    p6_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-credentials",
-            "system:kube-proxy",
-            "--client-certificate=%s/kube-proxy.pem" % configData['certificatesPath'],
-            "--client-key=%s/kube-proxy-key.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--kubeconfig=%s/kube-proxy.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
-    if 'User "system:kube-proxy" set.' in str(p6_kubeconfig):
-        print('User "system:kube-proxy" set.')
-    else:
-        print(str(p6_kubeconfig))
-        sys.exit(1)
-
-    p7_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-context",
-            "default",
-            "--cluster=kubernetes-the-hard-way",
-            "--user=system:kube-proxy",
-            "--kubeconfig=%s/kube-proxy.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
-
-    if 'Context "default" created.' in str(p7_kubeconfig):
-        print('Context "default" created.')
-    else:
-        print(str(p7_kubeconfig))
-        sys.exit(1)
-
-    p8_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "use-context",
-            "default",
-            "--kubeconfig=%s/kube-proxy.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
-
-    if 'Switched to context "default".' in str(p8_kubeconfig):
-        print('kube-proxy switched to context "default".')
-    else:
-        print(str(p8_kubeconfig.strip()))
-        sys.exit(1)
+    return [("kube-proxy", "https://%s:6443" % configData['staticExternalIP'], "system:kube-proxy", "kube-proxy")]
 
 
+@traced
 def genControllerMgrConfig(configData):
     print(":: Generating kubeconfig file for kube-controller-manager service.")
 
-    # Clean old file
-
-    if os.path.exists("%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath']):
-        os.remove("%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath'])
-
-    p9_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-cluster",
-            "kubernetes-the-hard-way",
-            "--certificate-authority=%s/ca.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--server=https://127.0.0.1:6443",
-            "--kubeconfig=%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    return [("kube-controller-manager", "https://127.0.0.1:6443", "system:kube-controller-manager", "kube-controller-manager")]
 
-    if 'Cluster "kubernetes-the-hard-way" set.' in str(p9_kubeconfig):
-        print('Cluster "kubernetes-the-hard-way" set')
-    else:
-        print(str(p9_kubeconfig))
-        sys.exit(1)
 
-    p10_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-credentials",
-            "system:kube-controller-manager",
-            "--client-certificate=%s/kube-controller-manager.pem" % configData['certificatesPath'],
-            "--client-key=%s/kube-controller-manager-key.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--kubeconfig=%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+@traced
+def genKubeSchedConfig(configData):
+    print(":: Generating kubeconfig file for kube-scheduler service.")
 
-    if 'User "system:kube-controller-manager" set.' in str(p10_kubeconfig):
-        print('User "system:kube-controller-manager" set.')
-    else:
-        print(str(p10_kubeconfig))
-        sys.exit(1)
+    return [("kube-scheduler", "https://127.0.0.1:6443", "system:kube-scheduler", "kube-scheduler")]
 
-    p11_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-context",
-            "default",
-            "--cluster=kubernetes-the-hard-way",
-            "--user=system:kube-controller-manager",
-            "--kubeconfig=%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
 
-    if 'Context "default" created.' in str(p11_kubeconfig):
-        print('Context "default" created.')
-    else:
-        print(str(p11_kubeconfig))
-        sys.exit(1)
-
-    p12_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "use-context",
-            "default",
-            "--kubeconfig=%s/kube-controller-manager.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+@traced
+def genAdminConfig(configData):
+    print(":: Generating kubeconfig file for Admin user.")
 
-    if 'Switched to context "default".' in str(p12_kubeconfig):
-        print('kube-controller-manager switched to context "default".')
-    else:
-        print(str(p12_kubeconfig.strip()))
-        sys.exit(1)
+    return [("admin", "https://127.0.0.1:6443", "admin", "admin")]
 
 
-def genKubeSchedConfig(configData):
-    print(":: Generating kubeconfig file for kube-scheduler service.")
+def buildKubeconfigs(configData, writer, directory, kubeconfigs, jobs=1, manifest=None):
+    # The kubeconfig files don't depend on each other, with jobs > 1 they are written concurrently.
+    # Returns a list of (name, error) for every file that failed.
+    import concurrent.futures
 
-    # Clean old file
-
-    if os.path.exists("%s/kube-scheduler.kubeconfig" % configData['k8sConfPath']):
-        os.remove("%s/kube-scheduler.kubeconfig" % configData['k8sConfPath'])
-
-    p13_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-cluster",
-            "kubernetes-the-hard-way",
-            "--certificate-authority=%s/ca.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--server=https://127.0.0.1:6443",
-            "--kubeconfig=%s/kube-scheduler.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    failed = []
 
-    if 'Cluster "kubernetes-the-hard-way" set.' in str(p13_kubeconfig):
-        print('Cluster "kubernetes-the-hard-way" set')
-    else:
-        print(str(p13_kubeconfig))
-        sys.exit(1)
+    if jobs <= 1:
+        for name, server, user, cert_name in kubeconfigs:
+            error = genKubeconfig(configData, writer, directory, name, server, user, cert_name, manifest)
+            if error is not None:
+                failed.append((name, error))
+        return failed
 
-    p14_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-credentials",
-            "system:kube-scheduler",
-            "--client-certificate=%s/kube-scheduler.pem" % configData['certificatesPath'],
-            "--client-key=%s/kube-scheduler-key.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--kubeconfig=%s/kube-scheduler.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(genKubeconfig, configData, writer, directory, name, server, user, cert_name, manifest): name
+            for name, server, user, cert_name in kubeconfigs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                error = future.result()
+            except Exception as err:
+                error = str(err)
 
-    if 'User "system:kube-scheduler" set.' in str(p14_kubeconfig):
-        print('User "system:kube-scheduler" set.')
-    else:
-        print(str(p14_kubeconfig))
-        sys.exit(1)
+            if error is not None:
+                failed.append((futures[future], error))
 
-    p15_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-context",
-            "default",
-            "--cluster=kubernetes-the-hard-way",
-            "--user=system:kube-scheduler",
-            "--kubeconfig=%s/kube-scheduler.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    return failed
 
-    if 'Context "default" created.' in str(p15_kubeconfig):
-        print('Context "default" created.')
-    else:
-        print(str(p15_kubeconfig))
-        sys.exit(1)
+@traced
+def archiveFiles(clusterConfig):
+    # One bundle per host with only the files that host needs.
+    print("::Archiving files.")
+    try:
+        path = clusterConfig['k8sConfPath']
 
-    p16_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "use-context",
-            "default",
-            "--kubeconfig=%s/kube-scheduler.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+        changed = buildHostBundles(path, "k8s-kubeconfig", hostBundles(clusterConfig, "kubeconfig"))
+        for host in changed:
+            if changed[host]:
+                print("%s written." % bundlePath(path, "k8s-kubeconfig", host))
+            else:
+                print("%s unchanged." % bundlePath(path, "k8s-kubeconfig", host))
 
-    if 'Switched to context "default".' in str(p16_kubeconfig):
-        print('kube-scheduler switched to context "default".')
-    else:
-        print(str(p16_kubeconfig.strip()))
+    except Exception as err:
+        print(err)
         sys.exit(1)
 
+# (component, gen function) for every kubeconfig file, see generateKubeconfigs
+KUBECONFIG_COMPONENTS = [
+    ("workers", genWorkerConfig),
+    ("kube-proxy", genKubeProxyConfig),
+    ("kube-controller-manager", genControllerMgrConfig),
+    ("kube-scheduler", genKubeSchedConfig),
+    ("admin", genAdminConfig),
+]
+
+
+def prepareKubeconfigs(clusterConfig, backend="native", jobs=1, delivery="bundle", incremental=False, command_timeout=None):
+    # Everything is built in a staging directory first, so a failure
+    # never leaves a half-written k8sConfPath behind, and renamed into
+    # k8sConfPath: a reader sees the old file or the new one, never a partial one.
+    # In incremental mode only the files whose inputs changed are staged.
+    # Returns the context genComponentKubeconfigs and finishKubeconfigs work on.
+    staging = clusterConfig['k8sConfPath'].rstrip("/") + ".staging"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.mkdir(staging)
+
+    manifest = KubeconfigManifest(clusterConfig['k8sConfPath'], incremental, backend)
+    manifest.load()
+
+    return {
+        "clusterConfig": clusterConfig,
+        "writer": getWriter(backend, command_timeout),
+        "staging": staging,
+        "manifest": manifest,
+        "jobs": jobs,
+        "kubeconfigs": [],
+        "failed": [],
+        "lock": threading.Lock(),
+        "delivery": delivery,
+    }
+
+
+def genComponentKubeconfigs(context, component):
+    kubeconfigs = dict(KUBECONFIG_COMPONENTS)[component](context['clusterConfig'])
+    failed = buildKubeconfigs(context['clusterConfig'], context['writer'], context['staging'], kubeconfigs, context['jobs'], context['manifest'])
+
+    with context['lock']:
+        context['kubeconfigs'] += kubeconfigs
+        context['failed'] += failed
+
+
+def finishKubeconfigs(context):
+    # Move the staged files into k8sConfPath once every file succeeded.
+    clusterConfig = context['clusterConfig']
+    staging = context['staging']
+    failed = context['failed']
+
+    if len(failed) > 0:
+        for name, error in sorted(failed):
+            print("ERROR > %s kubeconfig failed: %s" % (name, error))
+        cleanupKubeconfigs(context)
+        print("ERROR > %d of %d kubeconfig files failed, %s left unchanged." % (len(failed), len(context['kubeconfigs']), clusterConfig['k8sConfPath']))
+        sys.exit(1)
 
-def genAdminConfig(configData):
-    print(":: Generating kubeconfig file for Admin user.")
+    os.makedirs(clusterConfig['k8sConfPath'], exist_ok=True)
 
-    # Clean old file
-
-    if os.path.exists("%s/admin.kubeconfig" % configData['k8sConfPath']):
-        os.remove("%s/admin.kubeconfig" % configData['k8sConfPath'])
-
-    p17_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-cluster",
-            "kubernetes-the-hard-way",
-            "--certificate-authority=%s/ca.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--server=https://127.0.0.1:6443",
-            "--kubeconfig=%s/admin.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    # only *.kubeconfig files are replaced, other files in k8sConfPath
+    # (encryption-config.yaml) are left alone
+    names = [name for name, server, user, cert_name in context['kubeconfigs']]
+    for name in os.listdir(clusterConfig['k8sConfPath']):
+        if name.endswith(".kubeconfig") and name[:-len(".kubeconfig")] not in names:
+            print('removing %s..' % name)
+            os.remove(os.path.join(clusterConfig['k8sConfPath'], name))
 
-    if 'Cluster "kubernetes-the-hard-way" set.' in str(p17_kubeconfig):
-        print('Cluster "kubernetes-the-hard-way" set')
-    else:
-        print(str(p17_kubeconfig))
-        sys.exit(1)
+    for name in sorted(os.listdir(staging)):
+        os.replace(os.path.join(staging, name), os.path.join(clusterConfig['k8sConfPath'], name))
+    os.rmdir(staging)
 
-    p18_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-credentials",
-            "admin",
-            "--client-certificate=%s/admin.pem" % configData['certificatesPath'],
-            "--client-key=%s/admin-key.pem" % configData['certificatesPath'],
-            "--embed-certs=true",
-            "--kubeconfig=%s/admin.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
+    context['manifest'].prune(names)
+    context['manifest'].save()
 
-    if 'User "admin" set.' in str(p18_kubeconfig):
-        print('User "admin" set.')
-    else:
-        print(str(p18_kubeconfig))
-        sys.exit(1)
+    # with streaming delivery (kthw/deliver.py) the files go to the hosts without bundles
+    if context['delivery'] == "bundle":
+        archiveFiles(clusterConfig)
 
-    p19_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "set-context",
-            "default",
-            "--cluster=kubernetes-the-hard-way",
-            "--user=admin",
-            "--kubeconfig=%s/admin.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
 
-    if 'Context "default" created.' in str(p19_kubeconfig):
-        print('Context "default" created.')
-    else:
-        print(str(p19_kubeconfig))
-        sys.exit(1)
+def cleanupKubeconfigs(context):
+    # Drop the staging directory of a run that did not get to finishKubeconfigs (or failed in it),
+    # the next run must not pick up its files.
+    if os.path.exists(context['staging']):
+        shutil.rmtree(context['staging'])
 
-    p20_kubeconfig = subprocess.check_output(
-        [
-            "kubectl",
-            "config",
-            "use-context",
-            "default",
-            "--kubeconfig=%s/admin.kubeconfig" % configData['k8sConfPath'],
-        ]
-    )
 
-    if 'Switched to context "default".' in str(p20_kubeconfig):
-        print('admin switched to context "default".')
-    else:
-        print(str(p20_kubeconfig.strip()))
-        sys.exit(1)
+def generateKubeconfigs(clusterConfig, backend="native", jobs=1, delivery="bundle", incremental=False, command_timeout=None):
+    # Stage [02]: write every kubeconfig file and build the per-host bundles.
+    context = prepareKubeconfigs(clusterConfig, backend, jobs, delivery, incremental, command_timeout)
 
-def extractConfig(configFile):
     try:
-        # read json file
-        configData = json.load(open(configFile))
-
-        if(len(configData) > 0):
-            workersCount = configData[0]['workersCount']
-            controllersCount = configData[0]['controllersCount']
-
-            staticExternalIP = configData[0]['staticExternalIP']
-
-            controllers = configData[0]['controllers']
-            workers = configData[0]['workers']
-            certificatesPath = configData[0]['certificatesPath']
-            k8sConfPath = configData[0]['k8sConfPath']
-
-
-            return {
-                "workersCount" : workersCount,
-                "controllersCount": controllersCount,
-                "workers" : workers,
-                "controllers": controllers,
-                "staticExternalIP": staticExternalIP,
-                "certificatesPath" : certificatesPath,
-                "k8sConfPath" : k8sConfPath
-            }
-    except Exception as error:
-        print(error)
-        sys.exit(1)
+        for component, genConfig in KUBECONFIG_COMPONENTS:
+            genComponentKubeconfigs(context, component)
 
-def archiveFiles(clusterConfig):
-    print("::Archiving files.")
-    try:
-        path = clusterConfig['k8sConfPath']
-        tarFilename = path + "/k8s-kubeconfig.tar.gz"
-        
-        filenames = []
-        with tarfile.open(tarFilename,"w:gz") as archive:
-            for root,dirs,files in os.walk(path):
-                for file in files:
-                
-                    archive.add(os.path.join(root,file),arcname=os.path.basename(file))
-        archive.close()
-
-
-    except Exception as err:
-        print(err)
-        sys.exit(1)
+        finishKubeconfigs(context)
+    finally:
+        cleanupKubeconfigs(context)
 
 def main():
 
@@ -474,6 +260,30 @@ def main():
         "--config", type=str, help="Specify the path to the Kubernetes cluster config json file."
     )
 
+    parser.add_argument(
+        "--backend", type=str, choices=BACKENDS, default="native",
+        help="Kubeconfig writer: in-process 'native' or 'kubectl' config calls (default: native)."
+    )
+
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of kubeconfig files to generate in parallel (default: 1)."
+    )
+
+    parser.add_argument(
+        "--delivery", type=str, choices=DELIVERY_MODES, default="bundle",
+        help="'bundle' writes a k8s-kubeconfig bundle per host for Ansible, 'stream' skips them for python -m kthw.deliver (default: bundle)."
+    )
+
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Only rewrite kubeconfig files whose inputs (server, user, CA, client certificate and key) changed."
+    )
+
+    parser.add_argument(
+        "--command-timeout", type=float,
+        help="Seconds before a kubectl call is killed and retried (default: %d)." % KUBECTL_TIMEOUT
+    )
+
     args = parser.parse_args()
 
     if args.config is not None:
@@ -482,35 +292,16 @@ def main():
             sys.exit(1)
         else:
             if os.path.exists(args.config):
-                clusterConfig = extractConfig(args.config)
+                try:
+                    clusterConfig = loadConfig(args.config, save=True)
+                except ConfigError as err:
+                    print("ERROR > %s" % err)
+                    sys.exit(1)
             else:
                 print("ERROR > Failed to locate config file.")
                 sys.exit(1)
 
-            if not os.path.exists(clusterConfig['k8sConfPath']):
-                os.mkdir(clusterConfig['k8sConfPath'])
-            else:
-                print('removing..')
-                shutil.rmtree(clusterConfig['k8sConfPath'])
-                os.mkdir(clusterConfig['k8sConfPath'])
-
-            '''
-            if os.path.exists(clusterConfig['k8sConfPath']):
-                pattern = r"%s/**.kubeconfig" % clusterConfig['k8sConfPath']
-
-                for item in glob.iglob(pattern,recursive=True):
-                    os.remove(item)
-            #os.mkdir(configData['k8sConfPath'])
-
-            '''
-
-            genWorkerConfig(clusterConfig)
-            genKubeProxyConfig(clusterConfig)
-            genControllerMgrConfig(clusterConfig)
-            genKubeSchedConfig(clusterConfig)
-            genAdminConfig(clusterConfig)
-
-            archiveFiles(clusterConfig)
+            generateKubeconfigs(clusterConfig, backend=args.backend, jobs=args.jobs, delivery=args.delivery, incremental=args.incremental, command_timeout=args.command_timeout)
             
     else:
         parser.print_help()
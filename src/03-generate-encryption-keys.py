@@ -2,83 +2,93 @@
 
 # 03
 
-import random
-import string
-import base64
 import os
 import argparse
 import sys
-import json
 
+from kthw.config import ConfigError, loadConfig
+from kthw.trace import traced
+from kthw.encryption import (
+    ROTATIONS,
+    EncryptionError,
+    currentProvider,
+    describe,
+    loadEncryptionConfig,
+    prune,
+    renderInitial,
+    rotate,
+    writeEncryptionConfig,
+)
+
+
+@traced
+def generateEncKeys(clusterConfig, rotation=None, pruneKeys=False):
+    # An existing encryption-config.yaml is kept as it is unless a rotation is asked for:
+    # replacing it would leave the secrets already encrypted with it unreadable.
+    print(":: Generating Data Encryption Config and Key.")
 
-print(":: Generating Data Encryption Config and Key.")
-
-def generateEncKeys(clusterConfig):
-
-    # clean existing file
     outfile = clusterConfig['k8sConfPath'] + "/encryption-config.yaml"
     template_file = clusterConfig['templatesPath'] + "/encryption-config.yaml"
+    provider = clusterConfig['encryptionProvider']
 
-    if os.path.exists(outfile):
-        os.remove(outfile)
-
-    randstr = "".join(
-        random.SystemRandom().choice(string.ascii_letters + string.digits)
-        for _ in range(32)
-    )
-    base64_bytes = base64.b64encode(randstr.encode("ascii"))
-    base4_msg = base64_bytes.decode("ascii")
-
-    encrypt_config = string.Template(open(template_file).read())
-    encrypt_config_subst = {"secret": base4_msg}
-    encrypt_config_data = encrypt_config.substitute(encrypt_config_subst)
-
-    if(encrypt_config_data is not None and len(encrypt_config_data) > 0):
-        print("> Data encrypted, saving to file.")
+    version = clusterConfig['ansibleSettings']['kubernetesVersion'].lstrip("v").split(".")
+    if provider == "kms" and [int(part) for part in version[:2] if part.isdigit()] < [1, 27]:
+        print("WARNING > KMS v2 needs Kubernetes 1.27 or later, kubernetesVersion is %s." % clusterConfig['ansibleSettings']['kubernetesVersion'])
 
-    with open(outfile, "w") as f:
-        f.writelines(encrypt_config_data)
+    # may run before 02-generate-kubeconfig.py created the directory
+    os.makedirs(clusterConfig['k8sConfPath'], exist_ok=True)
 
-    if os.path.exists(outfile):
-        print("File %s created." % os.path.abspath(outfile))
-    else:
-        print("Something went wrong generating Encryption config.")
-        sys.exit(1)
-
-def extractConfig(configFile):
     try:
-        # read json file
-        configData = json.load(open(configFile))
-
-        if(len(configData) > 0):
-           
-            certificatesPath = configData[0]['certificatesPath']
-            k8sConfPath = configData[0]['k8sConfPath']
-            templatesPath = configData[0]['templatesPath']
-
-          
-            return {
-                "certificatesPath" : certificatesPath,
-                "k8sConfPath" : k8sConfPath,
-                "templatesPath" : templatesPath
-            }
-    except Exception as error:
-        print(error)
+        if not os.path.exists(outfile):
+            data = renderInitial(template_file, provider)
+            print("> New %s key." % provider)
+        else:
+            data = loadEncryptionConfig(outfile)
+            if rotation is None and not pruneKeys:
+                if currentProvider(data) != provider:
+                    print("WARNING > %s encrypts with %s, not encryptionProvider %s: run with --rotate to switch." % (
+                        outfile, currentProvider(data), provider))
+                print("File %s kept (%s)." % (os.path.abspath(outfile), describe(data)))
+                return
+            if rotation is not None:
+                data = rotate(data, provider, rotation)
+                print("> Rotated (%s) to a new %s key." % (rotation, provider) if rotation != "promote" else "> Staged key promoted.")
+            if pruneKeys:
+                data = prune(data)
+                print("> Old keys removed.")
+
+        writeEncryptionConfig(outfile, data)
+    except (OSError, EncryptionError) as err:
+        print("ERROR > %s" % err)
         sys.exit(1)
 
+    print("File %s created (%s)." % (os.path.abspath(outfile), describe(data)))
+
 def main():
     parser = argparse.ArgumentParser(description="KTHW [06] - Encryption Keys.")
     parser.add_argument(
         "--config", type=str, help="Specify the path to the Kubernetes cluster config json file."
     )
+    parser.add_argument(
+        "--rotate", type=str, nargs="?", const="prepend", choices=ROTATIONS,
+        help="Add a new encryptionProvider key and keep the old ones for reading: 'prepend' (default) encrypts with it right away, "
+             "'stage' adds it for reading only and 'promote' then makes it the encrypting key."
+    )
+    parser.add_argument(
+        "--prune", action="store_true", help="Remove every key but the encrypting one (after all secrets were rewritten)."
+    )
 
     args = parser.parse_args()
 
     if (args.config is not None):
         if(os.path.exists(args.config)):
         
-            clusterConfig = extractConfig(args.config)
-            generateEncKeys(clusterConfig)
+            try:
+                clusterConfig = loadConfig(args.config, save=True)
+            except ConfigError as err:
+                print("ERROR > %s" % err)
+                sys.exit(1)
+            generateEncKeys(clusterConfig, args.rotate, args.prune)
         else:
             print("ERROR > Failed to locate config file.")
             sys.exit(1)
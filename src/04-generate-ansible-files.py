@@ -2,87 +2,65 @@
 
 import sys
 import argparse
-import json
 import os
-from string import Template
-import yaml
+
+from kthw.config import ConfigError, loadConfig
+from kthw.trace import traced
+from kthw.deliver import DELIVERY_MODES
+from kthw.inventory import (
+    INVENTORY_MODES,
+    InventoryError,
+    playbookValues,
+    renderHostVars,
+    renderInventory,
+    renderInventoryScript,
+    renderPlaybook,
+    writeFile,
+    writeHostVars,
+)
 
 ANSIBLE_PLAYBOOK_TEMPLATE="ansible-playbook.yml"
 
 # Generate Ansible inventory file and playbook dynamically from json conf file.
+# The inventory, host_vars and playbook are rendered in memory first and each file is written
+# once, unchanged files are left alone (see kthw/inventory.py).
 
-def generateAnsibleFiles(configFile):
+@traced
+def generateAnsibleFiles(configData, delivery="bundle", inventory="static", configFile=None):
+    # configData is the cluster entry of the json conf file, configFile its path (script inventory)
     print(":: Generating ansible-inventory.")
-    try:
-        # read json file
-        configData = json.load(open(configFile))
-
-        if(len(configData) > 0):
-            controllers = configData[0]['controllers']
-            workers = configData[0]['workers']
-            ansibleInventory = configData[0]['ansibleInventory']
-            ansiblePlaybook = configData[0]['ansiblePlaybook']
-            staticExternalAddress = configData[0]['staticExternalIP']
-
-            ansibleSettings = configData[0]['ansibleSettings']
-            templatesPath = configData[0]['templatesPath']
-
-            with open(ansibleInventory,"w") as f:
-                f.writelines("---\n")
-                f.writelines("controllers:\n")
-                f.writelines("  hosts:\n")
-                for controller in controllers:
-                    f.writelines("        %s:\n" % controller['name'])
-                    f.writelines("            ansible_host: %s\n" % controller['externalIP'])
-                    f.writelines("            ansible_ssh_user: %s\n" % controller['sshUser'])
-                f.writelines("workers:\n")
-                f.writelines("  hosts:\n")
-                for worker in workers:
-                    f.writelines("        %s:\n" % worker['name'])
-                    f.writelines("            ansible_host: %s\n" % worker['externalIP'])
-                    f.writelines("            ansible_ssh_user: %s\n" % worker['sshUser'])
-
-            if(os.path.exists(ansibleInventory)):
-                print("ansible-inventory created in %s" % ansibleInventory)
-            else:
-                print("Failed to create ansible-inventory file.")
-                sys.exit(1)
-
-            playbookTemplate = templatesPath + "/%s" % ANSIBLE_PLAYBOOK_TEMPLATE 
-
-            if(os.path.exists(playbookTemplate)):
-                print("template found.")
-
-                playbook = Template(open(playbookTemplate).read())
+    ansibleInventory = configData['ansibleInventory']
+    ansiblePlaybook = configData['ansiblePlaybook']
+    hostVarsPath = os.path.join(os.path.dirname(os.path.abspath(ansibleInventory)), "host_vars")
+    playbookTemplate = os.path.join(configData['templatesPath'], ANSIBLE_PLAYBOOK_TEMPLATE)
 
-                etcdServers=""
-                for etcdServer in ansibleSettings['etcdServers']:
-                    etcdServers += "\n      - %s: %s" % (etcdServer, ansibleSettings['etcdServers'][etcdServer])
-
-                workerPodCIDR=""
-                for podCIDR in ansibleSettings['podCIDR']:
-                    workerPodCIDR += "\n      - %s: %s" % (podCIDR,ansibleSettings['podCIDR'][podCIDR])
-
-
-                values = { 
-                    "etcd_servers": etcdServers.strip(),
-                    "pod_cidr": workerPodCIDR.strip(),
-                    "kubernetes_version" : ansibleSettings['kubernetesVersion'],
-                    "kubernetes_public_address": staticExternalAddress,
-                    "kube_apiserver_count": ansibleSettings['kubeAPIServerCount'],
-                    "cluster_dns": ansibleSettings['clusterDNS'],
-                    "cluster_cidr" : ansibleSettings['cluster_cidr']
-                }
-                                
-                
+    if inventory == "script" and configFile is None:
+        print("ERROR > a script inventory needs the path of the config file.")
+        sys.exit(1)
 
-                with open(ansiblePlaybook,"w") as f:
-                    f.writelines(yaml.safe_load(yaml.dump(playbook.substitute(values))))
+    if not os.path.exists(playbookTemplate):
+        print("ERROR > %s not found." % playbookTemplate)
+        sys.exit(1)
 
-    except Exception as err:
-        print("error: %s" % err)
+    try:
+        playbook = renderPlaybook(playbookTemplate, playbookValues(configData, delivery))
+        if inventory == "script":
+            # the script hands Ansible the host vars itself
+            writeFile(ansibleInventory, renderInventoryScript(configFile), 0o755)
+            writeHostVars(hostVarsPath, {})
+        else:
+            writeFile(ansibleInventory, renderInventory(configData))
+            writeHostVars(hostVarsPath, renderHostVars(configData))
+        writeFile(ansiblePlaybook, playbook)
+    except (OSError, InventoryError) as err:
+        print("ERROR > %s" % err)
         sys.exit(1)
 
+    print("ansible-inventory (%s) created in %s" % (inventory, ansibleInventory))
+    if inventory == "static":
+        print("host_vars created in %s" % hostVarsPath)
+    print("playbook created in %s" % ansiblePlaybook)
+
 def main():
 
     parser = argparse.ArgumentParser(description="KTHW [04] - Generate Ansible files.")
@@ -91,11 +69,26 @@ def main():
         "--config", type=str, help="Specify the path to the Kubernetes cluster config json file."
     )
 
+    parser.add_argument(
+        "--delivery", type=str, choices=DELIVERY_MODES, default="bundle",
+        help="'stream' if the files are streamed to the hosts with python -m kthw.deliver, the playbook then skips copying them (default: bundle)."
+    )
+
+    parser.add_argument(
+        "--inventory", type=str, choices=INVENTORY_MODES, default="static",
+        help="'static': YAML inventory with host_vars/, 'script': executable inventory reading the config file (default: static)."
+    )
+
     args = parser.parse_args()
 
     if (args.config is not None):
         if(os.path.exists(args.config)):
-            generateAnsibleFiles(args.config)
+            try:
+                configData = loadConfig(args.config, save=True)
+            except ConfigError as err:
+                print("ERROR > %s" % err)
+                sys.exit(1)
+            generateAnsibleFiles(configData, args.delivery, args.inventory, args.config)
         else:
             print("ERROR > Failed to locate config file.")
             sys.exit(1)
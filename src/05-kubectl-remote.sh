@@ -5,9 +5,10 @@ CONF="$1"
 
 echo "::Setting kubectl remote access."
 if [ -f "$CONF" ]; then
-    KUBERNETES_PUBLIC_ADDRESS=$(cat $CONF | python -c 'import json,sys;obj=json.load(sys.stdin);print(obj[0]["staticExternalIP"])')
-    KUBERNETES_CLUSTER_NAME=$(cat $CONF | python -c 'import json,sys;obj=json.load(sys.stdin);print(obj[0]["clusterName"])')
-    KUBERNETES_CERTS=$(cat $CONF | python -c 'import json,sys;obj=json.load(sys.stdin);print(obj[0]["certificatesPath"])')
+    # one validated read of the config for all fields, one value per line
+    FIELDS=$(PYTHONPATH="$(dirname "$0")${PYTHONPATH:+:$PYTHONPATH}" python -m kthw.config --config "$CONF" \
+        --print-field staticExternalIP --print-field clusterName --print-field certificatesPath)
+    { read -r KUBERNETES_PUBLIC_ADDRESS; read -r KUBERNETES_CLUSTER_NAME; read -r KUBERNETES_CERTS; } <<< "$FIELDS"
 else
     echo "ERROR > Failed to locate Kubernetes cluster json file."
     echo "Script usage: $0 [path to cluster.json file]"
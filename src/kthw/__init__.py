@@ -0,0 +1 @@
+# Shared helpers for the KTHW generator scripts (src/0N-*.py).
@@ -0,0 +1,5 @@
+import sys
+
+from kthw.pipeline import main
+
+sys.exit(main())
@@ -0,0 +1,201 @@
+# Pod CIDR and internal IP allocation for the hosts of cluster.json.
+#
+# Workers without an entry in ansibleSettings.podCIDR keep the /24 of clusterCIDR of the state
+# file; new ones get the /24 numbered like them, the Nth worker 10.200.N.0/24 as the terraform
+# routes expect, or the next free one when that is taken. Hosts with an empty internalIP get the next free address of nodeCIDR (when
+# set), and etcdServers defaults to the controllers. Every address block is one bit of a bitmap, so
+# allocating for N hosts is a single pass over the hosts plus at most one over the bitmap.
+#
+# Assignments are kept in a state file next to the config so they stay the same across runs;
+# hosts removed from the config are dropped from it, which frees their blocks again. Only the
+# generation stages save it (loadConfig(..., save=True)), reading the config never writes.
+
+import os
+import json
+import ipaddress
+
+POD_CIDR_PREFIX = 24
+
+
+class AllocationError(Exception):
+    pass
+
+
+class Bitmap:
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.cursor = 0
+
+    def isSet(self, index):
+        return self.bits[index >> 3] & (1 << (index & 7)) != 0
+
+    def set(self, index):
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def nextFree(self):
+        # the cursor only moves forward, full bytes are skipped at once
+        index = self.cursor
+        while index < self.size:
+            if self.bits[index >> 3] == 0xFF:
+                index = (index | 7) + 1
+                continue
+            if not self.isSet(index):
+                self.cursor = index + 1
+                return index
+            index += 1
+
+        self.cursor = self.size
+        return None
+
+
+class AddressPool:
+    # Blocks of `prefix` bits inside `network`, e.g. the /24s of 10.200.0.0/16 or the /32s of 10.240.0.0/24.
+
+    def __init__(self, network, prefix, name):
+        try:
+            self.network = ipaddress.ip_network(network)
+        except ValueError as err:
+            raise AllocationError("%s: %s" % (name, err))
+
+        if prefix < self.network.prefixlen:
+            raise AllocationError("%s %s is smaller than a /%d" % (name, network, prefix))
+
+        self.name = name
+        self.prefix = prefix
+        self.shift = self.network.max_prefixlen - prefix
+        self.bitmap = Bitmap(1 << (prefix - self.network.prefixlen))
+
+        # addresses of the subnet no host may get: network and broadcast address, the gateway (.1)
+        # and the one before the broadcast address, which GCP keeps for itself
+        self.reserved = set()
+        if prefix == self.network.max_prefixlen and self.bitmap.size > 4:
+            self.reserved = {0, 1, self.bitmap.size - 2, self.bitmap.size - 1}
+        elif prefix == self.network.max_prefixlen and self.bitmap.size > 2:
+            self.reserved = {0, self.bitmap.size - 1}
+        for index in self.reserved:
+            self.bitmap.set(index)
+
+    def index(self, value):
+        # bit of a block given as "a.b.c.d/p" or "a.b.c.d", None when it is not a block of this pool
+        try:
+            block = ipaddress.ip_network(value if "/" in value else "%s/%d" % (value, self.prefix))
+        except ValueError:
+            return None
+
+        if block.version != self.network.version or block.prefixlen != self.prefix or not block.subnet_of(self.network):
+            return None
+
+        return (int(block.network_address) - int(self.network.network_address)) >> self.shift
+
+    def value(self, index):
+        address = self.network.network_address + (index << self.shift)
+        return str(address) if self.shift == 0 else "%s/%d" % (address, self.prefix)
+
+    def take(self, value):
+        # reserve a given block, False when it is outside the pool or already taken
+        index = self.index(value)
+        if index is None or self.bitmap.isSet(index):
+            return False
+
+        self.bitmap.set(index)
+        return True
+
+    def allocate(self):
+        index = self.bitmap.nextFree()
+        if index is None:
+            raise AllocationError("%s %s has no free /%d left" % (self.name, self.network, self.prefix))
+
+        self.bitmap.set(index)
+        return self.value(index)
+
+
+def assign(pool, names, given, previous, preferred=None):
+    # {name: block}: blocks from the config first, then the previous assignments, the preferred
+    # blocks of hosts without one and new ones
+    assigned = {}
+    for name in names:
+        if name in given:
+            index = pool.index(given[name])
+            if index is None:
+                raise AllocationError("%s of %s is not a /%d of %s %s" % (given[name], name, pool.prefix, pool.name, pool.network))
+            if index in pool.reserved:
+                raise AllocationError("%s of %s is a reserved address of %s %s" % (given[name], name, pool.name, pool.network))
+            if not pool.take(given[name]):
+                raise AllocationError("%s of %s overlaps with another host" % (given[name], name))
+            assigned[name] = given[name]
+
+    for name in names:
+        if name not in assigned and name in previous and pool.take(previous[name]):
+            assigned[name] = previous[name]
+
+    # only for hosts new to the state file, a persisted block never moves to make room
+    for name in names:
+        if name not in assigned and name not in previous and name in (preferred or {}) and pool.take(preferred[name]):
+            assigned[name] = preferred[name]
+
+    for name in names:
+        if name not in assigned:
+            assigned[name] = pool.allocate()
+
+    return dict((name, assigned[name]) for name in names)
+
+
+def statePath(configFile):
+    return os.path.splitext(configFile)[0] + ".state.json"
+
+
+def loadState(path):
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        raise AllocationError("failed to read %s: %s" % (path, err))
+
+
+def saveState(path, state):
+    data = json.dumps(state, indent=4, sort_keys=True) + "\n"
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == data:
+                return
+
+    import tempfile
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".state-")
+    with os.fdopen(fd, "w") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def allocate(configData, path):
+    # Fills in the missing pod CIDRs, internal IPs and etcd servers of configData in place,
+    # with the previous assignments of the state file at path. Returns the new state for saveState.
+    settings = configData['ansibleSettings']
+    previous = loadState(path)
+    state = {}
+
+    workers = [worker['name'] for worker in configData['workers']]
+    podCIDR = settings.get('podCIDR') or {}
+    pool = AddressPool(settings.get('clusterCIDR', ""), POD_CIDR_PREFIX, "clusterCIDR")
+    # block 0 is only used when given, the terraform routes number the pod ranges from 1 like the workers
+    pool.bitmap.cursor = 1
+    preferred = dict((name, pool.value(index + 1)) for index, name in enumerate(workers) if index + 1 < pool.bitmap.size)
+    settings['podCIDR'] = state['podCIDR'] = assign(pool, workers, podCIDR, previous.get('podCIDR', {}), preferred)
+
+    if configData.get('nodeCIDR'):
+        hosts = configData['controllers'] + configData['workers']
+        pool = AddressPool(configData['nodeCIDR'], ipaddress.ip_network(configData['nodeCIDR']).max_prefixlen, "nodeCIDR")
+        given = dict((host['name'], host['internalIP']) for host in hosts if host.get('internalIP'))
+        state['internalIP'] = assign(pool, [host['name'] for host in hosts], given, previous.get('internalIP', {}))
+        for host in hosts:
+            host['internalIP'] = state['internalIP'][host['name']]
+
+    if not settings.get('etcdServers'):
+        settings['etcdServers'] = dict((controller['name'], controller['internalIP']) for controller in configData['controllers'])
+
+    return state
@@ -0,0 +1,155 @@
+# Reproducible tar.gz bundles for the certificates and kubeconfig directories.
+#
+# buildHostBundles writes one bundle per host holding only the files that host
+# needs (hostBundles), buildArchive archives a whole directory.
+#
+# Entries are sorted, owner/group/mtime are fixed and the gzip header carries no
+# timestamp or file name, so the same input files always give a byte-identical
+# archive. Next to every archive a <archive>.sha256 sidecar holds its content hash,
+# the k8s-transfer-conf role compares it with the copy on the host and skips the
+# transfer when nothing changed.
+
+import io
+import os
+import hashlib
+
+SIDECAR_SUFFIX = ".sha256"
+
+# fixed timestamp for every entry, SOURCE_DATE_EPOCH is honoured when set
+ARCHIVE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+
+def collectFiles(directory, exclude=()):
+    # (arcname, path) for every file below directory, flattened like the
+    # original archiveFiles did and sorted by arcname
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            if name in exclude:
+                continue
+            files[name] = os.path.join(root, name)
+
+    return sorted(files.items())
+
+
+def tarInfo(arcname, path):
+    import tarfile
+
+    info = tarfile.TarInfo(arcname)
+    info.size = os.path.getsize(path)
+    info.mode = os.stat(path).st_mode & 0o777
+    info.mtime = ARCHIVE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def renderArchive(files):
+    # files: iterable of (arcname, path), returns the .tar.gz bytes
+    import gzip
+    import tarfile
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, mtime=ARCHIVE_MTIME) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as archive:
+            for arcname, path in files:
+                with open(path, "rb") as f:
+                    archive.addfile(tarInfo(arcname, path), f)
+
+    return buffer.getvalue()
+
+
+def writeArchive(tarFilename, files):
+    # Write tarFilename and its sidecar from the (arcname, path) files.
+    # Returns True if the archive changed, False if the existing one was already identical.
+    sidecar = tarFilename + SIDECAR_SUFFIX
+
+    data = renderArchive(files)
+    digest = hashlib.sha256(data).hexdigest()
+
+    if os.path.exists(tarFilename) and os.path.exists(sidecar):
+        with open(tarFilename, "rb") as f:
+            if f.read() == data:
+                return False
+
+    for path, content in (
+        (tarFilename, data),
+        (sidecar, ("%s  %s\n" % (digest, os.path.basename(tarFilename))).encode()),
+    ):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    return True
+
+
+def buildArchive(directory, tarFilename, exclude=()):
+    # Archive every file in directory.
+    sidecar = tarFilename + SIDECAR_SUFFIX
+    exclude = set(exclude) | {os.path.basename(tarFilename), os.path.basename(sidecar)}
+
+    return writeArchive(tarFilename, collectFiles(directory, exclude))
+
+
+# Files each host needs, see the k8s-bootstrap-* roles.
+
+CONTROLLER_CERTS = [
+    "ca.pem",
+    "ca-key.pem",
+    "kubernetes.pem",
+    "kubernetes-key.pem",
+    "service-account.pem",
+    "service-account-key.pem",
+]
+
+CONTROLLER_KUBECONFIGS = [
+    "admin.kubeconfig",
+    "kube-controller-manager.kubeconfig",
+    "kube-scheduler.kubeconfig",
+]
+
+
+def hostBundles(clusterConfig, kind):
+    # {host name: [file names]} for kind "certs" or "kubeconfig"
+    bundles = {}
+
+    for controller in clusterConfig['controllers'][:clusterConfig['controllersCount']]:
+        bundles[controller['name']] = list(CONTROLLER_CERTS if kind == "certs" else CONTROLLER_KUBECONFIGS)
+
+    for worker in clusterConfig['workers'][:clusterConfig['workersCount']]:
+        if kind == "certs":
+            files = ["ca.pem", worker['name'] + ".pem", worker['name'] + "-key.pem"]
+        else:
+            files = [worker['name'] + ".kubeconfig", "kube-proxy.kubeconfig"]
+        bundles[worker['name']] = files
+
+    return bundles
+
+
+def bundlePath(directory, prefix, host):
+    return os.path.join(directory, "%s-%s.tar.gz" % (prefix, host))
+
+
+def buildHostBundles(directory, prefix, bundles):
+    # Write <directory>/<prefix>-<host>.tar.gz for every host and remove the
+    # bundles of hosts that are no longer part of the cluster.
+    # Returns {host: changed}.
+    for files in bundles.values():
+        for name in files:
+            if not os.path.exists(os.path.join(directory, name)):
+                raise FileNotFoundError("%s not found in %s" % (name, directory))
+
+    changed = {}
+    for host in sorted(bundles):
+        files = sorted((name, os.path.join(directory, name)) for name in bundles[host])
+        changed[host] = writeArchive(bundlePath(directory, prefix, host), files)
+
+    expected = {os.path.basename(bundlePath(directory, prefix, host)) for host in bundles}
+    for name in os.listdir(directory):
+        if name.startswith(prefix + "-") and name.endswith(".tar.gz") and name not in expected:
+            os.remove(os.path.join(directory, name))
+            if os.path.exists(os.path.join(directory, name + SIDECAR_SUFFIX)):
+                os.remove(os.path.join(directory, name + SIDECAR_SUFFIX))
+
+    return changed
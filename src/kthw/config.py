@@ -0,0 +1,365 @@
+# Loading of the conf/cluster.json file shared by the pipeline stages.
+#
+# The file is parsed once per process (cached on path, size and mtime), checked against
+# SCHEMA, completed by the allocator (kthw/allocator.py) and returned as an immutable
+# ClusterConfig record. Fields can be read as attributes or, like the json dict, as config['key'].
+#
+# The shell scripts read fields with one interpreter start:
+#   python -m kthw.config --config ../conf/cluster.json --print-field staticExternalIP --print-field clusterName
+
+import os
+import sys
+import json
+import types
+import argparse
+import ipaddress
+import threading
+import collections.abc
+
+from kthw.allocator import AllocationError, allocate, saveState, statePath
+from kthw.encryption import DEFAULT_ENCRYPTION_PROVIDER, ENCRYPTION_PROVIDERS
+from kthw.kms import ENDPOINT
+from kthw.signer import DEFAULT_KEY_ALGORITHM, KEY_ALGORITHMS
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Record(collections.abc.Mapping):
+    # Immutable record with the fields listed in FIELDS as (name, type). The fields are
+    # attributes, and config['workers'] / config.get('nodeCIDR') work like on the json dict.
+    # (not a frozen dataclass: importing dataclasses costs more than this whole module)
+
+    FIELDS = ()
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name, kind in self.FIELDS:
+            object.__setattr__(self, name, values.pop(name))
+        if len(values) > 0:
+            raise TypeError("%s got unexpected fields: %s" % (type(self).__name__, ", ".join(values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
+
+
+class Host(Record):
+    FIELDS = (("name", str), ("internalIP", str), ("externalIP", str), ("sshUser", str))
+    __slots__ = tuple(name for name, kind in FIELDS)
+
+
+class AnsibleSettings(Record):
+    FIELDS = (
+        ("etcdServers", types.MappingProxyType),
+        ("podCIDR", types.MappingProxyType),
+        ("clusterCIDR", str),
+        ("kubernetesVersion", str),
+        ("kubeAPIServerCount", int),
+        ("clusterDNS", str),
+    )
+    __slots__ = tuple(name for name, kind in FIELDS)
+
+
+class ClusterConfig(Record):
+    FIELDS = (
+        ("workersCount", int),
+        ("controllersCount", int),
+        ("ansibleSettings", AnsibleSettings),
+        ("staticExternalIP", str),
+        ("clusterName", str),
+        ("certificatesPath", str),
+        ("k8sConfPath", str),
+        ("templatesPath", str),
+        ("ansiblePlaybook", str),
+        ("ansibleInventory", str),
+        ("controllers", tuple),
+        ("workers", tuple),
+        ("nodeCIDR", str),
+        ("keyAlgorithm", str),
+        ("encryptionProvider", str),
+    )
+    __slots__ = tuple(name for name, kind in FIELDS)
+
+
+# key: (type, required) of the json entries, a dict is a nested object and [dict] a list of them.
+# podCIDR, etcdServers and internalIP may be left for the allocator to fill in.
+HOST_SCHEMA = {
+    "name": (str, True),
+    "internalIP": (str, False),
+    "externalIP": (str, True),
+    "sshUser": (str, True),
+}
+
+ANSIBLE_SCHEMA = {
+    "etcdServers": (dict, False),
+    "podCIDR": (dict, False),
+    "clusterCIDR": (str, True),
+    "kubernetesVersion": (str, True),
+    "kubeAPIServerCount": (int, True),
+    "clusterDNS": (str, True),
+}
+
+SCHEMA = {
+    "workersCount": (int, True),
+    "controllersCount": (int, True),
+    "ansibleSettings": (ANSIBLE_SCHEMA, True),
+    "staticExternalIP": (str, True),
+    "clusterName": (str, True),
+    "certificatesPath": (str, True),
+    "k8sConfPath": (str, True),
+    "templatesPath": (str, True),
+    "ansiblePlaybook": (str, True),
+    "ansibleInventory": (str, True),
+    "controllers": ([HOST_SCHEMA], True),
+    "workers": ([HOST_SCHEMA], True),
+    "nodeCIDR": (str, False),
+    "keyAlgorithm": (str, False),
+    "encryptionProvider": (str, False),
+}
+
+REQUIRED_KEYS = [key for key, (kind, required) in SCHEMA.items() if required]
+
+
+def checkSchema(data, schema, path, errors):
+    for key in data:
+        if key not in schema:
+            errors.append("%s is not a known setting" % ("%s.%s" % (path, key) if path else key))
+
+    for key, (kind, required) in schema.items():
+        name = "%s.%s" % (path, key) if path else key
+        if key not in data:
+            if required:
+                errors.append("%s is missing" % name)
+            continue
+
+        value = data[key]
+        if isinstance(kind, dict):
+            if not isinstance(value, dict):
+                errors.append("%s must be an object" % name)
+            else:
+                checkSchema(value, kind, name, errors)
+        elif isinstance(kind, list):
+            if not isinstance(value, list):
+                errors.append("%s must be a list" % name)
+                continue
+            for index, item in enumerate(value):
+                if not isinstance(item, dict):
+                    errors.append("%s[%d] must be an object" % (name, index))
+                else:
+                    checkSchema(item, kind[0], "%s[%d]" % (name, index), errors)
+        elif kind is dict:
+            if not isinstance(value, dict) or not all(isinstance(item, str) for item in value.values()):
+                errors.append("%s must be an object of strings" % name)
+        elif not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            errors.append("%s must be a %s" % (name, "number" if kind is int else "string"))
+
+
+def checkAddress(value, name, errors, network=False, optional=False):
+    if optional and value == "":
+        return
+    try:
+        if network:
+            ipaddress.ip_network(value)
+        else:
+            ipaddress.ip_address(value)
+    except ValueError:
+        errors.append("%s: %r is not a valid %s" % (name, value, "CIDR" if network else "IP address"))
+
+
+def checkHosts(configData, errors):
+    # counts and unique names, before the allocator hands out addresses by name
+    for key in ("controllers", "workers"):
+        if configData[key + "Count"] != len(configData[key]):
+            errors.append("%sCount is %d but %s lists %d hosts" % (key, configData[key + "Count"], key, len(configData[key])))
+
+    names = set()
+    for key in ("controllers", "workers"):
+        for index, host in enumerate(configData[key]):
+            if host['name'] in names:
+                errors.append("%s[%d]: host name %s is used more than once" % (key, index, host['name']))
+            names.add(host['name'])
+
+
+def checkValues(configData, errors):
+    # address syntax of the allocated config
+    settings = configData['ansibleSettings']
+
+    for key in ("controllers", "workers"):
+        for index, host in enumerate(configData[key]):
+            name = "%s[%d]" % (key, index)
+            if host['internalIP'] == "":
+                errors.append("%s.internalIP is empty and no nodeCIDR is set" % name)
+            else:
+                checkAddress(host['internalIP'], name + ".internalIP", errors)
+            checkAddress(host['externalIP'], name + ".externalIP", errors, optional=True)
+
+    checkAddress(configData['staticExternalIP'], "staticExternalIP", errors, optional=True)
+    checkAddress(settings['clusterCIDR'], "ansibleSettings.clusterCIDR", errors, network=True)
+    checkAddress(settings['clusterDNS'], "ansibleSettings.clusterDNS", errors)
+    for name, cidr in settings['podCIDR'].items():
+        checkAddress(cidr, "ansibleSettings.podCIDR.%s" % name, errors, network=True)
+    for name, ip in settings['etcdServers'].items():
+        checkAddress(ip, "ansibleSettings.etcdServers.%s" % name, errors)
+
+    if configData.get('keyAlgorithm', DEFAULT_KEY_ALGORITHM) not in KEY_ALGORITHMS:
+        errors.append("keyAlgorithm: %r is not one of %s" % (configData['keyAlgorithm'], ", ".join(KEY_ALGORITHMS)))
+    if configData.get('encryptionProvider', DEFAULT_ENCRYPTION_PROVIDER) not in ENCRYPTION_PROVIDERS:
+        errors.append("encryptionProvider: %r is not one of %s" % (configData['encryptionProvider'], ", ".join(ENCRYPTION_PROVIDERS)))
+    elif configData.get('encryptionProvider') == "kms":
+        # the playbook does not run a KMS plugin on the controllers yet, kube-apiserver would not start
+        errors.append("encryptionProvider: kms needs a KMS plugin on %s of every controller, which the playbook does not deploy yet" % ENDPOINT)
+
+
+def freeze(configData):
+    settings = configData['ansibleSettings']
+    return ClusterConfig(
+        workersCount=configData['workersCount'],
+        controllersCount=configData['controllersCount'],
+        ansibleSettings=AnsibleSettings(
+            etcdServers=types.MappingProxyType(dict(settings['etcdServers'])),
+            podCIDR=types.MappingProxyType(dict(settings['podCIDR'])),
+            clusterCIDR=settings['clusterCIDR'],
+            kubernetesVersion=settings['kubernetesVersion'],
+            kubeAPIServerCount=settings['kubeAPIServerCount'],
+            clusterDNS=settings['clusterDNS'],
+        ),
+        staticExternalIP=configData['staticExternalIP'],
+        clusterName=configData['clusterName'],
+        certificatesPath=configData['certificatesPath'],
+        k8sConfPath=configData['k8sConfPath'],
+        templatesPath=configData['templatesPath'],
+        ansiblePlaybook=configData['ansiblePlaybook'],
+        ansibleInventory=configData['ansibleInventory'],
+        controllers=tuple(Host(**host) for host in configData['controllers']),
+        workers=tuple(Host(**host) for host in configData['workers']),
+        nodeCIDR=configData.get('nodeCIDR', ""),
+        keyAlgorithm=configData.get('keyAlgorithm', DEFAULT_KEY_ALGORITHM),
+        encryptionProvider=configData.get('encryptionProvider', DEFAULT_ENCRYPTION_PROVIDER),
+    )
+
+
+def parseConfig(configData, configFile):
+    if not isinstance(configData, list) or len(configData) == 0 or not isinstance(configData[0], dict):
+        raise ConfigError("%s must contain a list with one cluster entry" % configFile)
+
+    entry = configData[0]
+    errors = []
+    checkSchema(entry, SCHEMA, "", errors)
+    if len(errors) == 0:
+        checkHosts(entry, errors)
+    if len(errors) > 0:
+        raise ConfigError("%s: %s" % (configFile, "; ".join(errors)))
+
+    for host in entry['controllers'] + entry['workers']:
+        host.setdefault('internalIP', "")
+
+    try:
+        state = allocate(entry, statePath(configFile))
+    except (OSError, AllocationError) as err:
+        raise ConfigError("%s: %s" % (configFile, err))
+
+    checkValues(entry, errors)
+    if len(errors) > 0:
+        raise ConfigError("%s: %s" % (configFile, "; ".join(errors)))
+
+    return freeze(entry), state
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def loadConfig(configFile, save=False):
+    # Returns the cluster entry (the first element) of the json conf file as a ClusterConfig,
+    # with the missing pod CIDRs / internal IPs allocated (see kthw/allocator.py).
+    # save writes the allocation to the state file, for the stages that generate from it;
+    # read-only users (--print-field, the inventory script) leave it alone.
+    path = os.path.abspath(configFile)
+    with _lock:
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime_ns)
+            if key not in _cache:
+                with open(path) as f:
+                    configData = json.load(f)
+                _cache[key] = parseConfig(configData, configFile)
+        except (OSError, ValueError) as err:
+            raise ConfigError("failed to read %s: %s" % (configFile, err))
+
+        config, state = _cache[key]
+        if save:
+            try:
+                saveState(statePath(configFile), state)
+            except OSError as err:
+                raise ConfigError("failed to write %s: %s" % (statePath(configFile), err))
+
+        return config
+
+
+def configData(value):
+    # plain json data of a ClusterConfig (allocated values included), e.g. to write a derived cluster.json
+    if isinstance(value, Record):
+        return dict((name, configData(getattr(value, name))) for name in value.__slots__)
+    if isinstance(value, tuple):
+        return [configData(item) for item in value]
+    if isinstance(value, types.MappingProxyType):
+        return dict(value)
+    return value
+
+
+def field(config, name):
+    # dotted path, e.g. ansibleSettings.clusterCIDR or workers.0.internalIP
+    value = config
+    for part in name.split("."):
+        try:
+            value = value[int(part)] if isinstance(value, tuple) else value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ConfigError("unknown field %s" % name)
+
+    if isinstance(value, (tuple, types.MappingProxyType, Record)):
+        raise ConfigError("%s is not a single value" % name)
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kthw.config", description="KTHW - Validate the cluster config and print fields.")
+    parser.add_argument("--config", type=str, required=True, help="Specify the path to the Kubernetes cluster config json file.")
+    parser.add_argument(
+        "--print-field", type=str, action="append", default=[], dest="fields",
+        help="Field to print, e.g. staticExternalIP or ansibleSettings.clusterCIDR; can be repeated, one value per line.",
+    )
+
+    args = parser.parse_args(argv)
+
+    try:
+        config = loadConfig(args.config)
+        values = [field(config, name) for name in args.fields]
+    except ConfigError as err:
+        print("ERROR > %s" % err, file=sys.stderr)
+        return 1
+
+    for value in values:
+        print(value)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
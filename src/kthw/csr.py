@@ -0,0 +1,82 @@
+# CSR templates (templates/*-csr.json) rendered in memory.
+#
+# Every template is read and parsed once per process (cached on path, size and mtime), with
+# placeholders such as ${instance} compiled to string.Template objects at that point. Rendering
+# the CSR of a host then only copies the small json structure and fills them in, and the
+# signers take the rendered dict as it is: no <name>-csr.json files are written.
+#
+# With KTHW_DEBUG_CSR=1 in the environment the rendered CSR of every issued certificate is
+# written next to it as <name>-csr.json, like the scripts used to.
+
+import os
+import json
+import threading
+from string import Template
+
+DEBUG = os.environ.get("KTHW_DEBUG_CSR", "") not in ("", "0")
+
+
+class CsrError(Exception):
+    pass
+
+
+def compileNode(node):
+    if isinstance(node, str):
+        return Template(node) if "$" in node else node
+    if isinstance(node, dict):
+        return dict((key, compileNode(value)) for key, value in node.items())
+    if isinstance(node, list):
+        return [compileNode(item) for item in node]
+    return node
+
+
+def renderNode(node, values):
+    if isinstance(node, Template):
+        return node.substitute(values)
+    if isinstance(node, dict):
+        return dict((key, renderNode(value, values)) for key, value in node.items())
+    if isinstance(node, list):
+        return [renderNode(item, values) for item in node]
+    return node
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def loadTemplate(csrFile):
+    # compiled template of csrFile, parsed on first use
+    path = os.path.abspath(csrFile)
+    with _lock:
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime_ns)
+            if key not in _cache:
+                with open(path) as f:
+                    _cache[key] = compileNode(json.load(f))
+        except (OSError, ValueError) as err:
+            raise CsrError("failed to read %s: %s" % (csrFile, err))
+
+        return _cache[key]
+
+
+def renderCsr(csrFile, values=None):
+    return renderCsrs(csrFile, [values or {}])[0]
+
+
+def renderCsrs(csrFile, valuesList):
+    # one CSR dict per entry of valuesList, e.g. [{"instance": "worker-1"}, ...]
+    template = loadTemplate(csrFile)
+    try:
+        return [renderNode(template, values) for values in valuesList]
+    except KeyError as err:
+        raise CsrError("%s: no value for ${%s}" % (csrFile, err.args[0]))
+    except ValueError as err:
+        raise CsrError("%s: %s" % (csrFile, err))
+
+
+def writeDebugCsr(out_base, csr):
+    # <out_base>-csr.json when KTHW_DEBUG_CSR is set
+    if DEBUG:
+        with open(out_base + "-csr.json", "w") as f:
+            json.dump(csr, f, indent=4)
@@ -0,0 +1,219 @@
+# Streaming delivery of the certificates and kubeconfig files to the hosts.
+#
+#   python -m kthw.deliver --config ../conf/cluster.json [--jobs 8]
+#
+# Instead of writing k8s-certs/k8s-kubeconfig bundles that Ansible copies to remote_path,
+# unarchives and copies again into /var/lib/kubernetes, /etc/etcd, ..., every host gets one
+# tar stream built in memory, piped over ssh into `tar -x -C /`: each file lands in its
+# final location (HOST_FILES) in a single pass, with no archive on either side.
+#
+# The stream is reproducible (see kthw/archive.py), its sha256 is kept on the host in
+# STATE_FILE and an unchanged stream is not extracted again. The ssh connections are opened
+# as ControlMaster sockets in CONTROL_PATH_DIR, the playbook run reuses them (kthw/pipeline.py).
+# A host that does not finish within DELIVER_TIMEOUT is cut off, failed connections are retried.
+
+import io
+import os
+import sys
+import hashlib
+import argparse
+
+from kthw.archive import tarInfo
+from kthw.config import ConfigError, loadConfig
+from kthw.executor import CommandError, Executor
+
+DELIVERY_MODES = ("bundle", "stream")
+
+STATE_FILE = "/var/lib/kthw/delivered.sha256"
+
+CONTROL_PATH_DIR = os.path.join(os.path.expanduser("~"), ".ansible", "cp")
+
+# per host; ssh exits with 255 when the connection failed, the remote script is safe to run again
+DELIVER_TIMEOUT = 300.0
+DELIVER_RETRIES = 2
+SSH_CONNECTION_FAILED = 255
+
+# (source directory key, file name, destinations) per host kind, see the k8s-bootstrap-* roles.
+# {host} is the worker name.
+HOST_FILES = {
+    "controller": [
+        ("certificatesPath", "ca.pem", ["/var/lib/kubernetes/ca.pem", "/etc/etcd/ca.pem"]),
+        ("certificatesPath", "ca-key.pem", ["/var/lib/kubernetes/ca-key.pem"]),
+        ("certificatesPath", "kubernetes.pem", ["/var/lib/kubernetes/kubernetes.pem", "/etc/etcd/kubernetes.pem"]),
+        ("certificatesPath", "kubernetes-key.pem", ["/var/lib/kubernetes/kubernetes-key.pem", "/etc/etcd/kubernetes-key.pem"]),
+        ("certificatesPath", "service-account.pem", ["/var/lib/kubernetes/service-account.pem"]),
+        ("certificatesPath", "service-account-key.pem", ["/var/lib/kubernetes/service-account-key.pem"]),
+        ("k8sConfPath", "encryption-config.yaml", ["/var/lib/kubernetes/encryption-config.yaml"]),
+        ("k8sConfPath", "kube-controller-manager.kubeconfig", ["/var/lib/kubernetes/kube-controller-manager.kubeconfig"]),
+        ("k8sConfPath", "kube-scheduler.kubeconfig", ["/var/lib/kubernetes/kube-scheduler.kubeconfig"]),
+        ("k8sConfPath", "admin.kubeconfig", ["/var/lib/kubernetes/admin.kubeconfig"]),
+    ],
+    "worker": [
+        ("certificatesPath", "ca.pem", ["/var/lib/kubernetes/ca.pem"]),
+        ("certificatesPath", "{host}.pem", ["/var/lib/kubelet/{host}.pem"]),
+        ("certificatesPath", "{host}-key.pem", ["/var/lib/kubelet/{host}-key.pem"]),
+        ("k8sConfPath", "{host}.kubeconfig", ["/var/lib/kubelet/kubeconfig"]),
+        ("k8sConfPath", "kube-proxy.kubeconfig", ["/var/lib/kube-proxy/kubeconfig"]),
+    ],
+}
+
+# Runs on the host with the stream on stdin. An unchanged stream (REMOTE_CHECK, left out
+# with --force) is left unread, ssh discards it when the command exits.
+REMOTE_CHECK = """if [ "$(sudo cat %(state)s 2>/dev/null)" = "%(digest)s" ]; then echo unchanged; exit 0; fi
+"""
+
+REMOTE_SCRIPT = """set -e
+%(check)ssudo tar -x -f - -C /
+sudo mkdir -p %(stateDir)s
+echo %(digest)s | sudo tee %(state)s >/dev/null
+echo delivered"""
+
+
+class DeliveryError(Exception):
+    pass
+
+
+def hostFiles(clusterConfig, host, kind):
+    # [(destination, source path)] of a host, sorted by destination
+    files = []
+    for directory, name, destinations in HOST_FILES[kind]:
+        source = os.path.join(clusterConfig[directory], name.format(host=host['name']))
+        if not os.path.exists(source):
+            raise DeliveryError("%s: %s not found" % (host['name'], source))
+        for destination in destinations:
+            files.append((destination.format(host=host['name']), source))
+
+    return sorted(files)
+
+
+def renderStream(files):
+    # uncompressed tar of the (destination, source path) files, relative to /
+    import tarfile
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as archive:
+        for destination, source in files:
+            with open(source, "rb") as f:
+                archive.addfile(tarInfo(destination.lstrip("/"), source), f)
+
+    return buffer.getvalue()
+
+
+def sshCommand(host, command, ssh="ssh"):
+    return [
+        ssh,
+        "-o", "BatchMode=yes",
+        "-o", "ControlMaster=auto",
+        "-o", "ControlPersist=120s",
+        "-o", "ControlPath=%s/%%C" % CONTROL_PATH_DIR,
+        "%s@%s" % (host['sshUser'], host['externalIP']),
+        command,
+    ]
+
+
+def deliveryExecutor(jobs=4):
+    return Executor(limit=max(1, jobs), timeout=DELIVER_TIMEOUT, retries=DELIVER_RETRIES, retryCodes=(SSH_CONNECTION_FAILED,))
+
+
+def deliverHost(clusterConfig, host, kind, force=False, ssh="ssh", executor=None):
+    # Stream the files of one host, returns "delivered" or "unchanged".
+    stream = renderStream(hostFiles(clusterConfig, host, kind))
+    digest = hashlib.sha256(stream).hexdigest()
+    values = {"state": STATE_FILE, "stateDir": os.path.dirname(STATE_FILE), "digest": digest}
+    values["check"] = "" if force else REMOTE_CHECK % values
+    script = REMOTE_SCRIPT % values
+
+    command = sshCommand(host, script, ssh)
+    try:
+        result = (executor or deliveryExecutor()).run(
+            command,
+            input=stream,
+            display=[ssh, "%s@%s" % (host['sshUser'], host['externalIP'])],
+            spanArgs={"host": host['name'], "bytes": len(stream)},
+        )
+    except CommandError as err:
+        raise DeliveryError("%s: %s" % (host['name'], err))
+
+    output = result.stdout.decode(errors="replace").split()
+    return output[-1] if len(output) > 0 else "delivered"
+
+
+def deliveryHosts(clusterConfig):
+    hosts = [(controller, "controller") for controller in clusterConfig['controllers'][:clusterConfig['controllersCount']]]
+    hosts += [(worker, "worker") for worker in clusterConfig['workers'][:clusterConfig['workersCount']]]
+    return hosts
+
+
+def deliverFiles(clusterConfig, jobs=4, force=False, ssh="ssh"):
+    # Stream to every host, `jobs` at a time. Returns {host name: "delivered" / "unchanged"},
+    # raises DeliveryError listing every host that failed.
+    import concurrent.futures
+
+    os.makedirs(CONTROL_PATH_DIR, mode=0o700, exist_ok=True)
+
+    results = {}
+    errors = []
+    executor = deliveryExecutor(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = dict(
+            (pool.submit(deliverHost, clusterConfig, host, kind, force, ssh, executor), host['name'])
+            for host, kind in deliveryHosts(clusterConfig)
+        )
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except DeliveryError as err:
+                errors.append(str(err))
+
+    if len(errors) > 0:
+        raise DeliveryError("; ".join(sorted(errors)))
+
+    return results
+
+
+def streamFiles(clusterConfig, jobs=4, force=False, ssh="ssh"):
+    # Stage function: report like the other stages, sys.exit(1) on failure.
+    print("::Streaming certificates and kubeconfig files to the hosts.")
+    try:
+        results = deliverFiles(clusterConfig, jobs, force, ssh)
+    except DeliveryError as err:
+        print("ERROR > %s" % err)
+        sys.exit(1)
+
+    for name in sorted(results):
+        print("> %s %s." % (name, results[name]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kthw.deliver", description="KTHW - Stream the generated files to the hosts.")
+    parser.add_argument("--config", type=str, required=True, help="Specify the path to the Kubernetes cluster config json file.")
+    parser.add_argument("--jobs", type=int, default=4, help="Number of hosts to stream to at the same time (default: 4).")
+    parser.add_argument("--force", action="store_true", help="Extract the stream even if the host already has the same files.")
+    parser.add_argument("--ssh", type=str, default="ssh", help="ssh client to use (default: ssh).")
+    parser.add_argument("--list", action="store_true", help="Only print where every file goes, per host.")
+
+    args = parser.parse_args(argv)
+
+    try:
+        clusterConfig = loadConfig(args.config)
+    except ConfigError as err:
+        print("ERROR > %s" % err)
+        return 1
+
+    if args.list:
+        try:
+            for host, kind in deliveryHosts(clusterConfig):
+                print("%s:" % host['name'])
+                for destination, source in hostFiles(clusterConfig, host, kind):
+                    print("    %s <- %s" % (destination, source))
+        except DeliveryError as err:
+            print("ERROR > %s" % err)
+            return 1
+        return 0
+
+    streamFiles(clusterConfig, args.jobs, args.force, args.ssh)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
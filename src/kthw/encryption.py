@@ -0,0 +1,223 @@
+# Encryption config of the kube-apiserver (encryption at rest of secrets).
+#
+# The config lists providers in order, the first key of the first provider encrypts new
+# writes and every listed key can decrypt. Keys are 32 random bytes, base64 encoded:
+#
+#   aescbc    - AES-CBC with PKCS#7 padding, the slowest of the three
+#   aesgcm    - AES-GCM with a random nonce, fastest with AES-NI; rotate at least every
+#               200k writes (nonce collisions)
+#   secretbox - XSalsa20 + Poly1305
+#   kms       - KMS v2: the apiserver encrypts with a data encryption key it caches and only
+#               the key is wrapped by the KMS plugin on the controller (see kthw/kms.py), so
+#               writes make no call to the plugin. Needs Kubernetes 1.27 or later.
+#
+# Rotation keeps the old keys so secrets written with them stay readable:
+#
+#   prepend - a new key encrypts from now on (one controller, or apiservers restarted at once)
+#   stage   - a new key is added second, every apiserver can read it before any writes with it
+#   promote - the staged (newest) key becomes the first one, after every apiserver runs the staged config
+#   prune   - only the first key is kept, once all secrets were rewritten with it
+#             (kubectl get secrets -A -o json | kubectl replace -f -)
+
+import os
+import base64
+from string import Template
+
+from kthw.kms import ENDPOINT, TIMEOUT
+
+ENCRYPTION_PROVIDERS = ("aescbc", "aesgcm", "secretbox", "kms")
+DEFAULT_ENCRYPTION_PROVIDER = "aescbc"
+
+ROTATIONS = ("prepend", "stage", "promote")
+
+KEY_BYTES = 32
+
+# KMS v2 takes the EncryptionConfiguration format only
+CONFIGURATION_KIND = {"kind": "EncryptionConfiguration", "apiVersion": "apiserver.config.k8s.io/v1"}
+
+
+class EncryptionError(Exception):
+    pass
+
+
+def newSecret():
+    return base64.b64encode(os.urandom(KEY_BYTES)).decode("ascii")
+
+
+def renderInitial(templateFile, provider):
+    # first config of a cluster: one key1 of provider, or the kms provider in place of the key
+    import yaml
+
+    try:
+        with open(templateFile) as f:
+            template = Template(f.read())
+        data = yaml.safe_load(template.substitute({"provider": provider, "secret": newSecret()}))
+    except (OSError, yaml.YAMLError) as err:
+        raise EncryptionError("failed to read %s: %s" % (templateFile, err))
+    except (KeyError, ValueError) as err:
+        raise EncryptionError("%s: no value for %s" % (templateFile, err))
+
+    if provider == "kms":
+        resource = secretsResource(data)
+        entries = flatten(resource['providers'])
+        resource['providers'] = unflatten([newEntry("kms", [])] + [entry for entry in entries if not encrypts(entry)])
+    return configurationKind(data)
+
+
+def loadEncryptionConfig(path):
+    import yaml
+
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as err:
+        raise EncryptionError("failed to read %s: %s" % (path, err))
+
+    if not isinstance(data, dict) or not isinstance(data.get('resources'), list):
+        raise EncryptionError("%s is not an encryption config" % path)
+
+    return data
+
+
+def secretsResource(data):
+    for resource in data['resources']:
+        if "secrets" in resource.get('resources', []):
+            return resource
+
+    raise EncryptionError("no provider list for secrets")
+
+
+def flatten(providers):
+    # [(provider, key or None, config)] in the order the apiserver tries them, one entry per key;
+    # providers without keys (identity, kms) keep their config
+    entries = []
+    for entry in providers:
+        (name, config), = entry.items()
+        if isinstance(config, dict) and isinstance(config.get('keys'), list):
+            entries += [(name, key, None) for key in config['keys']]
+        else:
+            entries.append((name, None, config))
+
+    return entries
+
+
+def unflatten(entries):
+    # consecutive keys of the same provider share one provider entry
+    providers = []
+    for name, key, config in entries:
+        if key is None:
+            providers.append({name: config})
+        elif len(providers) > 0 and name in providers[-1] and isinstance(providers[-1][name], dict) and 'keys' in providers[-1][name]:
+            providers[-1][name]['keys'].append(key)
+        else:
+            providers.append({name: {"keys": [key]}})
+
+    return providers
+
+
+def encrypts(entry):
+    # a key or a kms provider, not identity
+    name, key, config = entry
+    return key is not None or name == "kms"
+
+
+def keyEntries(entries):
+    return [index for index, entry in enumerate(entries) if encrypts(entry)]
+
+
+def keyNumber(entry):
+    # 3 of key3 / kms3, 0 for names not given by this module
+    name, key, config = entry
+    name = str((key if key is not None else config or {}).get('name', ""))
+    return int(name[3:]) if name[:3] in ("key", "kms") and name[3:].isdigit() else 0
+
+
+def newEntry(provider, entries):
+    number = max([0] + [keyNumber(entry) for entry in entries if encrypts(entry)]) + 1
+    if provider == "kms":
+        return ("kms", None, {"apiVersion": "v2", "name": "kms%d" % number, "endpoint": ENDPOINT, "timeout": TIMEOUT})
+    return (provider, {"name": "key%d" % number, "secret": newSecret()}, None)
+
+
+def entryName(entry):
+    name, key, config = entry
+    if key is not None:
+        return "%s:%s" % (name, key['name'])
+    if isinstance(config, dict) and 'name' in config:
+        return "%s:%s" % (name, config['name'])
+    return name
+
+
+def configurationKind(data):
+    # data in the EncryptionConfiguration format once a kms provider is listed
+    if any(name == "kms" for name, key, config in flatten(secretsResource(data)['providers'])):
+        data = dict(CONFIGURATION_KIND, **dict((key, value) for key, value in data.items() if key not in CONFIGURATION_KIND))
+    return data
+
+
+def currentProvider(data):
+    # provider that encrypts new writes
+    entries = flatten(secretsResource(data)['providers'])
+    return entries[0][0] if len(entries) > 0 else None
+
+
+def describe(data):
+    # "aesgcm:key2, aescbc:key1, identity" of the secrets providers
+    return ", ".join(entryName(entry) for entry in flatten(secretsResource(data)['providers']))
+
+
+def rotate(data, provider, mode):
+    # New config with a fresh key of provider (prepend / stage) or the staged key first (promote).
+    # A new kms provider gets a name of its own, data written under the old one stays readable.
+    if provider not in ENCRYPTION_PROVIDERS:
+        raise EncryptionError("unknown encryption provider %s" % provider)
+
+    resource = secretsResource(data)
+    entries = flatten(resource['providers'])
+    keys = keyEntries(entries)
+    new = newEntry(provider, entries)
+
+    if mode == "prepend":
+        entries.insert(0, new)
+    elif mode == "stage":
+        # before the second key, or right after the first one if it is the only one
+        entries.insert(keys[0] + 1 if len(keys) > 0 else len(entries), new)
+    elif mode == "promote":
+        # the staged key is the newest one
+        newest = max(keys, key=lambda index: keyNumber(entries[index])) if len(keys) > 0 else None
+        if newest is None or newest == 0:
+            raise EncryptionError("no staged key to promote")
+        entries.insert(0, entries.pop(newest))
+    else:
+        raise EncryptionError("unknown rotation %s" % mode)
+
+    resource['providers'] = unflatten(entries)
+    return configurationKind(data)
+
+
+def prune(data):
+    # drop every key but the one that encrypts, identity stays
+    resource = secretsResource(data)
+    entries = flatten(resource['providers'])
+    keys = keyEntries(entries)
+    if len(keys) == 0 or keys[0] != 0:
+        raise EncryptionError("new writes are not encrypted, nothing to prune to")
+
+    resource['providers'] = unflatten([entry for index, entry in enumerate(entries) if index == 0 or not encrypts(entry)])
+    return data
+
+
+def writeEncryptionConfig(path, data):
+    # written to a temporary file and renamed in, readable by the owner only
+    import yaml
+
+    tmp = "%s.tmp-%d" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(yaml.safe_dump(data, default_flow_style=False, sort_keys=False))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
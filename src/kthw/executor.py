@@ -0,0 +1,239 @@
+# Shared runner of the external commands (cfssl, kubectl, ssh, ansible-playbook, ...).
+#
+# Every command of every stage runs on one asyncio event loop in a background thread; the
+# stages keep calling from their own threads and block on the result:
+#
+#   executor = Executor(limit=8, timeout=60, retries=2)
+#   result = executor.run(["cfssl", "gencert", ...], input=csr)     # CommandResult
+#
+# An Executor bounds how many of its commands run at the same time (limit), kills a command
+# that runs longer than its timeout and retries timed out commands (and exit codes listed in
+# retryCodes) with exponential backoff. run() raises CommandError with the CommandResult when
+# the command still failed; check=False returns it instead.
+#
+# A fatal error, a command that cannot be started at all (not installed) or a failed run
+# with fatal=True, cancels the siblings: running commands of the same Executor are killed
+# and every later run() fails right away, so a broken build stops instead of trying every
+# remaining certificate. Each stage uses an Executor of its own.
+#
+# Every command is a process span (kthw/trace.py) with its exit code, attempts and stderr tail.
+
+import os
+import time
+import random
+import threading
+
+from kthw.trace import commandName, processSpan
+
+DEFAULT_TIMEOUT = 120.0
+DEFAULT_BACKOFF = 0.5
+
+PIPE = "pipe"
+
+
+class CommandError(Exception):
+
+    def __init__(self, message, result=None):
+        Exception.__init__(self, message)
+        self.result = result
+
+
+class CommandResult:
+
+    def __init__(self, args, display=None):
+        self.args = list(args)
+        # what spans and error messages show of the command
+        self.display = list(display) if display is not None else self.args
+        self.returncode = None
+        self.stdout = b""
+        self.stderr = b""
+        self.duration = 0.0
+        self.attempts = 0
+        self.timeout = None
+        self.timedOut = False
+        self.cancelled = False
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timedOut and not self.cancelled and self.error is None
+
+    def output(self):
+        # stderr, else stdout, decoded for error messages
+        return (self.stderr or self.stdout or b"").decode(errors="replace").strip()
+
+    def describe(self):
+        command = commandName(self.display)
+        if self.cancelled:
+            return "%s: cancelled after a fatal error of another command" % command
+        if self.error is not None:
+            return "%s: %s" % (command, self.error)
+        if self.timedOut:
+            return "%s: timed out after %gs, %d attempts" % (command, self.timeout, self.attempts)
+        output = self.output()
+        return "%s: exited with %s%s" % (command, self.returncode, ": " + output if output else "")
+
+    def __repr__(self):
+        return "CommandResult(%s, returncode=%s, attempts=%d, %.3fs)" % (commandName(self.display), self.returncode, self.attempts, self.duration)
+
+
+_loop = None
+_loopLock = threading.Lock()
+
+
+def eventLoop():
+    # the shared loop, started in a daemon thread on first use
+    global _loop
+    import asyncio
+
+    with _loopLock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="kthw-executor", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+class Executor:
+
+    def __init__(self, limit=None, timeout=DEFAULT_TIMEOUT, retries=0, backoff=DEFAULT_BACKOFF, retryCodes=()):
+        self.limit = limit or os.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retryCodes = tuple(retryCodes)
+        self.fatal = None
+        self._semaphore = None
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def run(self, args, input=None, timeout=None, retries=None, check=True, fatal=False, cwd=None, env=None, stdout=PIPE, stderr=PIPE,
+            display=None, spanArgs=None):
+        # Run args to completion from any thread, returns its CommandResult.
+        # stdout / stderr: PIPE to capture, None to inherit, or an open file.
+        # display replaces args in spans and messages (ssh with a whole script as argument),
+        # spanArgs are added to the process span.
+        import asyncio
+
+        loop = eventLoop()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(CommandResult(args, display), input, self.timeout if timeout is None else timeout,
+                      self.retries if retries is None else retries, fatal, cwd, env, stdout, stderr, spanArgs or {}),
+            loop,
+        )
+        try:
+            result = future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+        if check and not result.ok:
+            raise CommandError(result.describe(), result)
+        return result
+
+    def cancel(self, reason):
+        # fail every running and later command of this executor
+        with self._lock:
+            if self.fatal is None:
+                self.fatal = reason
+            tasks = list(self._tasks)
+        for task in tasks:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    async def _run(self, result, input, timeout, retries, fatal, cwd, env, stdout, stderr, spanArgs):
+        import asyncio
+
+        task = asyncio.current_task()
+        with self._lock:
+            if self.fatal is not None:
+                result.cancelled = True
+                return result
+            self._tasks.add(task)
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.limit)
+
+        result.timeout = timeout
+        start = time.perf_counter()
+        try:
+            with processSpan(result.display) as traced_span:
+                async with self._semaphore:
+                    while True:
+                        result.attempts += 1
+                        await self._attempt(result, input, timeout, cwd, env, stdout, stderr)
+                        transient = result.timedOut or (result.returncode in self.retryCodes and result.error is None)
+                        if result.ok or not transient or result.attempts > retries:
+                            break
+                        # exponential backoff with jitter, retries of parallel commands don't line up
+                        await asyncio.sleep(self.backoff * 2 ** (result.attempts - 1) * random.uniform(0.5, 1.5))
+                traced_span.process(result.display, result.returncode, result.stderr)
+                traced_span.update(attempts=result.attempts, **spanArgs)
+                if result.timedOut:
+                    traced_span.update(timedOut=timeout)
+                if result.error is not None:
+                    traced_span.update(error=result.error)
+        except asyncio.CancelledError:
+            result.cancelled = True
+        finally:
+            result.duration = time.perf_counter() - start
+            with self._lock:
+                self._tasks.discard(task)
+
+        if result.error is not None or (fatal and not result.ok and not result.cancelled):
+            self.cancel(result.describe())
+        return result
+
+    async def _attempt(self, result, input, timeout, cwd, env, stdout, stderr):
+        import asyncio
+        import subprocess
+
+        def stream(value):
+            return subprocess.PIPE if value == PIPE else value
+
+        result.returncode = None
+        result.timedOut = False
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *result.args,
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=stream(stdout),
+                stderr=stream(stderr),
+                cwd=cwd,
+                env=dict(os.environ, **env) if env is not None else None,
+                # commands with a timeout get a process group of their own, so a kill on timeout also takes
+                # down what they started (a wrapper script's children would keep the pipes open);
+                # commands without one stay in the terminal's group, they may prompt
+                start_new_session=timeout is not None,
+            )
+        except OSError as err:
+            # not installed / not executable: fatal, retrying won't help
+            result.error = str(err)
+            return
+
+        try:
+            out, err = await asyncio.wait_for(process.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            result.timedOut = True
+            await kill(process, timeout is not None)
+            return
+        except asyncio.CancelledError:
+            await kill(process, timeout is not None)
+            raise
+
+        result.returncode = process.returncode
+        result.stdout = out or b""
+        result.stderr = err or b""
+
+
+async def kill(process, group):
+    import signal
+
+    if process.returncode is None:
+        try:
+            if group:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
@@ -0,0 +1,202 @@
+# Ansible inventory, host_vars and playbook emitter.
+#
+# The inventory is built as data (inventoryGroups / hostVars) and written in one pass:
+#
+#   static - ansibleInventory lists the group members only, everything about a host
+#            (connection settings, pod_cidr of a worker) goes to host_vars/<host>.yml next to it.
+#   script - ansibleInventory is a small executable that runs this module, Ansible gets groups
+#            and host vars as JSON straight from cluster.json:
+#
+#   python -m kthw.inventory --config ../conf/cluster.json --list
+#   python -m kthw.inventory --config ../conf/cluster.json --host worker-1
+#
+# The playbook template (templates/ansible-playbook.yml) is parsed as YAML and its ${...}
+# placeholders are filled with typed values, values shared by every host stay in its vars.
+
+import os
+import sys
+import json
+import shlex
+import argparse
+from string import Template
+
+from kthw.config import ConfigError, loadConfig
+
+INVENTORY_MODES = ("static", "script")
+
+HOST_VARS_HEADER = "# generated by 04-generate-ansible-files.py\n"
+
+INVENTORY_SCRIPT = """#!/bin/sh
+# generated by 04-generate-ansible-files.py: dynamic inventory of %(config)s
+PYTHONPATH=%(src)s${PYTHONPATH:+:$PYTHONPATH} exec %(python)s -m kthw.inventory --config %(config)s "$@"
+"""
+
+
+class InventoryError(Exception):
+    pass
+
+
+def inventoryGroups(clusterConfig):
+    # {group: [host names]}
+    return {
+        "controllers": [controller['name'] for controller in clusterConfig['controllers']],
+        "workers": [worker['name'] for worker in clusterConfig['workers']],
+    }
+
+
+def hostVars(clusterConfig):
+    # {host name: {var: value}}
+    podCIDR = clusterConfig['ansibleSettings']['podCIDR']
+    variables = {}
+    for host in clusterConfig['controllers'] + clusterConfig['workers']:
+        variables[host['name']] = {"ansible_host": host['externalIP'], "ansible_ssh_user": host['sshUser']}
+        if host['name'] in podCIDR:
+            variables[host['name']]['pod_cidr'] = podCIDR[host['name']]
+
+    return variables
+
+
+def dynamicInventory(clusterConfig):
+    # --list output of a script inventory, the host vars in _meta spare Ansible one call per host
+    inventory = dict((group, {"hosts": hosts}) for group, hosts in inventoryGroups(clusterConfig).items())
+    inventory['_meta'] = {"hostvars": hostVars(clusterConfig)}
+    return inventory
+
+
+def renderInventory(clusterConfig):
+    import yaml
+
+    groups = dict((group, {"hosts": dict((name, None) for name in hosts)}) for group, hosts in inventoryGroups(clusterConfig).items())
+    return "---\n" + yaml.safe_dump(groups, default_flow_style=False, sort_keys=False)
+
+
+def renderHostVars(clusterConfig):
+    # {file name: content} of host_vars/
+    import yaml
+
+    return dict(
+        ("%s.yml" % name, HOST_VARS_HEADER + yaml.safe_dump(variables, default_flow_style=False, sort_keys=False))
+        for name, variables in hostVars(clusterConfig).items()
+    )
+
+
+def renderInventoryScript(configFile):
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return INVENTORY_SCRIPT % {
+        "config": shlex.quote(os.path.abspath(configFile)),
+        "src": shlex.quote(src),
+        "python": shlex.quote(sys.executable),
+    }
+
+
+def etcdVars(etcdServers):
+    # joined once here instead of looping over every etcd server in the templates of each host
+    initialCluster = ",".join("%s=https://%s:2380" % (name, ip) for name, ip in etcdServers.items())
+    serversUrl = ",".join("https://%s:2379" % ip for ip in etcdServers.values())
+    return initialCluster, serversUrl
+
+
+def playbookValues(clusterConfig, delivery="bundle"):
+    ansibleSettings = clusterConfig['ansibleSettings']
+    etcdInitialCluster, etcdServersUrl = etcdVars(ansibleSettings['etcdServers'])
+    return {
+        "etcd_initial_cluster": etcdInitialCluster,
+        "etcd_servers_url": etcdServersUrl,
+        "kubernetes_version": ansibleSettings['kubernetesVersion'],
+        "kubernetes_public_address": clusterConfig['staticExternalIP'],
+        "kube_apiserver_count": ansibleSettings['kubeAPIServerCount'],
+        "cluster_dns": ansibleSettings['clusterDNS'],
+        "cluster_cidr": ansibleSettings['clusterCIDR'],
+        "stream_delivery": delivery == "stream",
+    }
+
+
+def fillNode(node, values):
+    # a string that is a single placeholder takes the value as it is (numbers and booleans stay typed)
+    if isinstance(node, str):
+        if node.startswith("${") and node.endswith("}") and node[2:-1] in values:
+            return values[node[2:-1]]
+        return Template(node).substitute(values) if "$" in node else node
+    if isinstance(node, dict):
+        return dict((key, fillNode(value, values)) for key, value in node.items())
+    if isinstance(node, list):
+        return [fillNode(item, values) for item in node]
+    return node
+
+
+def renderPlaybook(templateFile, values):
+    import yaml
+
+    try:
+        with open(templateFile) as f:
+            plays = yaml.safe_load(f)
+        plays = fillNode(plays, values)
+    except (OSError, yaml.YAMLError) as err:
+        raise InventoryError("failed to read %s: %s" % (templateFile, err))
+    except (KeyError, ValueError) as err:
+        raise InventoryError("%s: no value for %s" % (templateFile, err))
+
+    return "---\n# generated by 04-generate-ansible-files.py from %s\n%s" % (
+        os.path.basename(templateFile),
+        yaml.safe_dump(plays, default_flow_style=False, sort_keys=False),
+    )
+
+
+def writeFile(path, content, mode=0o644):
+    # returns True if the file changed, an unchanged file is left alone
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return False
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.chmod(path, mode)
+    return True
+
+
+def writeHostVars(hostVarsPath, files):
+    # files: {file name: content}; generated files of hosts that are gone are removed
+    os.makedirs(hostVarsPath, exist_ok=True)
+
+    for name, content in files.items():
+        writeFile(os.path.join(hostVarsPath, name), content)
+
+    for filename in os.listdir(hostVarsPath):
+        path = os.path.join(hostVarsPath, filename)
+        if filename.endswith(".yml") and filename not in files:
+            with open(path) as f:
+                generated = f.readline() == HOST_VARS_HEADER
+            if generated:
+                os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kthw.inventory", description="KTHW - Dynamic Ansible inventory.")
+    parser.add_argument("--config", type=str, required=True, help="Specify the path to the Kubernetes cluster config json file.")
+    parser.add_argument("--list", action="store_true", help="Print all groups and host vars (Ansible inventory script protocol).")
+    parser.add_argument("--host", type=str, help="Print the vars of one host.")
+
+    args = parser.parse_args(argv)
+
+    try:
+        clusterConfig = loadConfig(args.config)
+    except ConfigError as err:
+        print("ERROR > %s" % err, file=sys.stderr)
+        return 1
+
+    if args.host is not None:
+        variables = hostVars(clusterConfig)
+        if args.host not in variables:
+            print("ERROR > unknown host %s" % args.host, file=sys.stderr)
+            return 1
+        json.dump(variables[args.host], sys.stdout)
+    else:
+        json.dump(dynamicInventory(clusterConfig), sys.stdout)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
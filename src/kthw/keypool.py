@@ -0,0 +1,245 @@
+# Pool of pre-generated private keys for the native signer.
+#
+#   python -m kthw.keypool fill --pool ~/.cache/kthw/keypool --count 512
+#   python -m kthw.keypool status --pool ~/.cache/kthw/keypool
+#
+# Key generation (RSA in particular) is the slow part of issuing a certificate. The pool
+# generates keys ahead of time on every core and 01-generate-certs.py --key-pool takes one
+# per certificate, so issuing only signs.
+#
+# Layout: <pool>/<algo>-<size>/<id>.pem (PKCS#8, mode 0600), written as .tmp-<id> and renamed
+# in when complete. A key is claimed by renaming it into .claimed/ and deleting it after it was
+# read; rename is atomic, so of two runs racing for the same key only one gets it. Refills
+# are serialised with an flock on <pool>/.lock.
+
+import os
+import sys
+import errno
+import fcntl
+import argparse
+import threading
+
+DEFAULT_POOL = os.path.join(os.path.expanduser("~"), ".cache", "kthw", "keypool")
+DEFAULT_LOW_WATER = 32
+DEFAULT_FILL = 256
+
+CLAIMED_DIR = ".claimed"
+LOCK_FILE = ".lock"
+
+
+class KeyPoolError(Exception):
+    pass
+
+
+def specName(algo, size):
+    return "%s-%s" % (algo, size)
+
+
+def parseSpec(name):
+    algo, _, size = name.rpartition("-")
+    if len(algo) == 0 or not size.isdigit():
+        raise KeyPoolError("invalid key spec %s, expected e.g. rsa-2048" % name)
+    return algo, int(size)
+
+
+def generateKeyPem(algo, size):
+    # runs in the worker processes of fill()
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+
+    if algo == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=size)
+    elif algo == "ecdsa":
+        curves = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+        if size not in curves:
+            raise KeyPoolError("unsupported ecdsa key size: %s" % size)
+        key = ec.generate_private_key(curves[size]())
+    elif algo == "ed25519":
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise KeyPoolError("unsupported key algorithm: %s" % algo)
+
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class KeyPool:
+
+    def __init__(self, directory=DEFAULT_POOL, low_water=DEFAULT_LOW_WATER, fill_to=DEFAULT_FILL):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.low_water = low_water
+        self.fill_to = max(fill_to, low_water)
+        # names of keys seen in the last listing, per spec, so claims don't re-list the directory
+        self._candidates = {}
+        self._lock = threading.Lock()
+        self.claimed = {}
+        self.missed = {}
+
+    def _specDir(self, algo, size):
+        path = os.path.join(self.directory, specName(algo, size))
+        for directory in (self.directory, path, os.path.join(path, CLAIMED_DIR)):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        return path
+
+    def _keys(self, path):
+        return sorted(entry.name for entry in os.scandir(path) if entry.name.endswith(".pem") and entry.is_file())
+
+    def available(self, algo, size):
+        path = os.path.join(self.directory, specName(algo, size))
+        return len(self._keys(path)) if os.path.isdir(path) else 0
+
+    def claim(self, algo, size):
+        # PEM of an unused key, removed from the pool, or None when the pool is empty
+        spec = (algo, size)
+        with self._lock:
+            path = self._specDir(algo, size)
+            for attempt in range(2):
+                candidates = self._candidates.get(spec)
+                if not candidates:
+                    candidates = self._candidates[spec] = self._keys(path)
+
+                while len(candidates) > 0:
+                    name = candidates.pop()
+                    claimed = os.path.join(path, CLAIMED_DIR, "%d-%s" % (os.getpid(), name))
+                    try:
+                        os.rename(os.path.join(path, name), claimed)
+                    except FileNotFoundError:
+                        # another run got it first
+                        continue
+
+                    with open(claimed, "rb") as f:
+                        pem = f.read()
+                    os.remove(claimed)
+                    self.claimed[spec] = self.claimed.get(spec, 0) + 1
+                    return pem
+
+            self.missed[spec] = self.missed.get(spec, 0) + 1
+            return None
+
+    def fill(self, algo, size, count=None, jobs=None, wait=True):
+        # Generate keys until the pool holds fill_to (or `count` more), returns how many were added.
+        # With wait=False it returns 0 right away if another process is already filling.
+        import concurrent.futures
+
+        path = self._specDir(algo, size)
+        with open(os.path.join(self.directory, LOCK_FILE), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            self._cleanClaimed(path)
+            missing = count if count is not None else self.fill_to - len(self._keys(path))
+            if missing <= 0:
+                return 0
+
+            added = 0
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+                for pem in pool.map(generateKeyPem, [algo] * missing, [size] * missing, chunksize=8):
+                    self._add(path, pem)
+                    added += 1
+
+            return added
+
+    def _add(self, path, pem):
+        name = os.urandom(16).hex()
+        tmp = os.path.join(path, ".tmp-" + name)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pem)
+        os.rename(tmp, os.path.join(path, name + ".pem"))
+
+    def _cleanClaimed(self, path):
+        # keys claimed by runs that died before deleting them are never handed out again
+        claimed = os.path.join(path, CLAIMED_DIR)
+        for name in os.listdir(claimed):
+            pid = name.split("-", 1)[0]
+            if not pid.isdigit() or not processAlive(int(pid)):
+                os.remove(os.path.join(claimed, name))
+        for name in os.listdir(path):
+            if name.startswith(".tmp-"):
+                os.remove(os.path.join(path, name))
+
+    def refillInBackground(self):
+        # Start a detached `fill` for every spec this run took keys of (or wanted and missed)
+        # that is below the low-water mark; returns the specs being refilled.
+        import subprocess
+
+        refilled = []
+        for algo, size in sorted(set(self.claimed) | set(self.missed)):
+            if self.available(algo, size) >= self.low_water:
+                continue
+            subprocess.Popen(
+                [
+                    sys.executable, "-m", "kthw.keypool", "fill",
+                    "--pool", self.directory,
+                    "--spec", specName(algo, size),
+                    "--fill-to", str(self.fill_to),
+                    "--no-wait",
+                ],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            refilled.append(specName(algo, size))
+
+        return refilled
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kthw.keypool", description="KTHW - Pre-generated private keys.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    fill_parser = subparsers.add_parser("fill", help="Generate keys into the pool.")
+    status_parser = subparsers.add_parser("status", help="Show how many keys the pool holds.")
+    for sub in (fill_parser, status_parser):
+        sub.add_argument("--pool", type=str, default=DEFAULT_POOL, help="Pool directory (default: %s)." % DEFAULT_POOL)
+
+    fill_parser.add_argument("--spec", type=str, default="rsa-2048", help="Key algorithm and size (default: rsa-2048).")
+    fill_parser.add_argument("--count", type=int, help="Generate this many keys (default: up to --fill-to).")
+    fill_parser.add_argument("--fill-to", type=int, default=DEFAULT_FILL, help="Fill the pool up to this many keys (default: %d)." % DEFAULT_FILL)
+    fill_parser.add_argument("--jobs", type=int, help="Worker processes (default: one per core).")
+    fill_parser.add_argument("--no-wait", action="store_true", help="Do nothing if another fill is running.")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "fill":
+        try:
+            algo, size = parseSpec(args.spec)
+            pool = KeyPool(args.pool, low_water=0, fill_to=args.fill_to)
+            added = pool.fill(algo, size, count=args.count, jobs=args.jobs, wait=not args.no_wait)
+        except (OSError, KeyPoolError) as err:
+            print("ERROR > %s" % err)
+            return 1
+        print("%d %s keys added, %d available." % (added, args.spec, pool.available(algo, size)))
+        return 0
+
+    if args.command == "status":
+        pool = KeyPool(args.pool)
+        specs = sorted(name for name in os.listdir(pool.directory) if not name.startswith(".")) if os.path.isdir(pool.directory) else []
+        if len(specs) == 0:
+            print("%s is empty." % pool.directory)
+        for name in specs:
+            algo, size = parseSpec(name)
+            print("%-12s %d" % (name, pool.available(algo, size)))
+        return 0
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
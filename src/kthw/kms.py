@@ -0,0 +1,491 @@
+# Local KMS v2 plugin for the kube-apiserver (encryptionProvider "kms").
+#
+#   python -m kthw.kms serve --socket /var/run/kthw-kms/kms.sock --key-file /var/lib/kthw-kms/kek
+#   python -m kthw.kms rotate --key-file /var/lib/kthw-kms/kek
+#   python -m kthw.kms bench [--socket /var/run/kthw-kms/kms.sock] [--count 2000]
+#
+# With KMS v2 the apiserver encrypts secrets itself with a data encryption key (DEK) and only
+# asks the plugin to wrap that DEK, once per DEK and not once per write: the plugin is on the
+# path of apiserver startup and key rotation, not of every secret.
+#
+# The plugin speaks the KeyManagementService gRPC API (k8s.io/kms/apis/v2, package v2 and the
+# v2beta1 of Kubernetes 1.27/1.28) on a unix socket. The messages are small enough to be
+# encoded here, only grpcio is needed. DEKs are wrapped with AES-GCM under a key encryption key
+# (KEK) of 32 random bytes from --key-file: one base64 key per line, the first one wraps and
+# every one unwraps. `rotate` puts a new key first; the plugin reloads the file when it changes
+# and reports the new key_id from Status, which makes the apiserver switch to a new DEK.
+#
+# This is a stand-in that keeps the KEK on the controller, it is there to measure the
+# encryption overhead of the apiserver, not to hold keys for compliance. Every call is
+# counted: calls, errors, bytes and a latency histogram per method, printed on exit and
+# served in the Prometheus text format with --metrics 127.0.0.1:9464.
+
+import os
+import sys
+import time
+import base64
+import hashlib
+import argparse
+import threading
+
+DEFAULT_SOCKET = "/var/run/kthw-kms/kms.sock"
+DEFAULT_KEY_FILE = "/var/lib/kthw-kms/kek"
+
+# of the kms provider entries in the encryption config, see kthw/encryption.py
+ENDPOINT = "unix://" + DEFAULT_SOCKET
+TIMEOUT = "3s"
+
+SERVICES = ("v2.KeyManagementService", "v2beta1.KeyManagementService")
+METHODS = ("Status", "Encrypt", "Decrypt")
+
+KEK_BYTES = 32
+NONCE_BYTES = 12
+
+# latency histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+class KmsError(Exception):
+    pass
+
+
+# protobuf wire format, enough for the KMS messages: varints, bytes / string fields and
+# map<string, bytes> (repeated entries with key = 1, value = 2)
+
+def encodeVarint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decodeVarint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise KmsError("truncated message")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def encodeMessage(fields):
+    # fields: [(number, str / bytes / {str: bytes})], empty values are left out like proto3 does
+    out = bytearray()
+    for number, value in fields:
+        if isinstance(value, dict):
+            for key, item in sorted(value.items()):
+                out += encodeVarint(number << 3 | 2)
+                entry = encodeMessage([(1, key), (2, item)])
+                out += encodeVarint(len(entry)) + entry
+            continue
+        if isinstance(value, str):
+            value = value.encode()
+        if len(value) > 0:
+            out += encodeVarint(number << 3 | 2) + encodeVarint(len(value)) + value
+    return bytes(out)
+
+
+def decodeMessage(data):
+    # {field number: [bytes]} of the length delimited fields, other wire types are skipped
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        tag, offset = decodeVarint(data, offset)
+        wire = tag & 7
+        if wire == 0:
+            value, offset = decodeVarint(data, offset)
+            continue
+        if wire == 1 or wire == 5:
+            offset += 8 if wire == 1 else 4
+            continue
+        if wire != 2:
+            raise KmsError("unsupported wire type %d" % wire)
+        size, offset = decodeVarint(data, offset)
+        if offset + size > len(data):
+            raise KmsError("truncated message")
+        fields.setdefault(tag >> 3, []).append(bytes(data[offset:offset + size]))
+        offset += size
+    return fields
+
+
+def field(fields, number, default=b""):
+    return fields.get(number, [default])[-1]
+
+
+# key encryption keys
+
+def keyId(kek):
+    return "kthw-" + hashlib.sha256(kek).hexdigest()[:16]
+
+
+def loadKeys(keyFile):
+    # [(key_id, kek)], the first one wraps
+    try:
+        with open(keyFile) as f:
+            keys = [base64.b64decode(line.strip()) for line in f if line.strip() and not line.startswith("#")]
+    except (OSError, ValueError) as err:
+        raise KmsError("failed to read %s: %s" % (keyFile, err))
+
+    for kek in keys:
+        if len(kek) != KEK_BYTES:
+            raise KmsError("%s: keys must be %d bytes" % (keyFile, KEK_BYTES))
+    if len(keys) == 0:
+        raise KmsError("%s holds no key" % keyFile)
+
+    return [(keyId(kek), kek) for kek in keys]
+
+
+def rotateKeys(keyFile, keep=None):
+    # put a new KEK first, keep the `keep` newest old ones (default: all); returns the new key_id
+    keys = [kek for key_id, kek in loadKeys(keyFile)] if os.path.exists(keyFile) else []
+    keys = [os.urandom(KEK_BYTES)] + keys[:keep]
+
+    os.makedirs(os.path.dirname(os.path.abspath(keyFile)), mode=0o700, exist_ok=True)
+    tmp = "%s.tmp-%d" % (keyFile, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write("".join(base64.b64encode(kek).decode() + "\n" for kek in keys))
+    os.replace(tmp, keyFile)
+    return keyId(keys[0])
+
+
+class Counters:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.methods = dict((method, {"calls": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "bytesIn": 0, "bytesOut": 0,
+                                      "buckets": [0] * len(BUCKETS)}) for method in METHODS)
+
+    def record(self, method, seconds, bytesIn, bytesOut, failed):
+        with self._lock:
+            stats = self.methods[method]
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['bytesIn'] += bytesIn
+            stats['bytesOut'] += bytesOut
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][index] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((method, dict(stats, buckets=list(stats['buckets']))) for method, stats in self.methods.items())
+
+    def prometheus(self):
+        lines = [
+            "# HELP kthw_kms_requests_total KMS plugin calls.",
+            "# TYPE kthw_kms_requests_total counter",
+        ]
+        snapshot = self.snapshot()
+        for method, stats in snapshot.items():
+            lines.append('kthw_kms_requests_total{method="%s"} %d' % (method, stats['calls']))
+        lines += ["# HELP kthw_kms_errors_total Failed KMS plugin calls.", "# TYPE kthw_kms_errors_total counter"]
+        for method, stats in snapshot.items():
+            lines.append('kthw_kms_errors_total{method="%s"} %d' % (method, stats['errors']))
+        lines += ["# HELP kthw_kms_bytes_total Payload bytes in and out.", "# TYPE kthw_kms_bytes_total counter"]
+        for method, stats in snapshot.items():
+            lines.append('kthw_kms_bytes_total{method="%s",direction="in"} %d' % (method, stats['bytesIn']))
+            lines.append('kthw_kms_bytes_total{method="%s",direction="out"} %d' % (method, stats['bytesOut']))
+        lines += ["# HELP kthw_kms_request_seconds KMS plugin call latency.", "# TYPE kthw_kms_request_seconds histogram"]
+        for method, stats in snapshot.items():
+            for bound, count in zip(BUCKETS, stats['buckets']):
+                lines.append('kthw_kms_request_seconds_bucket{method="%s",le="%g"} %d' % (method, bound, count))
+            lines.append('kthw_kms_request_seconds_bucket{method="%s",le="+Inf"} %d' % (method, stats['calls']))
+            lines.append('kthw_kms_request_seconds_sum{method="%s"} %.6f' % (method, stats['seconds']))
+            lines.append('kthw_kms_request_seconds_count{method="%s"} %d' % (method, stats['calls']))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        lines = ["  %-8s %8s %7s %10s %10s %9s" % ("method", "calls", "errors", "avg [ms]", "max [ms]", "calls/s")]
+        for method, stats in self.snapshot().items():
+            lines.append("  %-8s %8d %7d %10.3f %10.3f %9.1f" % (
+                method, stats['calls'], stats['errors'],
+                stats['seconds'] / stats['calls'] * 1000 if stats['calls'] else 0.0,
+                stats['max'] * 1000, stats['calls'] / elapsed,
+            ))
+        return "\n".join(lines)
+
+
+class Plugin:
+    # The KMS calls on raw protobuf bytes. The key file is re-read when it changes.
+
+    def __init__(self, keyFile, counters=None):
+        self.keyFile = keyFile
+        self.counters = counters or Counters()
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._keys = []
+        self._aead = {}
+        self.keys()
+
+    def keys(self):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        stat = os.stat(self.keyFile)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if stamp != self._stamp:
+                self._keys = loadKeys(self.keyFile)
+                self._aead = dict((key_id, AESGCM(kek)) for key_id, kek in self._keys)
+                self._stamp = stamp
+            return self._keys, self._aead
+
+    def status(self, request):
+        keys, aead = self.keys()
+        return encodeMessage([(1, "v2"), (2, "ok"), (3, keys[0][0])])
+
+    def encrypt(self, request):
+        fields = decodeMessage(request)
+        keys, aead = self.keys()
+        key_id = keys[0][0]
+        nonce = os.urandom(NONCE_BYTES)
+        ciphertext = nonce + aead[key_id].encrypt(nonce, field(fields, 1), key_id.encode())
+        return encodeMessage([(1, ciphertext), (2, key_id)])
+
+    def decrypt(self, request):
+        from cryptography.exceptions import InvalidTag
+
+        fields = decodeMessage(request)
+        key_id = field(fields, 3).decode()
+        ciphertext = field(fields, 1)
+        keys, aead = self.keys()
+        if key_id not in aead:
+            raise KmsError("unknown key_id %s" % key_id)
+        try:
+            plaintext = aead[key_id].decrypt(ciphertext[:NONCE_BYTES], ciphertext[NONCE_BYTES:], key_id.encode())
+        except InvalidTag:
+            raise KmsError("ciphertext of %s does not verify" % key_id)
+        return encodeMessage([(1, plaintext)])
+
+    def handler(self, method):
+        # grpc unary handler of method, counted
+        import grpc
+
+        function = {"Status": self.status, "Encrypt": self.encrypt, "Decrypt": self.decrypt}[method]
+
+        def handle(request, context):
+            start = time.perf_counter()
+            response = None
+            try:
+                response = function(request)
+                return response
+            except (KmsError, OSError) as err:
+                context.abort(grpc.StatusCode.INTERNAL, str(err))
+            finally:
+                self.counters.record(method, time.perf_counter() - start, len(request), len(response or b""), response is None)
+
+        return grpc.unary_unary_rpc_method_handler(handle)
+
+
+def startServer(plugin, socket, workers=8):
+    # grpc server of plugin on the unix socket, started
+    import grpc
+    import concurrent.futures
+
+    os.makedirs(os.path.dirname(os.path.abspath(socket)), mode=0o700, exist_ok=True)
+    if os.path.exists(socket):
+        os.remove(socket)
+
+    server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+    for service in SERVICES:
+        server.add_generic_rpc_handlers([
+            grpc.method_handlers_generic_handler(service, dict((method, plugin.handler(method)) for method in METHODS))
+        ])
+    if server.add_insecure_port("unix:" + os.path.abspath(socket)) == 0:
+        raise KmsError("cannot listen on %s" % socket)
+    server.start()
+    return server
+
+
+def startMetrics(counters, address):
+    # Prometheus text format on http://address/metrics, in a daemon thread
+    import http.server
+
+    host, _, port = address.rpartition(":")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = counters.prometheus().encode()
+            self.send_response(200 if self.path == "/metrics" else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Client:
+    # KMS calls over the socket, as the apiserver makes them
+
+    def __init__(self, socket, service=SERVICES[0]):
+        import grpc
+
+        self.channel = grpc.insecure_channel("unix:" + os.path.abspath(socket))
+        self.calls = dict(
+            (method, self.channel.unary_unary("/%s/%s" % (service, method))) for method in METHODS
+        )
+
+    def status(self):
+        fields = decodeMessage(self.calls['Status'](b"", timeout=3))
+        return field(fields, 1).decode(), field(fields, 2).decode(), field(fields, 3).decode()
+
+    def encrypt(self, plaintext, uid=""):
+        fields = decodeMessage(self.calls['Encrypt'](encodeMessage([(1, plaintext), (2, uid)]), timeout=3))
+        return field(fields, 1), field(fields, 2).decode()
+
+    def decrypt(self, ciphertext, key_id, uid=""):
+        fields = decodeMessage(self.calls['Decrypt'](encodeMessage([(1, ciphertext), (2, uid), (3, key_id)]), timeout=3))
+        return field(fields, 1)
+
+    def close(self):
+        self.channel.close()
+
+
+def bench(socket, count, size):
+    # Encrypt + Decrypt round trips of a `size` byte DEK over the socket, returns
+    # {encrypt / decrypt: {p50, p99, max [ms]}, callsPerSecond}
+    client = Client(socket)
+    try:
+        client.status()
+        latencies = {"encrypt": [], "decrypt": []}
+        start = time.perf_counter()
+        for i in range(count):
+            dek = os.urandom(size)
+            begin = time.perf_counter()
+            ciphertext, key_id = client.encrypt(dek)
+            middle = time.perf_counter()
+            if client.decrypt(ciphertext, key_id) != dek:
+                raise KmsError("decrypted DEK differs")
+            latencies['encrypt'].append(middle - begin)
+            latencies['decrypt'].append(time.perf_counter() - middle)
+        elapsed = time.perf_counter() - start
+    finally:
+        client.close()
+
+    result = {"callsPerSecond": 2 * count / elapsed}
+    for name, values in latencies.items():
+        values.sort()
+        result[name] = {
+            "p50": values[len(values) // 2] * 1000,
+            "p99": values[min(len(values) - 1, len(values) * 99 // 100)] * 1000,
+            "max": values[-1] * 1000,
+        }
+    return result
+
+
+def serve(args):
+    import signal
+
+    if not os.path.exists(args.key_file):
+        print("> New key %s in %s." % (rotateKeys(args.key_file), args.key_file))
+
+    counters = Counters()
+    plugin = Plugin(args.key_file, counters)
+    server = startServer(plugin, args.socket, args.workers)
+    if args.metrics:
+        startMetrics(counters, args.metrics)
+    print("KMS v2 plugin listening on unix://%s, key %s." % (os.path.abspath(args.socket), plugin.keys()[0][0][0]))
+    sys.stdout.flush()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    stop.wait()
+    server.stop(grace=2).wait()
+    print(counters.summary())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m kthw.kms", description="KTHW - Local KMS v2 plugin.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Run the plugin.")
+    rotate_parser = subparsers.add_parser("rotate", help="Put a new key encryption key first.")
+    bench_parser = subparsers.add_parser("bench", help="Measure Encrypt / Decrypt round trips.")
+
+    for sub in (serve_parser, bench_parser):
+        sub.add_argument("--socket", type=str, help="Unix socket (default: %s, bench: a plugin of its own)." % DEFAULT_SOCKET)
+    for sub in (serve_parser, rotate_parser):
+        sub.add_argument("--key-file", type=str, default=DEFAULT_KEY_FILE, help="Key encryption keys (default: %s)." % DEFAULT_KEY_FILE)
+    serve_parser.add_argument("--workers", type=int, default=8, help="Threads serving calls (default: 8).")
+    serve_parser.add_argument("--metrics", type=str, help="Serve the counters on http://<host:port>/metrics.")
+    rotate_parser.add_argument("--keep", type=int, help="Old keys to keep for unwrapping (default: all).")
+    bench_parser.add_argument("--count", type=int, default=2000, help="Encrypt + Decrypt round trips (default: 2000).")
+    bench_parser.add_argument("--size", type=int, default=32, help="Bytes per DEK (default: 32).")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "serve":
+            args.socket = args.socket or DEFAULT_SOCKET
+            serve(args)
+            return 0
+
+        if args.command == "rotate":
+            print("> New key %s in %s." % (rotateKeys(args.key_file, args.keep), args.key_file))
+            return 0
+
+        if args.command == "bench":
+            import tempfile
+            import shutil
+
+            directory = None
+            server = None
+            counters = Counters()
+            if args.socket is None:
+                # a plugin of its own on a temporary socket and key
+                directory = tempfile.mkdtemp(prefix="kthw-kms-")
+                args.socket = os.path.join(directory, "kms.sock")
+                rotateKeys(os.path.join(directory, "kek"))
+                server = startServer(Plugin(os.path.join(directory, "kek"), counters), args.socket)
+            try:
+                result = bench(args.socket, args.count, args.size)
+            finally:
+                if server is not None:
+                    server.stop(grace=None)
+                if directory is not None:
+                    shutil.rmtree(directory, ignore_errors=True)
+
+            print(":: KMS v2 round trips over %s, %d x %d byte DEKs" % (args.socket, args.count, args.size))
+            print("  %-8s %10s %10s %10s" % ("call", "p50 [ms]", "p99 [ms]", "max [ms]"))
+            for name in ("encrypt", "decrypt"):
+                print("  %-8s %10.3f %10.3f %10.3f" % (name, result[name]['p50'], result[name]['p99'], result[name]['max']))
+            print("  %.0f calls/s" % result['callsPerSecond'])
+            if server is not None:
+                print(":: Plugin side")
+                print(counters.summary())
+            return 0
+    except ImportError as err:
+        print("ERROR > %s, the KMS plugin needs grpcio (python -m pip install grpcio)." % err)
+        return 1
+    except (OSError, KmsError) as err:
+        print("ERROR > %s" % err)
+        return 1
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# Kubeconfig writers used by 02-generate-kubeconfig.py.
+#
+#   native  - builds the kubeconfig in-process and writes it in one pass, with the
+#             certificates embedded straight from the PEM files.
+#   kubectl - the original `kubectl config set-cluster/set-credentials/set-context/use-context` calls,
+#             run by the executor of the stage (kthw/executor.py) with a timeout.
+
+import os
+import base64
+import functools
+import threading
+
+from kthw.executor import CommandError, Executor
+
+BACKENDS = ("native", "kubectl")
+
+# per kubectl call, a timed out call is retried
+KUBECTL_TIMEOUT = 30.0
+KUBECTL_RETRIES = 2
+
+
+class KubeconfigError(Exception):
+    pass
+
+
+_pem_cache = {}
+_pem_lock = threading.Lock()
+
+
+def readPem(path):
+    # ca.pem is embedded in every kubeconfig, read it only once per version of the file:
+    # a certificate re-issued in the same process (kthw multi, kthw.bench) is read again
+    path = os.path.abspath(path)
+    with _pem_lock:
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime_ns)
+            if key not in _pem_cache:
+                with open(path, "rb") as f:
+                    _pem_cache[key] = f.read()
+        except OSError as err:
+            raise KubeconfigError("failed to read %s: %s" % (path, err))
+
+        return _pem_cache[key]
+
+
+def buildKubeconfig(cluster_name, server, ca_pem, user, client_cert_pem, client_key_pem, context="default"):
+    # Same structure `kubectl config ... --embed-certs=true` produces.
+    return {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "preferences": {},
+        "clusters": [
+            {
+                "name": cluster_name,
+                "cluster": {
+                    "certificate-authority-data": base64.b64encode(ca_pem).decode("ascii"),
+                    "server": server,
+                },
+            }
+        ],
+        "users": [
+            {
+                "name": user,
+                "user": {
+                    "client-certificate-data": base64.b64encode(client_cert_pem).decode("ascii"),
+                    "client-key-data": base64.b64encode(client_key_pem).decode("ascii"),
+                },
+            }
+        ],
+        "contexts": [
+            {
+                "name": context,
+                "context": {
+                    "cluster": cluster_name,
+                    "user": user,
+                },
+            }
+        ],
+        "current-context": context,
+    }
+
+
+def renderKubeconfig(kubeconfig):
+    import yaml
+
+    return yaml.safe_dump(kubeconfig, default_flow_style=False, width=float("inf"))
+
+
+def writeKubeconfig(path, cluster_name, server, ca_file, user, client_cert_file, client_key_file, context="default"):
+    data = renderKubeconfig(
+        buildKubeconfig(
+            cluster_name,
+            server,
+            readPem(ca_file),
+            user,
+            readPem(client_cert_file),
+            readPem(client_key_file),
+            context,
+        )
+    )
+
+    # kubectl creates kubeconfig files readable by the owner only
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+    except OSError as err:
+        raise KubeconfigError("failed to write %s: %s" % (path, err))
+
+
+def kubectlKubeconfig(path, cluster_name, server, ca_file, user, client_cert_file, client_key_file, context="default", executor=None):
+    commands = [
+        [
+            "kubectl", "config", "set-cluster", cluster_name,
+            "--certificate-authority=%s" % ca_file,
+            "--embed-certs=true",
+            "--server=%s" % server,
+            "--kubeconfig=%s" % path,
+        ],
+        [
+            "kubectl", "config", "set-credentials", user,
+            "--client-certificate=%s" % client_cert_file,
+            "--client-key=%s" % client_key_file,
+            "--embed-certs=true",
+            "--kubeconfig=%s" % path,
+        ],
+        [
+            "kubectl", "config", "set-context", context,
+            "--cluster=%s" % cluster_name,
+            "--user=%s" % user,
+            "--kubeconfig=%s" % path,
+        ],
+        ["kubectl", "config", "use-context", context, "--kubeconfig=%s" % path],
+    ]
+
+    executor = executor or kubectlExecutor()
+    for args in commands:
+        # a failed call fails this file; a kubectl that can't be started at all cancels every other file's calls
+        try:
+            executor.run(args)
+        except CommandError as err:
+            raise KubeconfigError(str(err))
+
+    checkKubeconfig(path, cluster_name, server, user, context)
+
+
+def checkKubeconfig(path, cluster_name, server, user, context):
+    # the file kubectl wrote has the cluster, user and current context asked for, whatever kubectl printed
+    import yaml
+
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as err:
+        raise KubeconfigError("failed to read %s: %s" % (path, err))
+
+    def entry(section, name):
+        for item in data.get(section) or []:
+            if item.get('name') == name:
+                return item.get(section[:-1]) or {}
+        return None
+
+    cluster = entry("clusters", cluster_name)
+    credentials = entry("users", user)
+    selected = entry("contexts", context)
+    if cluster is None or cluster.get('server') != server or 'certificate-authority-data' not in cluster:
+        raise KubeconfigError("%s: cluster %s with server %s and embedded CA missing" % (path, cluster_name, server))
+    if credentials is None or 'client-certificate-data' not in credentials or 'client-key-data' not in credentials:
+        raise KubeconfigError("%s: user %s with embedded certificate and key missing" % (path, user))
+    if selected is None or selected.get('cluster') != cluster_name or selected.get('user') != user:
+        raise KubeconfigError("%s: context %s for %s / %s missing" % (path, context, cluster_name, user))
+    if data.get('current-context') != context:
+        raise KubeconfigError("%s: current context is %s, not %s" % (path, data.get('current-context'), context))
+
+
+def kubectlExecutor(timeout=None):
+    return Executor(timeout=timeout or KUBECTL_TIMEOUT, retries=KUBECTL_RETRIES)
+
+
+def getWriter(backend, timeout=None):
+    if backend == "native":
+        return writeKubeconfig
+    if backend == "kubectl":
+        # one executor for every file of the stage
+        return functools.partial(kubectlKubeconfig, executor=kubectlExecutor(timeout))
+
+    raise KubeconfigError("unknown kubeconfig backend: %s" % backend)
@@ -0,0 +1,159 @@
+# Input manifests for incremental certificate and kubeconfig regeneration.
+#
+# For every issued certificate the manifest records a digest of what went into it
+# (rendered CSR, hostnames/IPs, CA fingerprint, signing profile) and when it expires.
+# A certificate is re-issued only if one of those inputs changed, one of its files
+# is missing, or it is about to expire.
+#
+# Likewise for every kubeconfig file: server URL, user, writer backend and the digests of
+# the CA and client certificate / key it embeds. It is rewritten only if one of them changed.
+
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+MANIFEST_FILE = ".certs-manifest.json"
+KUBECONFIG_MANIFEST_FILE = ".kubeconfig-manifest.json"
+
+
+def fileDigest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def dataDigest(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def certFiles(directory, name):
+    return [
+        os.path.join(directory, name + ".pem"),
+        os.path.join(directory, name + "-key.pem"),
+    ]
+
+
+class Manifest:
+    # {name: entry} kept in <directory>/<filename> under `section`
+
+    section = None
+
+    def __init__(self, directory, filename, incremental=False):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.incremental = incremental
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f).get(self.section, {})
+        except (OSError, ValueError):
+            # an unreadable manifest just means everything gets regenerated
+            self.entries = {}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({self.section: self.entries}, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class CertManifest(Manifest):
+
+    section = "certificates"
+
+    def __init__(self, directory, incremental=False, renew_before=None):
+        Manifest.__init__(self, directory, MANIFEST_FILE, incremental)
+        self.renew_before = renew_before or datetime.timedelta(0)
+
+    def inputs(self, csr, hostnames, ca_fingerprint, profile, profile_settings, key_spec=None):
+        inputs = {
+            "csr": dataDigest(csr),
+            "hostnames": list(hostnames) if hostnames is not None else None,
+            "ca": ca_fingerprint,
+            "profile": profile,
+            "profileSettings": dataDigest(profile_settings),
+        }
+        # only set when it overrides the key of the CSR, manifests of the default keys stay as they were
+        if key_spec is not None:
+            inputs["key"] = dict(key_spec)
+        return inputs
+
+    def isCurrent(self, name, inputs):
+        # only an incremental run may keep an existing certificate
+        if not self.incremental:
+            return False
+
+        entry = self.entries.get(name)
+        if entry is None or entry.get("inputs") != inputs:
+            return False
+
+        if not all(os.path.exists(path) for path in certFiles(self.directory, name)):
+            return False
+
+        expires = datetime.datetime.fromisoformat(entry["expires"])
+        return expires - datetime.datetime.now(datetime.timezone.utc) > self.renew_before
+
+    def record(self, name, inputs, expires):
+        with self._lock:
+            self.entries[name] = {"inputs": inputs, "expires": expires.isoformat()}
+
+    def prune(self, keep):
+        # drop certificates no longer part of the cluster (e.g. a removed worker)
+        removed = []
+        with self._lock:
+            for name in sorted(set(self.entries) - set(keep)):
+                for path in certFiles(self.directory, name) + [
+                    os.path.join(self.directory, name + ".csr"),
+                    os.path.join(self.directory, name + "-csr.json"),
+                ]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                del self.entries[name]
+                removed.append(name)
+        return removed
+
+
+class KubeconfigManifest(Manifest):
+
+    section = "kubeconfigs"
+
+    def __init__(self, directory, incremental=False, backend="native"):
+        Manifest.__init__(self, directory, KUBECONFIG_MANIFEST_FILE, incremental)
+        self.backend = backend
+
+    def inputs(self, cluster_name, server, user, ca_file, client_cert_file, client_key_file):
+        return {
+            "cluster": cluster_name,
+            "server": server,
+            "user": user,
+            "ca": fileDigest(ca_file),
+            "cert": fileDigest(client_cert_file),
+            "key": fileDigest(client_key_file),
+            "backend": self.backend,
+        }
+
+    def isCurrent(self, name, inputs):
+        if not self.incremental:
+            return False
+
+        entry = self.entries.get(name)
+        return entry is not None and entry.get("inputs") == inputs and os.path.exists(os.path.join(self.directory, name + ".kubeconfig"))
+
+    def record(self, name, inputs):
+        with self._lock:
+            self.entries[name] = {"inputs": inputs}
+
+    def prune(self, keep):
+        # entries of kubeconfig files no longer part of the cluster, the files are removed by the caller
+        with self._lock:
+            removed = sorted(set(self.entries) - set(keep))
+            for name in removed:
+                del self.entries[name]
+        return removed
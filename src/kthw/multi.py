@@ -0,0 +1,168 @@
+# Builds for many clusters at once: python -m kthw multi --out ../build ../conf/teams/
+#
+# Every cluster config (a directory stands for the *.json files in it) gets its own output
+# tree <out>/<config name>/ with a derived cluster.json whose certificatesPath, k8sConfPath,
+# ansibleInventory and ansiblePlaybook point into that tree, so clusters never share a path.
+# The allocated addresses are written out in it, the state file of the original config keeps
+# them stable.
+#
+# Each cluster is built by its own `python -m kthw build` process (one CPU each, the native
+# signer is CPU bound) with its output in <tree>/build.log; --parallel caps how many run at
+# the same time. A combined report is printed at the end and written to <out>/report.json.
+
+import os
+import sys
+import json
+import time
+
+from kthw.config import ConfigError, configData, loadConfig
+from kthw.pipeline import SRC_PATH, StageError, selectStages
+from kthw.executor import Executor
+
+# artifact stages only, the playbook and kubectl stages act on the hosts
+DEFAULT_STAGES = "certs,kubeconfig,encryption,ansible"
+
+LOG_FILE = "build.log"
+REPORT_FILE = "report.json"
+
+
+def configFiles(paths):
+    # config files of the given files and directories, state files left out
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(".json") and not name.endswith(".state.json")
+            )
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            raise StageError("%s not found" % path)
+
+    if len(files) == 0:
+        raise StageError("no cluster configs in %s" % ", ".join(paths))
+
+    return files
+
+
+def clusterName(configFile):
+    return os.path.splitext(os.path.basename(configFile))[0]
+
+
+def deriveConfig(configFile, tree):
+    # Write <tree>/cluster.json, the validated config of configFile with its outputs in tree.
+    data = configData(loadConfig(configFile, save=True))
+    data.update({
+        "certificatesPath": os.path.join(tree, "k8s-certs"),
+        "k8sConfPath": os.path.join(tree, "k8s-conf"),
+        "ansibleInventory": os.path.join(tree, "ansible", "ansible-hosts"),
+        "ansiblePlaybook": os.path.join(tree, "ansible", "k8s-thw-cluster-playbook.yml"),
+    })
+
+    os.makedirs(os.path.join(tree, "ansible"), exist_ok=True)
+    path = os.path.join(tree, "cluster.json")
+    content = json.dumps([data], indent=4) + "\n"
+    # an unchanged file keeps its mtime
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return path
+
+    with open(path, "w") as f:
+        f.write(content)
+
+    return path
+
+
+def buildCluster(name, configFile, tree, options, executor):
+    # Run the build of one cluster, returns its report.
+    start = time.perf_counter()
+    report = {"cluster": name, "config": configFile, "tree": tree, "succeeded": False, "elapsed": 0.0, "stages": [], "error": None}
+
+    try:
+        derived = deriveConfig(configFile, tree)
+    except (OSError, ConfigError) as err:
+        report['error'] = str(err)
+        return report
+
+    reportFile = os.path.join(tree, REPORT_FILE)
+    if os.path.exists(reportFile):
+        os.remove(reportFile)
+
+    command = [sys.executable, "-m", "kthw", "build", "--config", derived, "--report", reportFile, "--parallel", "1", "--jobs", "1"] + options
+    with open(os.path.join(tree, LOG_FILE), "w") as log:
+        result = executor.run(command, check=False, cwd=SRC_PATH, stdout=log, stderr=log, spanArgs={"cluster": name})
+    returncode = result.returncode
+    if returncode is None:
+        # not started, or cancelled because another build could not be started
+        report['error'] = result.describe()
+        returncode = 1
+
+    if os.path.exists(reportFile):
+        with open(reportFile) as f:
+            report.update(json.load(f), cluster=name, config=configFile, tree=tree)
+    if returncode != 0 and report['error'] is None:
+        failed = [stage for stage in report['stages'] if stage['error'] is not None]
+        report['error'] = "%s: %s" % (failed[0]['stage'], failed[0]['error']) if len(failed) > 0 else "build exited with %s" % returncode
+        report['error'] += ", see %s" % os.path.join(tree, LOG_FILE)
+
+    report['succeeded'] = returncode == 0
+    report['elapsed'] = time.perf_counter() - start
+    return report
+
+
+def printReport(reports, stages, elapsed):
+    print()
+    print(":: Cluster builds")
+    print("  %-24s %8s  %s  %s" % ("cluster", "total", " ".join("%10s" % stage for stage in stages), "result"))
+    for report in reports:
+        walls = dict((stage['stage'], stage['wall']) for stage in report['stages'])
+        print("  %-24s %7.2fs  %s  %s" % (
+            report['cluster'],
+            report['elapsed'],
+            " ".join("%9.2fs" % walls[stage] if walls.get(stage) is not None else "%10s" % "-" for stage in stages),
+            "ok" if report['succeeded'] else "FAILED (%s)" % report['error'],
+        ))
+    failed = len([report for report in reports if not report['succeeded']])
+    print("  %d clusters, %d failed, %.2fs" % (len(reports), failed, elapsed))
+
+
+def buildAll(paths, out, stages=DEFAULT_STAGES, parallel=None, options=()):
+    # Build every cluster of paths into out, at most `parallel` at a time. Returns 0 if all succeeded.
+    import concurrent.futures
+
+    selectStages(stages)
+    configs = configFiles(paths)
+    names = [clusterName(configFile) for configFile in configs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if len(duplicates) > 0:
+        raise StageError("config names must be unique, found more than one %s" % ", ".join(duplicates))
+
+    out = os.path.abspath(out)
+    os.makedirs(out, exist_ok=True)
+    options = ["--stages", stages] + list(options)
+    parallel = parallel or os.cpu_count()
+    print(":: Building %d clusters into %s, %d at a time." % (len(configs), out, parallel))
+
+    start = time.perf_counter()
+    reports = {}
+    # builds run as long as they take and a failed one does not stop the others
+    executor = Executor(limit=parallel, timeout=None)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = dict(
+            (pool.submit(buildCluster, name, os.path.abspath(configFile), os.path.join(out, name), options, executor), name)
+            for name, configFile in zip(names, configs)
+        )
+        for future in concurrent.futures.as_completed(futures):
+            report = reports[futures[future]] = future.result()
+            print("> %s %s in %.2fs." % (report['cluster'], "built" if report['succeeded'] else "FAILED", report['elapsed']))
+    elapsed = time.perf_counter() - start
+
+    ordered = [reports[name] for name in names]
+    printReport(ordered, [stage.strip() for stage in stages.split(",")], elapsed)
+
+    with open(os.path.join(out, REPORT_FILE), "w") as f:
+        json.dump({"elapsed": elapsed, "clusters": ordered}, f, indent=4)
+
+    return 0 if all(report['succeeded'] for report in ordered) else 1
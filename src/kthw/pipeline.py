@@ -0,0 +1,443 @@
+# Single-process pipeline driver: python -m kthw build --config ../conf/cluster.json
+#
+# Loads cluster.json once and runs the stages of wrapper.sh as in-process function
+# calls sharing one state dict, then prints how long every stage took.
+#
+# Each stage is broken into tasks with declared inputs and outputs (see kthw/scheduler.py):
+# the encryption key and the Ansible files are generated next to certificate issuance,
+# and the kubeconfig of a component is written as soon as its certificate exists.
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+from kthw.config import ConfigError, loadConfig
+from kthw.deliver import CONTROL_PATH_DIR, DELIVERY_MODES, streamFiles
+from kthw.executor import Executor
+from kthw.inventory import INVENTORY_MODES
+from kthw.scheduler import GraphError, Task, runGraph
+from kthw.trace import STAGE, TASK, enable, export, span, tracer
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StageError(Exception):
+    pass
+
+
+_scripts = {}
+
+
+def loadScript(filename):
+    # The stage scripts have numbered, hyphenated file names, load them by path.
+    if filename not in _scripts:
+        import importlib.util
+
+        name = "kthw_stage_" + filename.split(".")[0].replace("-", "_")
+        spec = importlib.util.spec_from_file_location(name, os.path.join(SRC_PATH, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[filename] = module
+
+    return _scripts[filename]
+
+
+def runCommand(args, env=None):
+    # the playbook and shell scripts print their progress as they go, no timeout
+    print("$ %s" % " ".join(args))
+    result = Executor(timeout=None).run(args, check=False, cwd=SRC_PATH, env=env, stdout=None, stderr=None)
+
+    if result.error is not None:
+        raise StageError("%s: %s" % (args[0], result.error))
+    if not result.ok:
+        raise StageError("%s exited with %s" % (" ".join(args), result.returncode))
+
+
+def certTasks(state):
+    # CA first, then every component certificate on its own, so the kubeconfig
+    # of a component can be written as soon as its certificate exists.
+    script = loadScript("01-generate-certs.py")
+
+    def prepare():
+        state['certs'] = script.prepareCerts(
+            state['config'],
+            backend=state['certBackend'],
+            jobs=state['jobs'],
+            incremental=state['incremental'],
+            key_pool=state['keyPool'],
+            delivery=state['delivery'],
+            command_timeout=state['commandTimeout'],
+        )
+
+    def component(name):
+        return lambda: script.genComponentCert(state['certs'], name)
+
+    components = [name for name, genCert in script.CERT_COMPONENTS]
+
+    # preparing the CA removes the certificates of the last build from certificatesPath, every
+    # task writing into a directory that may be the same one (k8sConfPath, the Ansible files)
+    # waits for "certs-dir"
+    tasks = [Task("certs:ca", "certs", prepare, outputs=["cert:ca", "certs-dir"])]
+    for name in components:
+        tasks.append(Task("certs:" + name, "certs", component(name), inputs=["cert:ca"], outputs=["cert:" + name]))
+    tasks.append(
+        Task(
+            "certs:bundles",
+            "certs",
+            lambda: script.finishCerts(state['certs']),
+            inputs=["cert:" + name for name in components],
+            outputs=["certs-bundles"],
+        )
+    )
+    return tasks
+
+
+def kubeconfigTasks(state):
+    script = loadScript("02-generate-kubeconfig.py")
+
+    def prepare():
+        state['kubeconfigs'] = script.prepareKubeconfigs(
+            state['config'],
+            backend=state['kubeconfigBackend'],
+            jobs=state['jobs'],
+            delivery=state['delivery'],
+            incremental=state['incremental'],
+            command_timeout=state['commandTimeout'],
+        )
+        # removes the staging directory when a component fails and finishKubeconfigs never runs
+        state['cleanup'].append(lambda: script.cleanupKubeconfigs(state['kubeconfigs']))
+
+    def component(name):
+        return lambda: script.genComponentKubeconfigs(state['kubeconfigs'], name)
+
+    components = [name for name, genConfig in script.KUBECONFIG_COMPONENTS]
+
+    tasks = [Task("kubeconfig:staging", "kubeconfig", prepare, inputs=["certs-dir"], outputs=["kubeconfig:staging"])]
+    for name in components:
+        tasks.append(
+            Task(
+                "kubeconfig:" + name,
+                "kubeconfig",
+                component(name),
+                inputs=["kubeconfig:staging", "cert:ca", "cert:" + name],
+                outputs=["kubeconfig:" + name],
+            )
+        )
+    tasks.append(
+        Task(
+            "kubeconfig:bundles",
+            "kubeconfig",
+            lambda: script.finishKubeconfigs(state['kubeconfigs']),
+            inputs=["kubeconfig:" + name for name in components],
+            outputs=["kubeconfig-bundles"],
+        )
+    )
+    return tasks
+
+
+def encryptionTasks(state):
+    script = loadScript("03-generate-encryption-keys.py")
+    return [Task("encryption", "encryption", lambda: script.generateEncKeys(state['config']), inputs=["certs-dir"], outputs=["encryption-config"])]
+
+
+def ansibleTasks(state):
+    script = loadScript("04-generate-ansible-files.py")
+    return [Task("ansible", "ansible", lambda: script.generateAnsibleFiles(state['config'], state['delivery'], state['inventory'], state['configFile']), inputs=["certs-dir"], outputs=["inventory", "host-vars", "playbook"])]
+
+
+def playbookTasks(state):
+    config = state['config']
+    files = ["certs-bundles", "kubeconfig-bundles", "encryption-config"]
+    # the playbook names its roles as ansible/roles/..., found from src/ wherever the playbook is written
+    env = {"ANSIBLE_ROLES_PATH": SRC_PATH}
+    if state['delivery'] != "stream":
+        return [
+            Task(
+                "playbook",
+                "playbook",
+                lambda: runCommand(["ansible-playbook", config['ansiblePlaybook'], "-i", config['ansibleInventory']], env),
+                inputs=files + ["inventory", "host-vars", "playbook"],
+                outputs=["cluster"],
+            )
+        ]
+
+    # Stream the files into place first; ansible-playbook then reuses the ssh master
+    # connections the delivery left open instead of connecting again.
+    env = dict(env, ANSIBLE_SSH_CONTROL_PATH_DIR=CONTROL_PATH_DIR, ANSIBLE_SSH_CONTROL_PATH="%(directory)s/%%C")
+    return [
+        Task("deliver", "playbook", lambda: streamFiles(config, max(state['jobs'], 4)), inputs=files, outputs=["delivered"]),
+        Task(
+            "playbook",
+            "playbook",
+            lambda: runCommand(["ansible-playbook", config['ansiblePlaybook'], "-i", config['ansibleInventory']], env),
+            inputs=["delivered", "inventory", "host-vars", "playbook"],
+            outputs=["cluster"],
+        ),
+    ]
+
+
+def kubectlRemoteTasks(state):
+    return [
+        Task(
+            "kubectl-remote",
+            "kubectl-remote",
+            lambda: runCommand(["bash", "05-kubectl-remote.sh", state['configFile']]),
+            inputs=["cluster", "certs-bundles"],
+            outputs=["kubectl-context"],
+        )
+    ]
+
+
+def dnsAddonTasks(state):
+    return [Task("dns", "dns", lambda: runCommand(["bash", "06-dns-addon.sh"]), inputs=["kubectl-context"])]
+
+
+# (name, description, task builder) in wrapper.sh order
+STAGES = [
+    ("certs", "Generating TLS Certificates", certTasks),
+    ("kubeconfig", "Generating Kubeconfig files", kubeconfigTasks),
+    ("encryption", "Generating Encryption Key file", encryptionTasks),
+    ("ansible", "Generating Ansible files", ansibleTasks),
+    ("playbook", "Running ansible-playbook", playbookTasks),
+    ("kubectl-remote", "Configuring kubectl remote", kubectlRemoteTasks),
+    ("dns", "Adding DNS", dnsAddonTasks),
+]
+
+STAGE_NAMES = [name for name, description, builder in STAGES]
+
+
+def selectStages(selection):
+    if selection is None:
+        return list(STAGES)
+
+    names = [name.strip() for name in selection.split(",") if len(name.strip()) > 0]
+    unknown = [name for name in names if name not in STAGE_NAMES]
+    if len(unknown) > 0:
+        raise StageError("unknown stage(s): %s (available: %s)" % (", ".join(unknown), ", ".join(STAGE_NAMES)))
+
+    # always run in pipeline order, whatever order they were given in
+    return [stage for stage in STAGES if stage[0] in names]
+
+
+def runStage(function):
+    # The stage functions report errors and sys.exit(1) like the scripts do,
+    # turn that into an error message for the summary.
+    try:
+        function()
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            return "exited with %s" % err.code
+    except StageError as err:
+        return str(err)
+    except Exception as err:
+        return "%s: %s" % (type(err).__name__, err)
+
+    return None
+
+
+def stageReport(stages, results):
+    # [{stage, wall, error}] per stage, wall is None for stages that did not run
+    report = []
+    for name, description, builder in stages:
+        spans = [(start, end, error) for task, start, end, error in results if task.stage == name]
+        if len(spans) == 0:
+            report.append({"stage": name, "wall": None, "error": None})
+            continue
+
+        # wall time from the first task starting to the last one finishing, tasks of
+        # different stages overlap so these don't add up to the total
+        wall = max(end for start, end, error in spans) - min(start for start, end, error in spans)
+        errors = [error for start, end, error in spans if error is not None]
+        report.append({"stage": name, "wall": wall, "error": errors[0] if len(errors) > 0 else None})
+
+    return report
+
+
+def printSummary(report, elapsed):
+    print()
+    print(":: Stage timings")
+    for stage in report:
+        if stage['wall'] is None:
+            print("  %-16s %8s  skipped" % (stage['stage'], "-"))
+        else:
+            print("  %-16s %8.2fs  %s" % (stage['stage'], stage['wall'], "ok" if stage['error'] is None else "FAILED (%s)" % stage['error']))
+    print("  %-16s %8.2fs" % ("total", elapsed))
+
+
+def build(configFile, stages, state, parallel=4, reportFile=None):
+    state['configFile'] = configFile
+    state['config'] = loadConfig(configFile, save=True)
+
+    tasks = []
+    for name, description, builder in stages:
+        tasks += builder(state)
+
+    banners = dict((name, "[%02d] %s%s" % (index + 1, description, "*" * max(0, 100 - len(description))))
+                   for index, (name, description, builder) in enumerate(stages))
+    lock = threading.Lock()
+
+    def run(task):
+        with lock:
+            if task.stage in banners:
+                print(banners.pop(task.stage))
+        with span(task.name, TASK, stage=task.stage) as traced_span:
+            error = runStage(task.function)
+            if error is not None:
+                traced_span.update(error=error)
+        if error is not None:
+            print("ERROR > %s failed: %s" % (task.name, error))
+        return error
+
+    start = time.perf_counter()
+    state['cleanup'] = []
+    try:
+        results = runGraph(tasks, run, parallel)
+    finally:
+        for cleanup in state['cleanup']:
+            cleanup()
+    elapsed = time.perf_counter() - start
+
+    report = stageReport(stages, results)
+    printSummary(report, elapsed)
+    succeeded = len(results) == len(tasks) and all(error is None for task, start, end, error in results)
+
+    if tracer.enabled:
+        # one row per stage, from its first task starting to its last one finishing
+        for name, description, builder in stages:
+            spans = [(taskStart, end, error) for task, taskStart, end, error in results if task.stage == name]
+            if len(spans) > 0:
+                errors = [error for taskStart, end, error in spans if error is not None]
+                tracer.record(name, STAGE, min(taskStart for taskStart, end, error in spans), max(end for taskStart, end, error in spans),
+                              thread="stage " + name, **({"error": errors[0]} if len(errors) > 0 else {}))
+        tracer.record("build", "build", start, start + elapsed, thread="build", succeeded=succeeded)
+        export()
+
+    if reportFile is not None:
+        import json
+
+        with open(reportFile, "w") as f:
+            json.dump({"config": configFile, "succeeded": succeeded, "elapsed": elapsed, "stages": report}, f, indent=4)
+
+    return 0 if succeeded else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kthw", description="KTHW - Kubernetes the hard way pipeline.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    build_parser = subparsers.add_parser("build", help="Run the pipeline stages for a cluster config.")
+    build_parser.add_argument(
+        "--config", type=str, required=True, help="Specify the path to the Kubernetes cluster config json file."
+    )
+    build_parser.add_argument(
+        "--stages", type=str, help="Comma separated stages to run (default: all): %s." % ",".join(STAGE_NAMES)
+    )
+    build_parser.add_argument(
+        "--parallel", type=int, default=4, help="Number of independent stage tasks to run at the same time, 1 runs them in order (default: 4)."
+    )
+    build_parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of certificates / kubeconfig files to generate in parallel (default: 1)."
+    )
+    build_parser.add_argument(
+        "--cert-backend", type=str, choices=("native", "cfssl"), default="native", help="Certificate signing backend (default: native)."
+    )
+    build_parser.add_argument(
+        "--kubeconfig-backend", type=str, choices=("native", "kubectl"), default="native", help="Kubeconfig writer (default: native)."
+    )
+    build_parser.add_argument(
+        "--incremental", action="store_true", help="Only re-issue certificates / rewrite kubeconfig files whose inputs changed (or that are near expiry)."
+    )
+    build_parser.add_argument(
+        "--key-pool", type=str, help="Take private keys from this pool of pre-generated keys (see python -m kthw.keypool)."
+    )
+    build_parser.add_argument(
+        "--delivery", type=str, choices=DELIVERY_MODES, default="bundle",
+        help="'bundle': per-host archives copied by Ansible, 'stream': files streamed over ssh into their final locations (default: bundle)."
+    )
+    build_parser.add_argument(
+        "--inventory", type=str, choices=INVENTORY_MODES, default="static",
+        help="'static': YAML inventory with host_vars/, 'script': executable inventory reading the config file (default: static)."
+    )
+    build_parser.add_argument(
+        "--command-timeout", type=float, help="Seconds before a cfssl / kubectl call is killed and retried (default: 60 / 30)."
+    )
+    build_parser.add_argument(
+        "--trace", type=str, help="Write a span of every stage, task, gen* function and external process to this Chrome trace json file."
+    )
+    build_parser.add_argument(
+        "--metrics", type=str, help="Write stage, function and process timings to this Prometheus textfile (.prom)."
+    )
+    build_parser.add_argument("--report", type=str, help=argparse.SUPPRESS)
+
+    multi_parser = subparsers.add_parser("multi", help="Build the artifacts of many cluster configs concurrently.")
+    multi_parser.add_argument("configs", nargs="+", help="Cluster config json files, or directories of them.")
+    multi_parser.add_argument("--out", type=str, required=True, help="Output directory, every cluster is built into <out>/<config name>/.")
+    multi_parser.add_argument(
+        "--stages", type=str, default="certs,kubeconfig,encryption,ansible",
+        help="Comma separated stages to run per cluster (default: certs,kubeconfig,encryption,ansible)."
+    )
+    multi_parser.add_argument(
+        "--parallel", type=int, help="Number of clusters to build at the same time (default: one per core)."
+    )
+    multi_parser.add_argument(
+        "--cert-backend", type=str, choices=("native", "cfssl"), default="native", help="Certificate signing backend (default: native)."
+    )
+    multi_parser.add_argument(
+        "--kubeconfig-backend", type=str, choices=("native", "kubectl"), default="native", help="Kubeconfig writer (default: native)."
+    )
+    multi_parser.add_argument(
+        "--incremental", action="store_true", help="Only re-issue certificates / rewrite kubeconfig files whose inputs changed (or that are near expiry)."
+    )
+    multi_parser.add_argument(
+        "--command-timeout", type=float, help="Seconds before a cfssl / kubectl call is killed and retried (default: 60 / 30)."
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == "multi":
+        from kthw.multi import buildAll
+
+        options = ["--cert-backend", args.cert_backend, "--kubeconfig-backend", args.kubeconfig_backend]
+        if args.incremental:
+            options.append("--incremental")
+        if args.command_timeout is not None:
+            options += ["--command-timeout", str(args.command_timeout)]
+        try:
+            return buildAll(args.configs, args.out, args.stages, args.parallel, options)
+        except (OSError, StageError) as err:
+            print("ERROR > %s" % err)
+            return 1
+
+    if args.command != "build":
+        parser.print_help()
+        return 1
+
+    if not os.path.exists(args.config):
+        print("ERROR > Failed to locate config file.")
+        return 1
+
+    if args.trace or args.metrics:
+        enable(args.trace, args.metrics)
+
+    try:
+        stages = selectStages(args.stages)
+        state = {
+            "jobs": args.jobs,
+            "certBackend": args.cert_backend,
+            "kubeconfigBackend": args.kubeconfig_backend,
+            "incremental": args.incremental,
+            "keyPool": args.key_pool,
+            "delivery": args.delivery,
+            "inventory": args.inventory,
+            "commandTimeout": args.command_timeout,
+        }
+        return build(os.path.abspath(args.config), stages, state, args.parallel, args.report)
+    except (ConfigError, StageError, GraphError) as err:
+        print("ERROR > %s" % err)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# Dependency graph scheduler for the pipeline stages.
+#
+# Every task declares the resources it reads (inputs) and writes (outputs). A task
+# becomes ready once every task producing one of its inputs has finished; ready
+# tasks run concurrently on a bounded thread pool. Inputs no task in the graph
+# produces (e.g. certificates of a stage that was not selected) are assumed to exist.
+
+import time
+
+
+class GraphError(Exception):
+    pass
+
+
+class Task:
+
+    def __init__(self, name, stage, function, inputs=(), outputs=()):
+        self.name = name
+        self.stage = stage
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def __repr__(self):
+        return "Task(%s)" % self.name
+
+
+def dependencies(tasks):
+    # {task name: set of task names it waits for}
+    producers = {}
+    for task in tasks:
+        for output in task.outputs:
+            if output in producers:
+                raise GraphError("%s is written by both %s and %s" % (output, producers[output], task.name))
+            producers[output] = task.name
+
+    return {
+        task.name: {producers[resource] for resource in task.inputs if resource in producers} - {task.name}
+        for task in tasks
+    }
+
+
+def runGraph(tasks, run, workers=4):
+    # Run every task as run(task) -> error message or None.
+    # On the first failure no new task is started; running ones are allowed to finish.
+    # Returns [(task, start, end, error)] in completion order, skipped tasks are left out.
+    import concurrent.futures
+
+    waiting = dependencies(tasks)
+    order = {task.name: index for index, task in enumerate(tasks)}
+    pending = {task.name: task for task in tasks}
+    done = set()
+    results = []
+    failed = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        running = {}
+
+        while len(pending) > 0 or len(running) > 0:
+            if not failed:
+                # start ready tasks in declaration order, so workers=1 runs the pipeline order
+                for name in sorted(pending, key=order.get):
+                    if len(running) >= workers:
+                        break
+                    if waiting[name] <= done:
+                        task = pending.pop(name)
+                        running[pool.submit(timedRun, run, task)] = task
+            elif len(running) == 0:
+                break
+
+            if len(running) == 0:
+                raise GraphError("dependency cycle between: %s" % ", ".join(sorted(pending)))
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                start, end, error = future.result()
+                results.append((task, start, end, error))
+                if error is None:
+                    done.add(task.name)
+                else:
+                    failed = True
+
+    return results
+
+
+def timedRun(run, task):
+    start = time.perf_counter()
+    try:
+        error = run(task)
+    except Exception as err:
+        error = "%s: %s" % (type(err).__name__, err)
+    return start, time.perf_counter(), error
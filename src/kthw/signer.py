@@ -0,0 +1,382 @@
+# Certificate signers used by 01-generate-certs.py.
+#
+# Both backends take a cfssl style CSR as a dict (rendered from templates/*-csr.json, see
+# kthw/csr.py) plus the ca-config.json file and write the same <name>.pem / <name>-key.pem /
+# <name>.csr files cfssl-json does.
+#
+#   native - in-process signing with the `cryptography` package, no fork/exec.
+#   cfssl  - the original `cfssl gencert | cfssl-json -bare` pipeline, both commands run by the
+#            executor of the stage (kthw/executor.py) with a timeout.
+
+import os
+import re
+import json
+import threading
+import datetime
+import ipaddress
+
+from kthw.executor import CommandError, Executor
+
+BACKENDS = ("native", "cfssl")
+
+# cfssl gencert -initca uses 5 years unless the CSR carries "ca": {"expiry": ...}
+DEFAULT_CA_EXPIRY = "43800h"
+
+# per cfssl / cfssl-json call, a timed out call is retried
+CFSSL_TIMEOUT = 60.0
+CFSSL_RETRIES = 2
+
+# cfssl backdates certificates to tolerate clock skew between hosts
+BACKDATE = datetime.timedelta(minutes=5)
+
+# keyAlgorithm of cluster.json -> the "key" of a cfssl CSR
+KEY_ALGORITHMS = {
+    "rsa-2048": {"algo": "rsa", "size": 2048},
+    "rsa-4096": {"algo": "rsa", "size": 4096},
+    "ecdsa-p256": {"algo": "ecdsa", "size": 256},
+    "ecdsa-p384": {"algo": "ecdsa", "size": 384},
+    "ed25519": {"algo": "ed25519", "size": 256},
+}
+
+# the key size of the CSR templates
+DEFAULT_KEY_ALGORITHM = "rsa-2048"
+
+
+class SignerError(Exception):
+    pass
+
+
+def parseDuration(value):
+    # Parse a Go style duration as used by cfssl ("8760h", "1h30m", "90s").
+    parts = re.findall(r"(\d+)(h|m|s)", value)
+    if len(parts) == 0 or "".join(n + u for n, u in parts) != value:
+        raise SignerError("invalid expiry: %s" % value)
+
+    seconds = {"h": 3600, "m": 60, "s": 1}
+    return datetime.timedelta(seconds=sum(int(n) * seconds[u] for n, u in parts))
+
+
+_signing_cache = {}
+_signing_lock = threading.Lock()
+
+
+def loadSigning(ca_config_file):
+    # "signing" section of ca-config.json, parsed once per process
+    path = os.path.abspath(ca_config_file)
+    with _signing_lock:
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime_ns)
+            if key not in _signing_cache:
+                with open(path) as f:
+                    _signing_cache[key] = json.load(f)["signing"]
+        except (OSError, ValueError, KeyError) as err:
+            raise SignerError("failed to read %s: %s" % (ca_config_file, err))
+
+        return _signing_cache[key]
+
+
+def loadProfile(ca_config_file, profile):
+    signing = loadSigning(ca_config_file)
+
+    settings = dict(signing.get("default", {}))
+    if profile is not None:
+        if profile not in signing.get("profiles", {}):
+            raise SignerError("profile %s not found in %s" % (profile, ca_config_file))
+        settings.update(signing["profiles"][profile])
+
+    return settings
+
+
+def writeBundle(out_base, cert_pem, key_pem, csr_pem):
+    # Same file names and modes as `cfssl-json -bare <out_base>`.
+    for path, data, mode in (
+        (out_base + ".pem", cert_pem, 0o644),
+        (out_base + "-key.pem", key_pem, 0o600),
+        (out_base + ".csr", csr_pem, 0o644),
+    ):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+
+class CfsslSigner:
+    name = "cfssl"
+
+    def __init__(self, cfssl="cfssl", cfssl_json="cfssl-json", timeout=None):
+        self.cfssl = cfssl
+        self.cfssl_json = cfssl_json
+        # every certificate of the stage fails it, so any failure is fatal: the cfssl calls
+        # of the other certificates are cancelled instead of running to completion
+        self.executor = Executor(timeout=timeout or CFSSL_TIMEOUT, retries=CFSSL_RETRIES)
+
+    def initCA(self, csr, out_base, key_spec=None):
+        # cfssl gencert -initca - | cfssljson -bare ca
+        self._run([self.cfssl, "gencert", "-initca", "-"], out_base, self._csr(csr, key_spec))
+
+    def sign(self, ca_base, ca_config_file, profile, csr, out_base, hostnames=None, key_spec=None):
+        args = [
+            self.cfssl,
+            "gencert",
+            "-ca=%s.pem" % ca_base,
+            "-ca-key=%s-key.pem" % ca_base,
+            "-config=%s" % ca_config_file,
+        ]
+        if hostnames is not None:
+            args.append("-hostname=%s" % ",".join(hostnames))
+        args += ["-profile=%s" % profile, "-"]
+
+        self._run(args, out_base, self._csr(csr, key_spec))
+
+    def _csr(self, csr, key_spec):
+        # The CSR goes to cfssl on stdin ("-"), with the key replaced when one is given.
+        if key_spec is not None:
+            if key_spec["algo"] not in ("rsa", "ecdsa"):
+                raise SignerError("cfssl does not support %s keys, use the native backend" % key_spec["algo"])
+            csr = dict(csr, key=dict(key_spec))
+
+        return json.dumps(csr).encode()
+
+    def _run(self, args, out_base, csr_data):
+        # cfssl prints the certificate, key and CSR as JSON, cfssl-json writes the files;
+        # the JSON is small, it is handed over in memory instead of a pipe between the two
+        try:
+            generated = self.executor.run(args, input=csr_data, fatal=True)
+            self.executor.run([self.cfssl_json, "-bare", out_base], input=generated.stdout, fatal=True)
+        except CommandError as err:
+            raise SignerError(str(err))
+
+
+class NativeSigner:
+    name = "native"
+
+    def __init__(self, keyPool=None):
+        try:
+            from cryptography import x509
+            from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+        except ImportError:
+            raise SignerError("the native backend needs the 'cryptography' package (pip install cryptography), or use --backend cfssl")
+
+        self.x509 = x509
+        self.NameOID = NameOID
+        self.ExtendedKeyUsageOID = ExtendedKeyUsageOID
+        self.hashes = hashes
+        self.serialization = serialization
+        self.rsa = rsa
+        self.ec = ec
+        self.ed25519 = ed25519
+
+        # pre-generated keys (kthw/keypool.py), keys are generated here when it runs dry
+        self.keyPool = keyPool
+
+        # the CA is loaded once per run and shared by every sign() call
+        self._ca_cache = {}
+        self._lock = threading.Lock()
+
+    def initCA(self, csr, out_base, key_spec=None):
+        x509 = self.x509
+        key = self._genKey(key_spec or csr.get("key", {}))
+        subject = self._subject(csr)
+        expiry = parseDuration(csr.get("ca", {}).get("expiry", DEFAULT_CA_EXPIRY))
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - BACKDATE)
+            .not_valid_after(now + expiry)
+            .add_extension(self._keyUsage(["cert sign", "crl sign"]), critical=True)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .sign(key, self._hash(key))
+        )
+
+        self._write(out_base, cert, key, self._csr(key, subject, csr.get("hosts")))
+
+    def sign(self, ca_base, ca_config_file, profile, csr, out_base, hostnames=None, key_spec=None):
+        x509 = self.x509
+        settings = loadProfile(ca_config_file, profile)
+        ca_cert, ca_key = self._loadCA(ca_base)
+
+        # like cfssl, -hostname overrides the "hosts" list of the CSR
+        hosts = hostnames if hostnames is not None else csr.get("hosts", [])
+
+        key = self._genKey(key_spec or csr.get("key", {}))
+        subject = self._subject(csr)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        usages = settings.get("usages", ["signing", "key encipherment", "server auth", "client auth"])
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(ca_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - BACKDATE)
+            .not_valid_after(now + parseDuration(settings.get("expiry", "8760h")))
+            .add_extension(self._keyUsage(usages), critical=True)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False)
+        )
+
+        eku = self._extKeyUsage(usages)
+        if eku is not None:
+            builder = builder.add_extension(eku, critical=False)
+
+        san = self._san(hosts)
+        if san is not None:
+            builder = builder.add_extension(san, critical=False)
+
+        cert = builder.sign(ca_key, self._hash(ca_key))
+
+        self._write(out_base, cert, key, self._csr(key, subject, hosts))
+
+    def _loadCA(self, ca_base):
+        with self._lock:
+            if ca_base not in self._ca_cache:
+                try:
+                    with open(ca_base + ".pem", "rb") as f:
+                        ca_cert = self.x509.load_pem_x509_certificate(f.read())
+                    with open(ca_base + "-key.pem", "rb") as f:
+                        ca_key = self.serialization.load_pem_private_key(f.read(), password=None)
+                except (OSError, ValueError) as err:
+                    raise SignerError("failed to load CA %s: %s" % (ca_base, err))
+                self._ca_cache[ca_base] = (ca_cert, ca_key)
+
+            return self._ca_cache[ca_base]
+
+    def _genKey(self, key_spec):
+        algo = key_spec.get("algo", "rsa")
+        size = key_spec.get("size", 2048)
+
+        if self.keyPool is not None:
+            pem = self.keyPool.claim(algo, size)
+            if pem is not None:
+                return self.serialization.load_pem_private_key(pem, password=None)
+
+        if algo == "rsa":
+            return self.rsa.generate_private_key(public_exponent=65537, key_size=size)
+        if algo == "ecdsa":
+            curves = {256: self.ec.SECP256R1, 384: self.ec.SECP384R1, 521: self.ec.SECP521R1}
+            if size not in curves:
+                raise SignerError("unsupported ecdsa key size: %s" % size)
+            return self.ec.generate_private_key(curves[size]())
+        if algo == "ed25519":
+            return self.ed25519.Ed25519PrivateKey.generate()
+
+        raise SignerError("unsupported key algorithm: %s" % algo)
+
+    def _hash(self, key):
+        # digest of the signatures made with key, as cfssl picks it: none for ed25519,
+        # SHA-384/512 for the larger curves, SHA-256 otherwise
+        if isinstance(key, self.ed25519.Ed25519PrivateKey):
+            return None
+        if isinstance(key, self.ec.EllipticCurvePrivateKey) and key.curve.key_size > 256:
+            return self.hashes.SHA384() if key.curve.key_size == 384 else self.hashes.SHA512()
+        return self.hashes.SHA256()
+
+    def _subject(self, csr):
+        NameOID = self.NameOID
+        # same attribute order as cfssl (Go pkix.Name)
+        fields = (
+            ("C", NameOID.COUNTRY_NAME),
+            ("ST", NameOID.STATE_OR_PROVINCE_NAME),
+            ("L", NameOID.LOCALITY_NAME),
+            ("O", NameOID.ORGANIZATION_NAME),
+            ("OU", NameOID.ORGANIZATIONAL_UNIT_NAME),
+        )
+
+        attributes = []
+        for name in csr.get("names", []):
+            for field, oid in fields:
+                if name.get(field):
+                    attributes.append(self.x509.NameAttribute(oid, name[field]))
+        if csr.get("CN"):
+            attributes.append(self.x509.NameAttribute(NameOID.COMMON_NAME, csr["CN"]))
+
+        return self.x509.Name(attributes)
+
+    def _san(self, hosts):
+        names = []
+        for host in hosts or []:
+            if len(host) == 0:
+                continue
+            try:
+                names.append(self.x509.IPAddress(ipaddress.ip_address(host)))
+            except ValueError:
+                names.append(self.x509.DNSName(host))
+
+        if len(names) == 0:
+            return None
+        return self.x509.SubjectAlternativeName(names)
+
+    def _keyUsage(self, usages):
+        return self.x509.KeyUsage(
+            digital_signature="signing" in usages or "digital signature" in usages,
+            content_commitment="content commitment" in usages,
+            key_encipherment="key encipherment" in usages,
+            data_encipherment="data encipherment" in usages,
+            key_agreement="key agreement" in usages,
+            key_cert_sign="cert sign" in usages,
+            crl_sign="crl sign" in usages,
+            encipher_only=False,
+            decipher_only=False,
+        )
+
+    def _extKeyUsage(self, usages):
+        oids = {
+            "server auth": self.ExtendedKeyUsageOID.SERVER_AUTH,
+            "client auth": self.ExtendedKeyUsageOID.CLIENT_AUTH,
+            "code signing": self.ExtendedKeyUsageOID.CODE_SIGNING,
+            "email protection": self.ExtendedKeyUsageOID.EMAIL_PROTECTION,
+            "timestamping": self.ExtendedKeyUsageOID.TIME_STAMPING,
+            "ocsp signing": self.ExtendedKeyUsageOID.OCSP_SIGNING,
+        }
+        selected = [oids[usage] for usage in usages if usage in oids]
+
+        if len(selected) == 0:
+            return None
+        return self.x509.ExtendedKeyUsage(selected)
+
+    def _csr(self, key, subject, hosts):
+        builder = self.x509.CertificateSigningRequestBuilder().subject_name(subject)
+        san = self._san(hosts)
+        if san is not None:
+            builder = builder.add_extension(san, critical=False)
+        return builder.sign(key, self._hash(key))
+
+    def _write(self, out_base, cert, key, csr):
+        serialization = self.serialization
+        # cfssl-json writes PKCS#1 ("RSA PRIVATE KEY") / SEC1 ("EC PRIVATE KEY") keys,
+        # ed25519 keys only have the PKCS#8 form
+        key_format = serialization.PrivateFormat.TraditionalOpenSSL
+        if isinstance(key, self.ed25519.Ed25519PrivateKey):
+            key_format = serialization.PrivateFormat.PKCS8
+        key_pem = key.private_bytes(serialization.Encoding.PEM, key_format, serialization.NoEncryption())
+
+        try:
+            writeBundle(
+                out_base,
+                cert.public_bytes(serialization.Encoding.PEM),
+                key_pem,
+                csr.public_bytes(serialization.Encoding.PEM),
+            )
+        except OSError as err:
+            raise SignerError("failed to write %s: %s" % (out_base, err))
+
+
+def getSigner(backend, cfssl="cfssl", cfssl_json="cfssl-json", keyPool=None, timeout=None):
+    if backend == "native":
+        return NativeSigner(keyPool)
+    if backend == "cfssl":
+        if keyPool is not None:
+            raise SignerError("a key pool needs the native backend, cfssl generates its own keys")
+        return CfsslSigner(cfssl, cfssl_json, timeout)
+
+    raise SignerError("unknown signing backend: %s" % backend)
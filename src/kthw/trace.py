@@ -0,0 +1,253 @@
+# Tracing of the pipeline: spans for stages, gen* functions and external processes.
+#
+#   python -m kthw build --config ../conf/cluster.json --trace trace.json --metrics kthw.prom
+#   KTHW_TRACE=trace.json KTHW_METRICS=kthw.prom python 01-generate-certs.py --config ...
+#
+# --trace writes the spans as Chrome trace events (chrome://tracing, https://ui.perfetto.dev),
+# one row per thread, so concurrent tasks and worker certificates show side by side.
+# --metrics writes a Prometheus textfile (node_exporter --collector.textfile.directory):
+# duration sums and counts per stage, span and command, and failed commands.
+#
+# Every external process span carries the command, its exit code and the tail of its stderr.
+# When tracing is off span() returns a shared no-op object and costs one attribute check.
+
+import os
+import time
+import threading
+
+STDERR_TAIL = 512
+
+# span categories
+STAGE = "stage"
+TASK = "task"
+FUNCTION = "function"
+PROCESS = "process"
+
+
+class Span:
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.end = None
+        self.thread = None
+
+    def update(self, **args):
+        self.args.update(args)
+
+    def process(self, args, returncode, stderr=None):
+        # command, exit code and stderr tail of an external process
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode(errors="replace")
+        self.args.update(command=" ".join(args), exitCode=returncode)
+        if stderr:
+            self.args['stderr'] = stderr.strip()[-STDERR_TAIL:]
+
+    def __enter__(self):
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.end = time.perf_counter()
+        if kind is not None and 'error' not in self.args:
+            self.args['error'] = "%s: %s" % (kind.__name__, value)
+        self.tracer.add(self)
+        return False
+
+
+class NullSpan:
+
+    def update(self, **args):
+        pass
+
+    def process(self, args, returncode, stderr=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.spans = []
+        # (trace file, metrics file) written by export()
+        self.files = (None, None)
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, category=FUNCTION, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start, end, thread=None, **args):
+        # a span measured elsewhere (e.g. by the scheduler), times from time.perf_counter();
+        # thread names the row it is shown in, default the current thread
+        if self.enabled:
+            span = Span(self, name, category, args)
+            span.start, span.end = start, end
+            span.thread = thread or threading.current_thread().name
+            self.add(span)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def chromeTrace(self):
+        # trace event format: complete ("X") events in microseconds plus thread names
+        pid = os.getpid()
+        events = []
+        threads = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        for span in spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": round((span.start - self.origin) * 1e6, 1),
+                "dur": round((span.end - span.start) * 1e6, 1),
+                "pid": pid,
+                "tid": tid,
+                "args": span.args,
+            })
+        for name, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "kthw"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def prometheus(self):
+        # duration summaries per stage / command / span and failed commands, text exposition format
+        durations = {STAGE: {}, PROCESS: {}, FUNCTION: {}}
+        failures = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span.category == STAGE:
+                group, labels = STAGE, (("stage", span.name),)
+            elif span.category == PROCESS:
+                group, labels = PROCESS, (("command", span.name),)
+                failures[labels] = failures.get(labels, 0) + (span.args.get('exitCode', 0) != 0 or 'error' in span.args)
+            else:
+                group, labels = FUNCTION, (("category", span.category), ("name", span.name))
+            entry = durations[group].setdefault(labels, [0.0, 0])
+            entry[0] += span.end - span.start
+            entry[1] += 1
+
+        lines = []
+        for group, metric, help in (
+            (STAGE, "kthw_stage_duration_seconds", "Wall time of the pipeline stages."),
+            (PROCESS, "kthw_process_duration_seconds", "Time spent in external processes per command."),
+            (FUNCTION, "kthw_span_duration_seconds", "Time spent in traced tasks and functions."),
+        ):
+            lines += ["# HELP %s %s" % (metric, help), "# TYPE %s summary" % metric]
+            for labels, (seconds, count) in sorted(durations[group].items()):
+                lines.append("%s_sum{%s} %.6f" % (metric, renderLabels(labels), seconds))
+                lines.append("%s_count{%s} %d" % (metric, renderLabels(labels), count))
+
+        lines += ["# HELP kthw_process_failures_total External processes that failed per command.", "# TYPE kthw_process_failures_total counter"]
+        for labels, count in sorted(failures.items()):
+            lines.append("kthw_process_failures_total{%s} %d" % (renderLabels(labels), count))
+
+        lines += ["# HELP kthw_last_run_timestamp_seconds When the traced run finished.", "# TYPE kthw_last_run_timestamp_seconds gauge"]
+        lines.append("kthw_last_run_timestamp_seconds %d" % time.time())
+        return "\n".join(lines) + "\n"
+
+
+def renderLabels(labels):
+    return ",".join('%s="%s"' % (key, escape(value)) for key, value in labels)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def writeAtomic(path, content):
+    # the textfile collector must never read a partial file
+    tmp = "%s.tmp-%d" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+tracer = Tracer()
+
+
+def span(name, category=FUNCTION, **args):
+    return tracer.span(name, category, **args)
+
+
+def commandName(args):
+    # "cfssl gencert", "kubectl config set-cluster", "bash 05-kubectl-remote.sh": the command without its options
+    words = [os.path.basename(args[0])]
+    for arg in args[1:3 if words[0] == "kubectl" else 2]:
+        if arg.startswith("-") or "=" in arg:
+            break
+        words.append(os.path.basename(arg))
+    return " ".join(words)
+
+
+def processSpan(args):
+    return tracer.span(commandName(args), PROCESS)
+
+
+def traced(function):
+    # decorator: a span per call of function, named after it
+    name = function.__name__
+
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return function(*args, **kwargs)
+        with Span(tracer, name, FUNCTION, {}):
+            return function(*args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = function.__doc__
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def enable(traceFile=None, metricsFile=None):
+    # trace from now on, the files are written by export() (at exit for enableFromEnv)
+    tracer.enable()
+    tracer.files = (traceFile, metricsFile)
+
+
+def export():
+    traceFile, metricsFile = tracer.files
+    if traceFile:
+        import json
+
+        writeAtomic(traceFile, json.dumps(tracer.chromeTrace()))
+    if metricsFile:
+        writeAtomic(metricsFile, tracer.prometheus())
+
+
+def enableFromEnv():
+    # KTHW_TRACE / KTHW_METRICS for the stage scripts run on their own
+    traceFile = os.environ.get("KTHW_TRACE")
+    metricsFile = os.environ.get("KTHW_METRICS")
+    if (traceFile or metricsFile) and not tracer.enabled:
+        import atexit
+
+        enable(traceFile, metricsFile)
+        atexit.register(export)
+
+
+enableFromEnv()
@@ -4,6 +4,7 @@
 # Install Client tools
 # 1 Install CFSSL
 # 2 Install kubectl
+# 3 Install Python dependencies
 
 
 # 1
@@ -65,3 +66,16 @@ echo "::kubectl client version"
 echo "::Moving binaries to $install_dest"
 
 sudo mv .tools/cfssl .tools/cfssl-json .tools/kubectl $install_dest
+
+# 3
+
+echo "::Installing Python dependencies"
+
+python -m pip install --user cryptography pyyaml grpcio
+
+if [ $? -ne 0 ]; then
+    echo "Install failed."
+    exit 1
+fi
+
+echo "Done."
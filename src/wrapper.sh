@@ -1,34 +1,20 @@
 #!/usr/bin/env bash 
 set -euo pipefail
 
-# Wrapper script to invoke the Python scripts and ansible-playbook
-CONF=$1
+# Wrapper script to invoke the pipeline driver (python -m kthw build), which runs
+# the Python stages in-process and then ansible-playbook, 05-kubectl-remote.sh and 06-dns-addon.sh.
+# Extra arguments are passed on, e.g. --stages certs,kubeconfig or --jobs 8
+CONF=${1:-}
 
 #CONF="../conf/cluster.json"
 
 if [ -f "$CONF" ] && [ ! -z $(echo $CONF|grep ".json") ]; then
-    ansible_inventory=$(cat $CONF | python -c 'import json,sys;obj=json.load(sys.stdin);print(obj[0]["ansibleInventory"])')
-    ansible_playbook=$(cat $CONF | python -c 'import json,sys;obj=json.load(sys.stdin);print(obj[0]["ansiblePlaybook"])')
-    echo "[01] Generating TLS Certificates******************************************************************"
-    python 01-generate-certs.py --config $CONF
-    echo "[02] Generating Kubeconfig files******************************************************************"
-    python 02-generate-kubeconfig.py --config $CONF
-    echo "[03] Generating Encryption Key file***************************************************************"
-    python 03-generate-encryption-keys.py --config $CONF
-    echo "[04] Generating Ansible files*********************************************************************"
-    python 04-generate-ansible-files.py --config $CONF
-    echo "[05] Running ansible-playbook*********************************************************************"
-    echo ansible-playbook "$ansible_playbook" -i "$ansible_inventory" 
-    ansible-playbook "$ansible_playbook" -i "$ansible_inventory"
-
-    if [ $? -eq 0 ]; then
-        echo "[06] Configuring kubectl remote***************************************************************"
-        ./05-kubectl-remote.sh
-        echo "[07] Adding DNS*******************************************************************************"
-        ./06-dns-addon.sh
-    fi
+    shift
+    CONF=$(cd "$(dirname "$CONF")" && pwd)/$(basename "$CONF")
+    cd "$(dirname "$0")"
+    exec python -m kthw build --config "$CONF" "$@"
 else
     echo "$CONF is not a valid path to the .json config file."
-    echo "Usage $0 [path to config .json file]"
+    echo "Usage $0 [path to config .json file] [kthw build options]"
     exit 1
-fi
\ No newline at end of file
+fi
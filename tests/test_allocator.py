@@ -0,0 +1,70 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.allocator import AllocationError, allocate, saveState
+
+
+class AllocateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.statePath = os.path.join(self.directory, "cluster.state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def config(self, workers, podCIDR=None, nodeCIDR=None):
+        configData = {
+            'controllers': [{'name': "controller-0", 'internalIP': ""}],
+            'workers': [{'name': name, 'internalIP': ""} for name in workers],
+            'ansibleSettings': {'clusterCIDR': "10.200.0.0/16", 'podCIDR': dict(podCIDR or {})},
+        }
+        if nodeCIDR:
+            configData['nodeCIDR'] = nodeCIDR
+        return configData
+
+    def generate(self, workers, podCIDR=None, nodeCIDR=None):
+        configData = self.config(workers, podCIDR, nodeCIDR)
+        saveState(self.statePath, allocate(configData, self.statePath))
+        return configData
+
+    def testWorkerIndex(self):
+        configData = self.generate(["w0", "w1", "w2"])
+        self.assertEqual(configData['ansibleSettings']['podCIDR'], {'w0': "10.200.1.0/24", 'w1': "10.200.2.0/24", 'w2': "10.200.3.0/24"})
+
+    def testRemovedWorkerKeepsOthersStable(self):
+        self.generate(["w0", "w1", "w2", "w3"])
+        configData = self.generate(["w0", "w2", "w3"])
+        self.assertEqual(configData['ansibleSettings']['podCIDR'], {'w0': "10.200.1.0/24", 'w2': "10.200.3.0/24", 'w3': "10.200.4.0/24"})
+
+        # a new worker takes the free block of its index, not one of a persisted worker
+        configData = self.generate(["w0", "w2", "w3", "w4"])
+        self.assertEqual(configData['ansibleSettings']['podCIDR']['w3'], "10.200.4.0/24")
+        self.assertEqual(configData['ansibleSettings']['podCIDR']['w4'], "10.200.2.0/24")
+
+    def testGivenWins(self):
+        configData = self.generate(["w0", "w1"], podCIDR={'w1': "10.200.1.0/24"})
+        self.assertEqual(configData['ansibleSettings']['podCIDR'], {'w0': "10.200.2.0/24", 'w1': "10.200.1.0/24"})
+
+    def testGivenOutsidePool(self):
+        with self.assertRaises(AllocationError):
+            allocate(self.config(["w0"], podCIDR={'w0': "10.100.0.0/24"}), self.statePath)
+
+    def testInternalIPs(self):
+        configData = self.generate(["w0", "w1"], nodeCIDR="10.240.0.0/24")
+        addresses = [host['internalIP'] for host in configData['controllers'] + configData['workers']]
+        self.assertEqual(len(set(addresses)), 3)
+        for address in addresses:
+            self.assertNotIn(address, ("10.240.0.0", "10.240.0.1", "10.240.0.254", "10.240.0.255"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.archive import SIDECAR_SUFFIX, buildHostBundles, bundlePath
+
+
+class HostBundlesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bundles = {"controller-1": ["ca.pem", "kubernetes.pem"], "worker-1": ["ca.pem", "worker-1.pem"]}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, directory, mtime):
+        os.makedirs(directory, exist_ok=True)
+        for name in ("ca.pem", "kubernetes.pem", "worker-1.pem"):
+            path = os.path.join(directory, name)
+            with open(path, "w") as f:
+                f.write("%s\n" % name)
+            os.chmod(path, 0o644)
+            os.utime(path, (mtime, mtime))
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def testReproducible(self):
+        # the same files written at different times in different directories give the same bytes
+        first = os.path.join(self.directory, "first")
+        second = os.path.join(self.directory, "second")
+        self.write(first, 1000000000)
+        self.write(second, 1700000000)
+
+        self.assertEqual(buildHostBundles(first, "k8s-certs", self.bundles), {"controller-1": True, "worker-1": True})
+        self.assertEqual(buildHostBundles(second, "k8s-certs", self.bundles), {"controller-1": True, "worker-1": True})
+        for host in self.bundles:
+            data = self.read(bundlePath(first, "k8s-certs", host))
+            self.assertEqual(data, self.read(bundlePath(second, "k8s-certs", host)))
+            self.assertEqual(
+                self.read(bundlePath(first, "k8s-certs", host) + SIDECAR_SUFFIX).split()[0].decode(),
+                hashlib.sha256(data).hexdigest(),
+            )
+
+        with tarfile.open(bundlePath(first, "k8s-certs", "worker-1")) as archive:
+            self.assertEqual(archive.getnames(), ["ca.pem", "worker-1.pem"])
+
+    def testUnchangedBundleIsKept(self):
+        self.write(self.directory, 1000000000)
+        buildHostBundles(self.directory, "k8s-certs", self.bundles)
+        path = bundlePath(self.directory, "k8s-certs", "worker-1")
+        stat = os.stat(path)
+
+        self.write(self.directory, 1700000000)
+        self.assertEqual(buildHostBundles(self.directory, "k8s-certs", self.bundles), {"controller-1": False, "worker-1": False})
+        self.assertEqual(os.stat(path).st_mtime_ns, stat.st_mtime_ns)
+
+    def testRemovedHost(self):
+        self.write(self.directory, 1000000000)
+        buildHostBundles(self.directory, "k8s-certs", self.bundles)
+        del self.bundles["worker-1"]
+        buildHostBundles(self.directory, "k8s-certs", self.bundles)
+        self.assertFalse(os.path.exists(bundlePath(self.directory, "k8s-certs", "worker-1")))
+        self.assertFalse(os.path.exists(bundlePath(self.directory, "k8s-certs", "worker-1") + SIDECAR_SUFFIX))
+
+
+if __name__ == "__main__":
+    unittest.main()
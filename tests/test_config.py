@@ -0,0 +1,93 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.bench import syntheticConfig
+from kthw.config import ConfigError, loadConfig, parseConfig
+
+
+class ParseConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.configFile = os.path.join(self.directory, "cluster.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse(self, **values):
+        entry = syntheticConfig(self.directory, 2, 1)
+        entry.update(values)
+        return parseConfig([entry], self.configFile)
+
+    def testValid(self):
+        config, state = self.parse()
+        self.assertEqual(config['workersCount'], 2)
+        self.assertEqual(state['podCIDR'], dict(config['ansibleSettings']['podCIDR']))
+
+    def testSchemaErrors(self):
+        entry = syntheticConfig(self.directory, 2, 1)
+        del entry['clusterName']
+        entry['workersCount'] = "2"
+        entry['ansibleSettings']['clusterDNS'] = 53
+        entry['workers'][0]['sshUser'] = None
+        entry['unknownSetting'] = True
+
+        with self.assertRaises(ConfigError) as context:
+            parseConfig([entry], self.configFile)
+        message = str(context.exception)
+        for error in (
+            "clusterName is missing",
+            "workersCount must be a number",
+            "ansibleSettings.clusterDNS must be a string",
+            "workers[0].sshUser must be a string",
+            "unknownSetting is not a known setting",
+        ):
+            self.assertIn(error, message)
+
+    def testValueErrors(self):
+        for values, error in (
+            ({'workersCount': 3}, "workersCount is 3 but workers lists 2 hosts"),
+            ({'keyAlgorithm': "dsa-1024"}, "keyAlgorithm: 'dsa-1024' is not one of"),
+            ({'encryptionProvider': "rot13"}, "encryptionProvider: 'rot13' is not one of"),
+        ):
+            with self.subTest(error=error), self.assertRaisesRegex(ConfigError, error):
+                self.parse(**values)
+
+        with self.assertRaisesRegex(ConfigError, "must contain a list with one cluster entry"):
+            parseConfig({}, self.configFile)
+
+    def testUnreadableFile(self):
+        with open(self.configFile, "w") as f:
+            f.write("[{")
+        with self.assertRaisesRegex(ConfigError, "failed to read"):
+            loadConfig(self.configFile)
+        with self.assertRaisesRegex(ConfigError, "failed to read"):
+            loadConfig(os.path.join(self.directory, "missing.json"))
+
+    def testLoadSavesOnlyWhenAsked(self):
+        with open(self.configFile, "w") as f:
+            json.dump([syntheticConfig(self.directory, 2, 1)], f)
+        statePath = os.path.join(self.directory, "cluster.state.json")
+
+        loadConfig(self.configFile)
+        self.assertFalse(os.path.exists(statePath))
+        loadConfig(self.configFile, save=True)
+        self.assertTrue(os.path.exists(statePath))
+
+    def testKmsRejected(self):
+        # nothing serves the plugin socket on the controllers
+        with self.assertRaisesRegex(ConfigError, "encryptionProvider: kms"):
+            self.parse(encryptionProvider="kms")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.bench import TEMPLATES_PATH
+from kthw.encryption import (EncryptionError, currentProvider, describe, flatten, loadEncryptionConfig, prune, renderInitial, rotate,
+                             secretsResource, writeEncryptionConfig)
+
+
+def secrets(data):
+    # [secret] of the keys in the order the apiserver tries them
+    return [key['secret'] for name, key, config in flatten(secretsResource(data)['providers']) if key is not None]
+
+
+class RotationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = renderInitial(os.path.join(TEMPLATES_PATH, "encryption-config.yaml"), "aescbc")
+        self.first = secrets(self.data)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testInitial(self):
+        self.assertEqual(describe(self.data), "aescbc:key1, identity")
+
+    def testPrepend(self):
+        data = rotate(self.data, "aesgcm", "prepend")
+        self.assertEqual(describe(data), "aesgcm:key2, aescbc:key1, identity")
+        # new writes use the new key, what was written with the old one stays readable
+        self.assertEqual(currentProvider(data), "aesgcm")
+        self.assertEqual(secrets(data)[1], self.first)
+
+        data = prune(data)
+        self.assertEqual(describe(data), "aesgcm:key2, identity")
+        self.assertNotIn(self.first, secrets(data))
+
+    def testStageAndPromote(self):
+        data = rotate(self.data, "aescbc", "stage")
+        # staged: every apiserver can read the new key before any of them writes with it
+        self.assertEqual(describe(data), "aescbc:key1, aescbc:key2, identity")
+        self.assertEqual(secrets(data)[0], self.first)
+
+        data = rotate(data, "aescbc", "promote")
+        self.assertEqual(describe(data), "aescbc:key2, aescbc:key1, identity")
+        self.assertEqual(secrets(data)[1], self.first)
+
+        with self.assertRaises(EncryptionError):
+            rotate(data, "aescbc", "promote")
+
+        data = prune(data)
+        self.assertEqual(describe(data), "aescbc:key2, identity")
+
+    def testPruneWithoutKey(self):
+        resource = secretsResource(self.data)
+        resource['providers'] = [{'identity': {}}] + resource['providers']
+        with self.assertRaises(EncryptionError):
+            prune(self.data)
+
+    def testWriteAndLoad(self):
+        path = os.path.join(self.directory, "encryption-config.yaml")
+        data = rotate(self.data, "secretbox", "prepend")
+        writeEncryptionConfig(path, data)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(loadEncryptionConfig(path), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
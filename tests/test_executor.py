@@ -0,0 +1,57 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import time
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.executor import CommandError, Executor
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def testOutput(self):
+        result = Executor(timeout=10).run(["sh", "-c", "cat; echo err >&2"], input=b"data")
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, b"data")
+        self.assertEqual(result.stderr, b"err\n")
+        self.assertEqual(result.attempts, 1)
+
+    def testTimeoutIsRetried(self):
+        start = time.perf_counter()
+        result = Executor(timeout=0.2, retries=2, backoff=0.01).run(["sleep", "5"], check=False)
+        self.assertTrue(result.timedOut)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 3)
+        self.assertLess(time.perf_counter() - start, 4)
+
+    def testTimeoutKillsChildren(self):
+        # the wrapper's sleep keeps the pipes open unless the whole process group is killed
+        start = time.perf_counter()
+        result = Executor(timeout=0.2).run(["sh", "-c", "sleep 5; true"], check=False)
+        self.assertTrue(result.timedOut)
+        self.assertLess(time.perf_counter() - start, 4)
+
+    def testExitCodes(self):
+        # only the listed exit codes are retried
+        executor = Executor(timeout=10, retries=2, backoff=0.01, retryCodes=(3,))
+        self.assertEqual(executor.run(["sh", "-c", "exit 3"], check=False).attempts, 3)
+        self.assertEqual(executor.run(["sh", "-c", "exit 4"], check=False).attempts, 1)
+
+        with self.assertRaises(CommandError) as context:
+            executor.run(["sh", "-c", "echo broken >&2; exit 4"])
+        self.assertEqual(context.exception.result.returncode, 4)
+        self.assertIn("broken", str(context.exception))
+
+    def testFatalCancelsLaterRuns(self):
+        executor = Executor(timeout=10)
+        result = executor.run([os.path.join(os.sep, "nonexistent", "command")], check=False)
+        self.assertIsNotNone(result.error)
+        self.assertTrue(executor.run(["true"], check=False).cancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.bench import ENTRY_POINTS, HEAVY_MODULES, IMPORT_BUDGET, importTimes
+
+
+class ImportTimeTest(unittest.TestCase):
+    # python -m kthw.bench --imports as a test: --help of every entry point must not pull in
+    # a heavy module and must stay within the import budget
+
+    def testEntryPoints(self):
+        for name, arguments in ENTRY_POINTS:
+            with self.subTest(entry_point=name):
+                # the first run warms the bytecode and file system caches
+                importTimes(arguments)
+                returncode, modules = importTimes(arguments)
+                self.assertEqual(returncode, 0)
+
+                heavy = sorted(set(module.strip() for module, cumulative in modules if module.strip() in HEAVY_MODULES))
+                self.assertEqual(heavy, [])
+
+                total = sum(cumulative for module, cumulative in modules if not module.startswith(" ")) / 1000.0
+                self.assertLessEqual(total, IMPORT_BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.bench import syntheticConfig
+from kthw.pipeline import main
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = syntheticConfig(self.directory, 2, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, *options):
+        configFile = os.path.join(self.directory, "cluster.json")
+        with open(configFile, "w") as f:
+            json.dump([self.config], f, indent=4)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            self.assertEqual(main(["build", "--config", configFile, "--stages", "certs,kubeconfig"] + list(options)), 0)
+
+    def read(self, directory, names):
+        contents = {}
+        for name in names:
+            with open(os.path.join(self.config[directory], name), "rb") as f:
+                contents[name] = f.read()
+        return contents
+
+    def testUnchangedInputsAreSkipped(self):
+        certs = ["ca.pem", "admin.pem", "admin-key.pem", "worker-1.pem", "worker-2.pem"]
+        kubeconfigs = ["admin.kubeconfig", "worker-1.kubeconfig"]
+
+        self.build()
+        before = self.read('certificatesPath', certs)
+        beforeKubeconfigs = self.read('k8sConfPath', kubeconfigs)
+
+        self.build("--incremental")
+        self.assertEqual(self.read('certificatesPath', certs), before)
+        self.assertEqual(self.read('k8sConfPath', kubeconfigs), beforeKubeconfigs)
+
+        # a changed input re-issues only the certificates it goes into
+        self.config['workers'][1]['internalIP'] = "10.240.9.9"
+        self.build("--incremental")
+        after = self.read('certificatesPath', certs)
+        self.assertNotEqual(after["worker-2.pem"], before["worker-2.pem"])
+        for name in ("ca.pem", "admin.pem", "worker-1.pem"):
+            self.assertEqual(after[name], before[name])
+
+        # without --incremental everything is issued again, the CA too
+        self.build()
+        again = self.read('certificatesPath', certs)
+        for name in certs:
+            self.assertNotEqual(again[name], after[name])
+
+
+if __name__ == "__main__":
+    unittest.main()
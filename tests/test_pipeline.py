@@ -0,0 +1,55 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from kthw.bench import syntheticConfig
+from kthw.pipeline import main
+
+
+class SharedDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, config):
+        configFile = os.path.join(self.directory, "cluster.json")
+        with open(configFile, "w") as f:
+            json.dump([config], f, indent=4)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return main(["build", "--config", configFile, "--stages", "certs,kubeconfig,encryption,ansible", "--parallel", "4"])
+
+    def testCertificatesAndConfInOneDirectory(self):
+        # certs:ca clears certificatesPath, the encryption key written next to it must survive
+        # every full build unchanged or the Secrets in etcd can't be read anymore
+        config = syntheticConfig(self.directory, 3, 3)
+        config['k8sConfPath'] = config['certificatesPath']
+        encryptionConfig = os.path.join(config['k8sConfPath'], "encryption-config.yaml")
+
+        keys = None
+        for run in range(3):
+            self.assertEqual(self.build(config), 0)
+            names = os.listdir(config['certificatesPath'])
+            self.assertIn("ca.pem", names)
+            self.assertIn("admin.kubeconfig", names)
+            with open(encryptionConfig, "rb") as f:
+                data = f.read()
+            if keys is not None:
+                self.assertEqual(data, keys)
+            keys = data
+
+
+if __name__ == "__main__":
+    unittest.main()
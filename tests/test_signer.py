@@ -0,0 +1,82 @@
+# python -m unittest discover tests (from the repository root)
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import ipaddress
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_PATH)
+
+from cryptography import x509
+from cryptography.x509.oid import ExtendedKeyUsageOID
+
+from kthw.bench import TEMPLATES_PATH
+from kthw.csr import renderCsr
+from kthw.signer import KEY_ALGORITHMS, NativeSigner
+
+
+class NativeSignerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.signer = NativeSigner()
+        self.ca_base = os.path.join(self.directory, "ca")
+        self.signer.initCA(renderCsr(os.path.join(TEMPLATES_PATH, "ca-csr.json")), self.ca_base)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, base):
+        with open(base + ".pem", "rb") as f:
+            return x509.load_pem_x509_certificate(f.read())
+
+    def sign(self, name, hostnames=None, key_spec=None):
+        out_base = os.path.join(self.directory, name)
+        csr = renderCsr(os.path.join(TEMPLATES_PATH, "worker-csr.json"), {"instance": name})
+        self.signer.sign(self.ca_base, os.path.join(TEMPLATES_PATH, "ca-config.json"), "kubernetes", csr, out_base, hostnames, key_spec)
+        return out_base
+
+    def testCertificate(self):
+        out_base = self.sign("worker-1", ["worker-1", "10.240.0.21"])
+        cert = self.load(out_base)
+        ca = self.load(self.ca_base)
+
+        # chains to the CA: issuer, signature and the key identifiers
+        cert.verify_directly_issued_by(ca)
+        self.assertEqual(
+            cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier,
+            ca.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value.key_identifier,
+        )
+        self.assertTrue(ca.extensions.get_extension_for_class(x509.BasicConstraints).value.ca)
+        self.assertFalse(cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca)
+
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        self.assertEqual(san.get_values_for_type(x509.DNSName), ["worker-1"])
+        self.assertEqual(san.get_values_for_type(x509.IPAddress), [ipaddress.ip_address("10.240.0.21")])
+
+        # the usages of the "kubernetes" profile of ca-config.json
+        usage = cert.extensions.get_extension_for_class(x509.KeyUsage)
+        self.assertTrue(usage.critical)
+        self.assertTrue(usage.value.digital_signature)
+        self.assertTrue(usage.value.key_encipherment)
+        self.assertFalse(usage.value.key_cert_sign)
+        self.assertEqual(
+            set(cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value),
+            {ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH},
+        )
+
+        self.assertEqual(cert.subject.rfc4514_string().split(",")[0], "CN=system:node:worker-1")
+        self.assertEqual(os.stat(out_base + "-key.pem").st_mode & 0o777, 0o600)
+        self.assertTrue(os.path.exists(out_base + ".csr"))
+
+    def testKeyAlgorithm(self):
+        cert = self.load(self.sign("worker-2", ["worker-2"], KEY_ALGORITHMS["ecdsa-p256"]))
+        cert.verify_directly_issued_by(self.load(self.ca_base))
+        self.assertEqual(cert.public_key().curve.name, "secp256r1")
+
+
+if __name__ == "__main__":
+    unittest.main()